@@ -0,0 +1,20 @@
+import argparse
+import yaml
+from mm_story_agent.benchmark import StoryBenchmark
+
+
+if __name__ == "__main__":
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--config", "-c", type=str, default="configs/benchmark.yaml")
+    parser.add_argument("--pages", type=int, nargs="+", default=[4, 16, 64, 256],
+                        help="story lengths to benchmark")
+    parser.add_argument("--repeats", type=int, default=3,
+                        help="runs per story length, latency percentiles are computed over them")
+
+    args = parser.parse_args()
+
+    with open(args.config, "r") as reader:
+        config = yaml.load(reader, Loader=yaml.FullLoader)
+
+    StoryBenchmark(config, args.pages, args.repeats).run()
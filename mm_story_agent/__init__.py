@@ -10,13 +10,42 @@ _import_structure = {
         'AudioLDM2Agent',
         'CosyVoiceAgent',
         'StoryDiffusionAgent',
+        'StoryDiffusionPromptAgent',
         'QwenAgent',
+        'OpenAICompatibleAgent',
+        'OpenAIStandInServer',
         'FreesoundSfxAgent',
-        'FreesoundMusicAgent'
+        'FreesoundMusicAgent',
+        'StubLLMAgent',
+        'StubStoryDiffusionAgent',
+        'StubAudioLDM2Agent',
+        'StubTTSAgent',
+        'StubMusicGenAgent',
+        'RemoteToolAgent',
+        'RemoteToolServer'
     ],
     'mm_story_agent': [
         'MMStoryAgent'
     ],
+    'scheduler': [
+        'StageScheduler'
+    ],
+    'batch': [
+        'BatchStoryRunner'
+    ],
+    'benchmark': [
+        'StoryBenchmark'
+    ],
+    'estimator': [
+        'CostEstimator'
+    ],
+    'server': [
+        'StoryServer'
+    ],
+    'job_queue': [
+        'JobQueue',
+        'QueueRunner'
+    ],
     'video_compose_agent': [
         'SlideshowVideoComposeAgent'
     ],
@@ -1,15 +1,25 @@
 from abc import ABC
 
+from .utils.tracing import span
+
 register_map = {
     'qwen': 'QwenAgent',
+    'openai_compatible': 'OpenAICompatibleAgent',
     'qa_outline_story_writer': 'QAOutlineStoryWriter',
     'musicgen_t2m': 'MusicGenAgent',
     'story_diffusion_t2i': 'StoryDiffusionAgent',
+    'story_diffusion_prompt': 'StoryDiffusionPromptAgent',
     'cosyvoice_tts': 'CosyVoiceAgent',
     'audioldm2_t2a': 'AudioLDM2Agent',
     'slideshow_video_compose': 'SlideshowVideoComposeAgent',
     'freesound_sfx_retrieval': 'FreesoundSfxAgent',
     'freesound_music_retrieval': 'FreesoundMusicAgent',
+    'stub_llm': 'StubLLMAgent',
+    'stub_t2i': 'StubStoryDiffusionAgent',
+    'stub_t2a': 'StubAudioLDM2Agent',
+    'stub_tts': 'StubTTSAgent',
+    'stub_t2m': 'StubMusicGenAgent',
+    'remote': 'RemoteToolAgent',
 }    
 
 
@@ -49,4 +59,5 @@ def register_tool(name):
 
 
 def init_tool_instance(cfg):
-    return TOOL_REGISTRY[cfg["tool"]](cfg["cfg"])
\ No newline at end of file
+    with span(f"init {cfg['tool']}", category="init"):
+        return TOOL_REGISTRY[cfg["tool"]](cfg["cfg"])
\ No newline at end of file
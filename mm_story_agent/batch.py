@@ -0,0 +1,436 @@
+import copy
+import json
+import time
+import queue
+import traceback
+from collections import deque
+from pathlib import Path
+from typing import Dict, List, Union
+
+import yaml
+import torch.multiprocessing as mp
+
+from .base import TOOL_REGISTRY, init_tool_instance
+from .mm_story_agent import MMStoryAgent
+from .scheduler import Stage, StageGraph, save_status
+from .utils.checkpoint import StageCheckpoint
+from .utils.memory_budget import MemoryBudget, get_footprint, set_memory_connection, reserve_before_call
+from .utils.tracing import span, set_trace_dir, set_process_name, clear_trace, export_chrome_trace
+from .utils.progress import emit, set_progress_file, set_progress_stage
+from .utils.asset_bus import release_story_assets
+
+
+def run_job(agent, job, results):
+    task_key, params, trace_dir, progress_file = job
+    # events are recorded in the trace (and progress file) of the story the task belongs to
+    set_trace_dir(trace_dir)
+    set_progress_file(progress_file)
+    set_progress_stage(task_key[1])
+    with span(f"call {task_key[1]}", category="stage", tool=type(agent).__name__):
+        result = agent.call(params)
+    results.put((task_key, result, None))
+
+
+def run_batch_jobs(agent, batch, results):
+    # tasks of several stories in one `call_batch`, so that their generation requests share
+    # model batches. The events are recorded in the trace (and progress file) of the first story.
+    set_trace_dir(batch[0][2])
+    set_progress_file(batch[0][3])
+    set_progress_stage(batch[0][0][1])
+    with span(f"call_batch {batch[0][0][1]}", category="stage", tool=type(agent).__name__,
+              tasks=[str(job[0]) for job in batch]):
+        outputs = agent.call_batch([job[1] for job in batch])
+    for (task_key, *_), output in zip(batch, outputs):
+        if isinstance(output, Exception):
+            error = "".join(traceback.format_exception(type(output), output, output.__traceback__))
+            results.put((task_key, None, error))
+        else:
+            results.put((task_key, output, None))
+
+
+def worker_loop(tool_cfg, jobs, results, memory_connection=None):
+    # the tool instance (and the models it loads) lives as long as the worker
+    set_memory_connection(memory_connection)
+    agent = None
+    while True:
+        batch = jobs.get()
+        if batch is None:
+            break
+        set_trace_dir(batch[0][2])
+        set_process_name(f"worker {tool_cfg['tool']}")
+        try:
+            if agent is None:
+                agent = init_tool_instance(tool_cfg)
+            reserve_before_call(agent)
+            if len(batch) > 1:
+                run_batch_jobs(agent, batch, results)
+            else:
+                run_job(agent, batch[0], results)
+        except Exception:
+            error = traceback.format_exc()
+            for task_key, *_ in batch:
+                results.put((task_key, None, error))
+
+
+class StageWorker:
+    """
+    A long-lived process that runs every task of one stage tool, for all stories of a batch.
+    Tasks are sent one at a time, so a crashed worker is always attributed to the right task,
+    except for tools with `call_batch`: up to `batch_tasks` waiting tasks (of different stories)
+    are sent together so that the tool can batch their generation requests.
+    With a memory budget, the process asks to reserve its footprint when it loads its models
+    (`reserve_memory`), and is stopped to release them.
+    """
+
+    def __init__(self, tool_cfg: Dict, results, footprint: Dict = None, batch_tasks: int = 1,
+                 budget: MemoryBudget = None) -> None:
+        self.tool_cfg = tool_cfg
+        self.results = results
+        self.footprint = footprint
+        self.batch_tasks = batch_tasks
+        self.budget = budget
+        self.connection = None
+        self.requested = None
+        self.reserved = False
+        self.jobs = mp.Queue()
+        self.backlog = deque()
+        self.inflight = []
+        self.timeouts = {}
+        self.deadline = None
+        self.process = None
+
+    @property
+    def idle(self):
+        return not self.inflight and not self.backlog
+
+    def start(self):
+        # also restarts a crashed worker, whose models are gone
+        self.release()
+        memory_connection = None
+        if self.budget is not None and any(self.footprint.values()):
+            self.connection, memory_connection = mp.Pipe()
+        self.process = mp.Process(target=worker_loop,
+                                  args=(self.tool_cfg, self.jobs, self.results, memory_connection))
+        self.process.start()
+
+    @property
+    def wants_memory(self):
+        # the process waits in `reserve_memory` before loading its models
+        if self.connection is not None and not self.requested and self.connection.poll():
+            try:
+                self.connection.recv()
+                self.requested = time.time()
+            except EOFError:
+                self.connection = None
+        return self.requested and not self.reserved
+
+    def reserve(self):
+        self.budget.acquire(self.footprint)
+        if self.deadline is not None:
+            # the timeout does not count the time spent waiting for memory
+            self.deadline += time.time() - self.requested
+        self.reserved = True
+        self.connection.send("admitted")
+
+    def release(self):
+        if self.reserved:
+            self.budget.release(self.footprint)
+        self.connection = None
+        # time of the request, if any
+        self.requested = None
+        self.reserved = False
+
+    def submit(self, task_key, params, trace_dir=None, progress_file=None, timeout=None):
+        self.backlog.append((task_key, params, trace_dir, progress_file))
+        self.timeouts[task_key] = timeout
+        self.feed()
+
+    def feed(self):
+        if self.process is not None and not self.inflight and self.backlog:
+            batch = [self.backlog.popleft() for _ in range(min(self.batch_tasks, len(self.backlog)))]
+            self.inflight = [job[0] for job in batch]
+            for task_key, _, _, progress_file in batch:
+                emit("stage_start", progress_file, stage=task_key[1], task=task_key[2])
+            timeouts = [self.timeouts[task_key] for task_key in self.inflight]
+            self.deadline = time.time() + max(timeouts) if all(timeouts) else None
+            self.jobs.put(batch)
+
+    def cancel(self, task_keys):
+        # drop tasks that have not been sent to the process yet
+        self.backlog = deque(job for job in self.backlog if job[0] not in task_keys)
+
+    def timed_out(self):
+        waiting = self.requested and not self.reserved
+        return self.inflight and not waiting and self.deadline is not None and time.time() > self.deadline
+
+    def done(self, task_key):
+        if task_key in self.inflight:
+            self.inflight.remove(task_key)
+        self.timeouts.pop(task_key, None)
+        self.feed()
+
+    def stop(self):
+        if self.process is None:
+            return
+        self.jobs.put(None)
+        self.process.join()
+        self.process = None
+        self.release()
+
+
+def set_story_dir(config: Dict, story_dir: Union[str, Path]):
+    # `story_dir` is repeated in stage params (e.g., video_compose) through a yaml anchor
+    old_story_dir = config["story_dir"]
+    config["story_dir"] = str(story_dir)
+    for value in config.values():
+        if isinstance(value, dict) and isinstance(value.get("params"), dict):
+            if value["params"].get("story_dir") == old_story_dir:
+                value["params"]["story_dir"] = str(story_dir)
+    return config
+
+
+def load_topics(topic_file: Union[str, Path]):
+    with open(topic_file, "r") as reader:
+        topics = json.load(reader)
+    if isinstance(topics, dict):
+        # {category: [topic, ...], ...} like story_eval/story_topics.json
+        topics = [topic for category_topics in topics.values() for topic in category_topics]
+    return topics
+
+
+def configs_from_topics(config: Dict, topics: List[str]):
+    configs = []
+    story_root = Path(config["story_dir"])
+    for idx, topic in enumerate(topics):
+        story_config = copy.deepcopy(config)
+        story_config["story_writer"]["params"]["story_topic"] = topic
+        set_story_dir(story_config, story_root / f"{idx:04d}")
+        configs.append(story_config)
+    return configs
+
+
+def configs_from_dir(config_dir: Union[str, Path]):
+    configs = []
+    for config_file in sorted(Path(config_dir).glob("*.yaml")):
+        with open(config_file, "r") as reader:
+            configs.append(yaml.load(reader, Loader=yaml.FullLoader))
+    return configs
+
+
+class BatchStoryRunner:
+    """
+    Generates many stories with one warm worker per stage tool. Stages of different stories
+    are dispatched to the same worker, so each model is loaded once for the whole batch and
+    story writing of the next stories overlaps with asset generation of the previous ones.
+    With a memory budget, a worker whose models do not fit waits, and idle workers are
+    stopped (releasing their models) to make room for it.
+    """
+
+    def __init__(self, configs: List[Dict], memory_budget: MemoryBudget = None) -> None:
+        self.configs = configs
+        self.mm_story_agent = MMStoryAgent()
+        if memory_budget is None and configs:
+            memory_budget = MemoryBudget.from_config(configs[0].get("memory_budget"))
+        self.memory_budget = memory_budget
+
+    def run(self, incoming: queue.Queue = None):
+        # With `incoming`, the runner keeps serving: `(config, on_finished)` items put there are
+        # added as new stories and `on_finished(result)` is called when they are done; None stops it.
+        results_queue = mp.Queue()
+        workers = {}
+        task_workers = {}
+        stories = []
+
+        def add_story(config, on_finished=None):
+            # a story that cannot be started (e.g., a bad config sent to the server) fails on its
+            # own through `on_finished`, the runner keeps serving the other stories
+            num_stories = len(stories)
+            try:
+                start_story(config, on_finished)
+            except Exception:
+                error = traceback.format_exc()
+                print(f"Story {config.get('story_dir')} could not be started: {error}")
+                if len(stories) > num_stories:
+                    cancel_story(num_stories, "the story could not be started")
+                    stories[num_stories]["finished"] = True
+                if on_finished is not None:
+                    on_finished({
+                        "story_dir": str(config.get("story_dir")),
+                        "failed": [],
+                        "status": {},
+                        "assets": {},
+                        "error": error,
+                    })
+
+        def start_story(config, on_finished=None):
+            stages = {
+                name: Stage(name, stage_cfg)
+                for name, stage_cfg in self.mm_story_agent.build_stages(config).items()
+            }
+            story_dir = Path(config["story_dir"])
+            progress_file = story_dir / "progress.jsonl"
+            stories.append({
+                "config": config,
+                "graph": StageGraph(stages, story_dir,
+                                    StageCheckpoint(story_dir / "checkpoints", config.get("resume", False)),
+                                    progress_file=progress_file),
+                "progress_file": progress_file,
+                "on_finished": on_finished,
+                "finished": False,
+            })
+            story_idx = len(stories) - 1
+            if config.get("trace", True):
+                clear_trace(Path(config["story_dir"]) / "trace")
+            progress_file = stories[story_idx]["progress_file"]
+            progress_file.parent.mkdir(exist_ok=True, parents=True)
+            progress_file.unlink(missing_ok=True)
+            emit("job_start", progress_file, story_dir=config["story_dir"])
+            dispatch(story_idx)
+            check_finished(story_idx)
+
+        def get_worker(stage):
+            key = json.dumps(stage.tool_cfg, sort_keys=True, default=str)
+            if key not in workers:
+                tool_cls = TOOL_REGISTRY[stage.tool_cfg["tool"]]
+                footprint = get_footprint(tool_cls, stage.tool_cfg, stage.memory)
+                batch_tasks = stage.tool_cfg["cfg"].get("batch_tasks", 8) if hasattr(tool_cls, "call_batch") else 1
+                workers[key] = StageWorker(stage.tool_cfg, results_queue, footprint, batch_tasks,
+                                           self.memory_budget)
+            return workers[key]
+
+        def admit_workers():
+            budget = self.memory_budget
+            for worker in workers.values():
+                if worker.process is None and worker.backlog:
+                    worker.start()
+                    worker.feed()
+            for worker in workers.values():
+                if not worker.wants_memory:
+                    continue
+                if not budget.fits(worker.footprint):
+                    # release the models of idle workers to make room
+                    for other in workers.values():
+                        if other.reserved and other.idle:
+                            other.stop()
+                            if budget.fits(worker.footprint):
+                                break
+                    if not budget.fits(worker.footprint):
+                        continue
+                worker.reserve()
+
+        def submit(worker, task_key, params):
+            task_workers[task_key] = worker
+            story_config = stories[task_key[0]]["config"]
+            trace_dir = None
+            if story_config.get("trace", True):
+                trace_dir = Path(story_config["story_dir"]) / "trace"
+            timeout = stories[task_key[0]]["graph"].stages[task_key[1]].timeout
+            worker.submit(task_key, params, trace_dir, stories[task_key[0]]["progress_file"], timeout)
+            admit_workers()
+
+        def dispatch(story_idx):
+            graph = stories[story_idx]["graph"]
+            for name, params in graph.ready():
+                worker = get_worker(graph.stages[name])
+                for page, task_params in graph.tasks(name, params):
+                    submit(worker, (story_idx, name, page), task_params)
+
+        def check_finished(story_idx):
+            story = stories[story_idx]
+            graph = story["graph"]
+            if not story["finished"] and graph.done:
+                story["finished"] = True
+                story_dir = Path(story["config"]["story_dir"])
+                assets = {}
+                if "story_writer" in graph.results:
+                    assets = self.mm_story_agent.collect_modality_results(
+                        story["config"], graph.results["story_writer"], graph.results)
+                if story["config"].get("trace", True) and (story_dir / "trace").exists():
+                    export_chrome_trace(story_dir / "trace", story_dir / "trace.json")
+                save_status(story_dir, graph.status)
+                emit("job_finish", story["progress_file"], failed=sorted(graph.failed))
+                try:
+                    if story["on_finished"] is not None:
+                        story["on_finished"]({
+                            "story_dir": str(story_dir),
+                            "failed": sorted(graph.failed),
+                            "status": graph.status,
+                            "assets": assets,
+                        })
+                finally:
+                    release_story_assets(story_dir)
+
+        def cancel_story(story_idx, reason):
+            # fail fast: the queued tasks and pending stages of the story are no longer needed.
+            # Tasks already running in a (shared) worker are left to finish.
+            graph = stories[story_idx]["graph"]
+            queued = [task_key for task_key in task_workers
+                      if task_key[0] == story_idx and task_key not in task_workers[task_key].inflight]
+            for task_key in queued:
+                task_workers.pop(task_key).cancel({task_key})
+                graph.finish_task(task_key[1], task_key[2], error=reason, status="cancelled")
+            graph.skip_pending(reason)
+
+        def finish_task(task_key, result, error, status="failed"):
+            if task_key not in task_workers:
+                # late result of a task that was already given up (timeout, crashed worker)
+                return
+            story_idx, name, page = task_key
+            story = stories[story_idx]
+            task_workers.pop(task_key).done(task_key)
+            if error is not None:
+                print(f"Stage {name} of {story['config']['story_dir']} failed: {error}")
+            if story["graph"].finish_task(name, page, result, error, status):
+                cancel_story(story_idx, f"required stage {name} failed")
+            dispatch(story_idx)
+            check_finished(story_idx)
+            admit_workers()
+
+        try:
+            for config in self.configs:
+                add_story(config)
+            while task_workers or incoming is not None:
+                while incoming is not None:
+                    try:
+                        item = incoming.get_nowait()
+                    except queue.Empty:
+                        break
+                    if item is None:
+                        incoming = None
+                    else:
+                        add_story(*item)
+                admit_workers()
+                # poll often while serving new stories or while workers wait for memory
+                polling = incoming is not None or any(
+                    worker.connection is not None and not worker.reserved for worker in workers.values())
+                try:
+                    finish_task(*results_queue.get(timeout=0.1 if polling else 1.0))
+                except queue.Empty:
+                    pass
+                # a crashed worker is noticed even while the other workers keep sending results
+                for worker in list(workers.values()):
+                    if worker.process is not None and not worker.process.is_alive() and worker.inflight:
+                        lost = list(worker.inflight)
+                        # the results it sent before it exited are not lost
+                        while True:
+                            try:
+                                finish_task(*results_queue.get_nowait())
+                            except queue.Empty:
+                                break
+                        # restart the worker so that the remaining tasks are still processed
+                        exitcode = worker.process.exitcode
+                        worker.start()
+                        for task_key in lost:
+                            finish_task(task_key, None, f"worker exited with code {exitcode}")
+                for worker in list(workers.values()):
+                    if worker.timed_out():
+                        worker.process.terminate()
+                        worker.process.join()
+                        worker.start()
+                        for task_key in list(worker.inflight):
+                            finish_task(task_key, None, f"{task_key[1]} exceeded its timeout", status="timeout")
+        finally:
+            for worker in workers.values():
+                worker.stop()
+
+        return [story["graph"].results for story in stories]
@@ -0,0 +1,111 @@
+import re
+import copy
+import json
+import math
+import time
+from pathlib import Path
+from typing import Dict, List
+
+import numpy as np
+
+from .mm_story_agent import MMStoryAgent
+from .scheduler import Stage, critical_path
+
+PERCENTILES = (50, 90, 99)
+
+
+def stage_latencies(trace_file):
+    # wall time of each stage in a trace.json, from the first to the last of its
+    # tasks (`foreach` stages run one task per page, named `stage[idx]`)
+    with open(trace_file, "r") as reader:
+        events = json.load(reader)["traceEvents"]
+    spans = {}
+    for event in events:
+        if event.get("cat") != "stage" or event.get("ph") != "X":
+            continue
+        name = re.sub(r"\[\d+\]$", "", event["name"].split(" ", 1)[1])
+        start, end = event["ts"], event["ts"] + event["dur"]
+        if name in spans:
+            start, end = min(start, spans[name][0]), max(end, spans[name][1])
+        spans[name] = (start, end)
+    return {name: (end - start) / 1e6 for name, (start, end) in spans.items()}
+
+
+def percentiles(values: List[float]):
+    return {f"p{q}": float(np.percentile(values, q)) for q in PERCENTILES}
+
+
+class StoryBenchmark:
+    """
+    Runs the whole pipeline for stories of several lengths, usually with the stub tools of
+    `configs/benchmark.yaml`, and reports percentiles over the repeats of the latency of each
+    stage and of the orchestration overhead: the part of the wall time not explained by the
+    stages on the critical path (process launch, IPC, tool initialization, scheduling).
+    """
+
+    def __init__(self,
+                 config: Dict,
+                 page_counts: List[int] = (4, 16, 64, 256),
+                 repeats: int = 3) -> None:
+        self.config = config
+        self.page_counts = page_counts
+        self.repeats = repeats
+        # the number of chapters is chosen for the pages per chapter of the stub LLM
+        llm_cfg = (config.get("llm") or {}).get("cfg") or {}
+        self.pages_per_chapter = llm_cfg.get("pages_per_chapter", 3)
+
+    def make_config(self, num_pages: int, repeat: int):
+        config = copy.deepcopy(self.config)
+        story_dir = Path(self.config["story_dir"]) / f"{num_pages}_pages" / f"run{repeat}"
+        config["story_dir"] = str(story_dir)
+        config["video_compose"]["params"]["story_dir"] = str(story_dir)
+        config["story_writer"]["cfg"]["num_outline"] = math.ceil(num_pages / self.pages_per_chapter)
+        config["trace"] = True
+        config["resume"] = False
+        return config
+
+    def run_story(self, config):
+        mm_story_agent = MMStoryAgent()
+        stages = {name: Stage(name, cfg) for name, cfg in mm_story_agent.build_stages(config).items()}
+        start = time.time()
+        results = mm_story_agent.call(config)
+        wall = time.time() - start
+        latencies = stage_latencies(Path(config["story_dir"]) / "trace.json")
+        return {
+            "num_pages": len(results.get("story_writer", [])),
+            "wall": wall,
+            "stages": latencies,
+            "overhead": wall - critical_path(stages, latencies),
+            "failed": sorted(set(stages) - set(results)),
+        }
+
+    def run(self):
+        report = {}
+        for num_pages in self.page_counts:
+            runs = []
+            for repeat in range(self.repeats):
+                config = self.make_config(num_pages, repeat)
+                runs.append(self.run_story(config))
+                print(f"{num_pages} pages, run {repeat}: {runs[-1]['wall']:.2f} s")
+            stage_names = sorted({name for run in runs for name in run["stages"]})
+            report[num_pages] = {
+                "wall": percentiles([run["wall"] for run in runs]),
+                "overhead": percentiles([run["overhead"] for run in runs]),
+                "stages": {
+                    name: percentiles([run["stages"][name] for run in runs if name in run["stages"]])
+                    for name in stage_names
+                },
+                "runs": runs,
+            }
+        with open(Path(self.config["story_dir"]) / "benchmark.json", "w") as writer:
+            json.dump(report, writer, ensure_ascii=False, indent=4)
+        self.print_report(report)
+        return report
+
+    def print_report(self, report):
+        header = " / ".join(f"p{q}" for q in PERCENTILES)
+        for num_pages, result in report.items():
+            print(f"\n{num_pages} pages ({len(result['runs'])} runs), seconds {header}")
+            rows = [("wall", result["wall"]), ("overhead", result["overhead"])] + list(result["stages"].items())
+            for name, values in rows:
+                print(f"    {name:<24}" + " / ".join(f"{value:8.3f}" for value in values.values()))
@@ -0,0 +1,186 @@
+import json
+from pathlib import Path
+from typing import Dict, List
+
+from .mm_story_agent import MMStoryAgent
+from .scheduler import Stage, critical_path
+
+# the chapter writer is asked for at most 3 pages per chapter (`chapter_writer_system`)
+PAGES_PER_CHAPTER = {"best": 1, "worst": 3}
+# video seconds per page (speech, fades and slides) until calibrated from a trace
+DEFAULT_SECONDS_PER_PAGE = 10.0
+CASES = ("best", "worst")
+
+
+def review_requests(num_turns: int, case: str):
+    # a reviser and a reviewer call per turn, the reviewer passes the first draft in the best case
+    return 2 * (num_turns if case == "worst" else 1)
+
+
+def prompt_requests(cfg: Dict, num_pages: int):
+    # pages revised on their own, or `batch_pages` of them per request
+    batch_pages = cfg.get("batch_pages")
+    return -(-num_pages // batch_pages) if batch_pages else num_pages
+
+
+def calibrate(trace_files: List):
+    """
+    Seconds per unit of work (LLM request, diffusion step, MusicGen token, video frame, model
+    load, ...) measured in previous runs, from the spans of their trace.json that declare a `unit`.
+    """
+    totals = {}
+    video = [0.0, 0]
+    for trace_file in trace_files:
+        trace_file = Path(trace_file)
+        if trace_file.is_dir():
+            trace_file = trace_file / "trace.json"
+        with open(trace_file, "r") as reader:
+            events = json.load(reader)["traceEvents"]
+        for event in events:
+            args = event.get("args") or {}
+            if event.get("ph") != "X" or "unit" not in args:
+                continue
+            total = totals.setdefault(args["unit"], [0.0, 0])
+            total[0] += event["dur"] / 1e6
+            total[1] += args.get("units", 1)
+            if args["unit"] == "video_frame" and args.get("pages"):
+                video[0] += args["units"] / args["fps"]
+                video[1] += args["pages"]
+    unit_costs = {unit: seconds / units for unit, (seconds, units) in totals.items() if units > 0}
+    if video[1] > 0:
+        unit_costs["video_seconds_per_page"] = video[0] / video[1]
+    return unit_costs
+
+
+class CostEstimator:
+    """
+    Dry run of a pipeline config: counts the work each stage will do in the best case (reviewers
+    pass the first draft, one page per chapter) and the worst case (every review turn is used, the
+    most pages per chapter), and turns it into seconds with per-unit costs from `calibrate`.
+    LLM format retries (up to `max_try` per request) are not counted.
+    """
+
+    def __init__(self,
+                 config: Dict,
+                 unit_costs: Dict = None) -> None:
+        self.config = config
+        self.unit_costs = unit_costs or {}
+        self.seconds_per_page = self.unit_costs.get("video_seconds_per_page", DEFAULT_SECONDS_PER_PAGE)
+        self.tool_units = {
+            "qa_outline_story_writer": self.story_writer_units,
+            "story_diffusion_t2i": self.image_units,
+            "story_diffusion_prompt": self.image_prompt_units,
+            "audioldm2_t2a": self.sound_units,
+            "freesound_sfx_retrieval": self.freesound_sfx_units,
+            "cosyvoice_tts": self.speech_units,
+            "musicgen_t2m": self.music_units,
+            "freesound_music_retrieval": self.freesound_music_units,
+            "slideshow_video_compose": self.video_units,
+            # the stub tools of `configs/benchmark.yaml` do the same work
+            "stub_t2i": self.image_units,
+            "stub_t2a": self.sound_units,
+            "stub_tts": self.speech_units,
+            "stub_t2m": self.music_units,
+        }
+
+    def num_pages(self, case: str):
+        num_outline = (self.config["story_writer"].get("cfg") or {}).get("num_outline", 4)
+        return num_outline * PAGES_PER_CHAPTER[case]
+
+    def story_writer_units(self, stage: Stage, num_pages: int, case: str):
+        cfg = stage.tool_cfg["cfg"]
+        # the asker may end the dialogue with its first question
+        dialogue = 2 * cfg.get("max_conv_turns", 3) if case == "worst" else 1
+        return {"llm_request": dialogue + 1 + cfg.get("num_outline", 4)}
+
+    def image_prompt_units(self, stage: Stage, num_pages: int, case: str):
+        # role extraction and one prompt per page
+        num_turns = stage.tool_cfg["cfg"].get("num_turns", 3)
+        return {"llm_request": review_requests(num_turns, case) * (prompt_requests(stage.tool_cfg["cfg"], num_pages) + 1)}
+
+    def image_units(self, stage: Stage, num_pages: int, case: str):
+        units = {
+            "image_step": num_pages * stage.tool_cfg["cfg"].get("num_steps", 50),
+            "image_model_load": 1,
+        }
+        if "prompts" not in stage.inputs:
+            units.update(self.image_prompt_units(stage, num_pages, case))
+        return units
+
+    def sound_units(self, stage: Stage, num_pages: int, case: str):
+        num_turns = stage.tool_cfg["cfg"].get("num_turns", 3)
+        # pages whose prompt is "No sounds." are not generated, all pages are counted
+        return {
+            "llm_request": review_requests(num_turns, case) * prompt_requests(stage.tool_cfg["cfg"], num_pages),
+            "sound_step": num_pages * stage.params.get("n_candidate_per_text", 3) * stage.params.get("ddim_steps", 100),
+            "sound_model_load": 1,
+        }
+
+    def freesound_sfx_units(self, stage: Stage, num_pages: int, case: str):
+        num_turns = stage.tool_cfg["cfg"].get("num_turns", 3)
+        return {"llm_request": review_requests(num_turns, case) * prompt_requests(stage.tool_cfg["cfg"], num_pages)}
+
+    def speech_units(self, stage: Stage, num_pages: int, case: str):
+        return {"tts_request": num_pages, "speech_model_load": 1}
+
+    def music_units(self, stage: Stage, num_pages: int, case: str):
+        # MusicGenAgent reads `max_turns`
+        num_turns = stage.tool_cfg["cfg"].get("max_turns", 3)
+        return {
+            "llm_request": review_requests(num_turns, case),
+            "music_token": int(51.2 * stage.params.get("duration", 30.0)),
+            "music_model_load": 1,
+        }
+
+    def freesound_music_units(self, stage: Stage, num_pages: int, case: str):
+        num_turns = stage.tool_cfg["cfg"].get("num_turns", 3)
+        return {"llm_request": review_requests(num_turns, case)}
+
+    def video_units(self, stage: Stage, num_pages: int, case: str):
+        return {
+            "compose_page": num_pages,
+            "video_frame": int(stage.params.get("fps", 10) * num_pages * self.seconds_per_page),
+        }
+
+    def estimate(self):
+        stages = {name: Stage(name, cfg) for name, cfg in MMStoryAgent().build_stages(self.config).items()}
+        report = {"stages": {}, "uncalibrated": set()}
+        for case in CASES:
+            num_pages = self.num_pages(case)
+            latencies = {}
+            for name, stage in stages.items():
+                units_fn = self.tool_units.get(stage.tool_cfg["tool"])
+                units = units_fn(stage, num_pages, case) if units_fn is not None else {}
+                seconds = 0.0
+                for unit, count in units.items():
+                    if unit in self.unit_costs:
+                        seconds += count * self.unit_costs[unit]
+                    else:
+                        report["uncalibrated"].add(unit)
+                latencies[name] = seconds
+                report["stages"].setdefault(name, {})[case] = {"units": units, "seconds": seconds}
+            report[case] = {
+                "pages": num_pages,
+                "llm_requests": sum(s[case]["units"].get("llm_request", 0) for s in report["stages"].values()),
+                "compute_seconds": sum(latencies.values()),
+                "latency": critical_path(stages, latencies),
+            }
+        report["uncalibrated"] = sorted(report["uncalibrated"])
+        return report
+
+
+def print_report(report: Dict):
+    for name, result in report["stages"].items():
+        print(f"{name}:")
+        units = sorted(set(result["best"]["units"]) | set(result["worst"]["units"]))
+        for unit in units:
+            best, worst = (result[case]["units"].get(unit, 0) for case in CASES)
+            print(f"    {unit:<20}{best:>12,} - {worst:,}")
+        print(f"    {'seconds':<20}{result['best']['seconds']:>12,.1f} - {result['worst']['seconds']:,.1f}")
+    for case in CASES:
+        total = report[case]
+        print(f"{case} case: {total['pages']} pages, {total['llm_requests']} LLM requests, "
+              f"{total['compute_seconds']:,.1f} s of compute, {total['latency']:,.1f} s end to end")
+    if report["uncalibrated"]:
+        print(f"No timings for {report['uncalibrated']}, they are left out of the seconds. "
+              f"Pass the trace.json of previous runs with --calibrate.")
@@ -0,0 +1,355 @@
+import os
+import json
+import time
+import pickle
+import socket
+import sqlite3
+import threading
+import traceback
+from pathlib import Path
+from typing import Dict, Union
+
+import torch.multiprocessing as mp
+
+from .base import TOOL_REGISTRY, init_tool_instance
+from .mm_story_agent import MMStoryAgent
+from .scheduler import Stage, StageGraph, save_status
+from .utils.checkpoint import StageCheckpoint
+from .utils.tracing import span, set_trace_dir, set_process_name, clear_trace, export_chrome_trace
+from .utils.progress import emit, set_progress_file, set_progress_stage
+from .utils.asset_bus import release_story_assets
+
+# number of worker processes of each pool
+DEFAULT_POOLS = {"llm": 4, "image": 1, "audio": 1, "tts": 2, "compose": 2, "default": 1}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    config TEXT NOT NULL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    status TEXT NOT NULL DEFAULT '{}',
+    created REAL NOT NULL,
+    updated REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS tasks (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    job_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    page INTEGER NOT NULL,
+    pool TEXT NOT NULL,
+    tool_cfg TEXT NOT NULL,
+    params BLOB NOT NULL,
+    timeout REAL,
+    state TEXT NOT NULL DEFAULT 'queued',
+    attempts INTEGER NOT NULL DEFAULT 0,
+    worker TEXT,
+    started REAL,
+    lease_until REAL,
+    result BLOB,
+    error TEXT,
+    UNIQUE (job_id, stage, page)
+);
+CREATE INDEX IF NOT EXISTS tasks_claim ON tasks (pool, state);
+CREATE TABLE IF NOT EXISTS stage_results (
+    job_id INTEGER NOT NULL,
+    stage TEXT NOT NULL,
+    result BLOB,
+    PRIMARY KEY (job_id, stage)
+);
+"""
+
+
+class JobQueue:
+    """
+    SQLite store of story jobs, their stage tasks and stage results. Everything needed to
+    continue a batch is in the database: tasks left `running` by a crashed worker are queued
+    again once their lease expires, finished tasks and stages are never run twice.
+    Each process (and thread) opens its own `JobQueue`.
+    """
+
+    def __init__(self, db_path: Union[str, Path]) -> None:
+        self.db_path = str(db_path)
+        Path(self.db_path).parent.mkdir(exist_ok=True, parents=True)
+        self.db = sqlite3.connect(self.db_path, timeout=60, isolation_level=None)
+        self.db.row_factory = sqlite3.Row
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.executescript(SCHEMA)
+
+    def submit(self, config: Dict):
+        now = time.time()
+        cursor = self.db.execute(
+            "INSERT INTO jobs (config, created, updated) VALUES (?, ?, ?)",
+            (json.dumps(config, ensure_ascii=False), now, now))
+        return cursor.lastrowid
+
+    def job_config(self, job_id: int):
+        return json.loads(self.db.execute("SELECT config FROM jobs WHERE id = ?", (job_id,)).fetchone()["config"])
+
+    def active_jobs(self):
+        rows = self.db.execute("SELECT * FROM jobs WHERE state IN ('queued', 'running') ORDER BY id").fetchall()
+        return [(row["id"], row["state"], json.loads(row["config"]), json.loads(row["status"])) for row in rows]
+
+    def set_job_state(self, job_id: int, state: str, status: Dict = None):
+        if status is None:
+            self.db.execute("UPDATE jobs SET state = ?, updated = ? WHERE id = ?", (state, time.time(), job_id))
+        else:
+            self.db.execute("UPDATE jobs SET state = ?, status = ?, updated = ? WHERE id = ?",
+                            (state, json.dumps(status, ensure_ascii=False), time.time(), job_id))
+
+    def add_task(self, job_id: int, stage: Stage, page: int, pool: str, params: Dict):
+        self.db.execute(
+            "INSERT OR IGNORE INTO tasks (job_id, stage, page, pool, tool_cfg, params, timeout) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+            (job_id, stage.name, page, pool, json.dumps(stage.tool_cfg, sort_keys=True, default=str),
+             pickle.dumps(params), stage.timeout))
+
+    def job_tasks(self, job_id: int):
+        # {stage: [task row, ...]} ordered by page
+        tasks = {}
+        for row in self.db.execute("SELECT * FROM tasks WHERE job_id = ? ORDER BY page", (job_id,)):
+            tasks.setdefault(row["stage"], []).append(row)
+        return tasks
+
+    def task_counts(self):
+        # {job_id: (tasks, finished tasks)} of the active jobs; advancing a job only depends on
+        # which of its tasks are finished, so the job has nothing to do while these are unchanged
+        rows = self.db.execute(
+            "SELECT job_id, COUNT(*) AS tasks, "
+            "SUM(state IN ('done', 'failed', 'timeout', 'cancelled')) AS finished FROM tasks "
+            "WHERE job_id IN (SELECT id FROM jobs WHERE state IN ('queued', 'running')) GROUP BY job_id")
+        return {row["job_id"]: (row["tasks"], row["finished"]) for row in rows}
+
+    def stage_results(self, job_id: int):
+        rows = self.db.execute("SELECT stage, result FROM stage_results WHERE job_id = ?", (job_id,))
+        return {row["stage"]: pickle.loads(row["result"]) for row in rows}
+
+    def save_stage_result(self, job_id: int, stage: str, result):
+        self.db.execute("INSERT OR REPLACE INTO stage_results (job_id, stage, result) VALUES (?, ?, ?)",
+                        (job_id, stage, pickle.dumps(result)))
+
+    def cancel_tasks(self, job_id: int, reason: str):
+        # queued tasks are dropped, running ones finish but their results are not used
+        self.db.execute("UPDATE tasks SET state = 'cancelled', error = ? WHERE job_id = ? AND state = 'queued'",
+                        (reason, job_id))
+
+    def claim(self, pool: str, worker: str, lease: float):
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            row = self.db.execute(
+                "SELECT * FROM tasks WHERE pool = ? AND state = 'queued' ORDER BY job_id, id LIMIT 1",
+                (pool,)).fetchone()
+            if row is not None:
+                now = time.time()
+                self.db.execute(
+                    "UPDATE tasks SET state = 'running', worker = ?, started = ?, lease_until = ? WHERE id = ?",
+                    (worker, now, now + lease, row["id"]))
+            self.db.execute("COMMIT")
+        except Exception:
+            self.db.execute("ROLLBACK")
+            raise
+        return row
+
+    def heartbeat(self, task_id: int, worker: str, lease: float):
+        self.db.execute("UPDATE tasks SET lease_until = ? WHERE id = ? AND worker = ? AND state = 'running'",
+                        (time.time() + lease, task_id, worker))
+
+    def complete(self, task_id: int, worker: str, result=None, error: str = None, state: str = None):
+        # a worker whose task was taken away (lease expired, timeout) can no longer complete it
+        state = state or ("failed" if error is not None else "done")
+        self.db.execute(
+            "UPDATE tasks SET state = ?, result = ?, error = ?, lease_until = NULL "
+            "WHERE id = ? AND worker = ? AND state = 'running'",
+            (state, pickle.dumps(result) if error is None else None, error, task_id, worker))
+
+    def requeue(self, max_attempts: int, worker: str = None):
+        # tasks of lost workers (expired lease, or the given dead worker) run again, up to `max_attempts` times
+        if worker is not None:
+            condition, args = "worker = ?", (worker,)
+        else:
+            condition, args = "lease_until < ?", (time.time(),)
+        self.db.execute(
+            f"UPDATE tasks SET state = CASE WHEN attempts + 1 >= ? THEN 'failed' ELSE 'queued' END, "
+            f"error = CASE WHEN attempts + 1 >= ? THEN 'worker lost ' || (attempts + 1) || ' times' END, "
+            f"attempts = attempts + 1, worker = NULL, lease_until = NULL "
+            f"WHERE state = 'running' AND {condition}",
+            (max_attempts, max_attempts, *args))
+
+    def timed_out(self):
+        return self.db.execute(
+            "SELECT id, worker FROM tasks WHERE state = 'running' AND timeout IS NOT NULL "
+            "AND started + timeout < ?", (time.time(),)).fetchall()
+
+
+def queue_worker(db_path: str, pool: str, worker: str, lease: float, poll_interval: float):
+    # runs the tasks of one pool; tool instances (and their models) are kept between tasks
+    job_queue = JobQueue(db_path)
+    set_process_name(f"worker {worker}")
+    agents = {}
+    parent = os.getppid()
+    # stop when the runner is gone (e.g., killed), its tasks are queued again by the next runner
+    while os.getppid() == parent:
+        task = job_queue.claim(pool, worker, lease)
+        if task is None:
+            time.sleep(poll_interval)
+            continue
+        stopped = threading.Event()
+
+        def keep_lease(task_id=task["id"]):
+            heartbeat_queue = JobQueue(db_path)
+            while not stopped.wait(lease / 3):
+                heartbeat_queue.heartbeat(task_id, worker, lease)
+
+        heartbeat = threading.Thread(target=keep_lease, daemon=True)
+        heartbeat.start()
+        try:
+            params = pickle.loads(task["params"])
+            config = job_queue.job_config(task["job_id"])
+            story_dir = Path(config["story_dir"])
+            set_trace_dir(story_dir / "trace" if config.get("trace", True) else None)
+            set_progress_file(story_dir / "progress.jsonl")
+            set_progress_stage(task["stage"])
+            if task["tool_cfg"] not in agents:
+                agents[task["tool_cfg"]] = init_tool_instance(json.loads(task["tool_cfg"]))
+            agent = agents[task["tool_cfg"]]
+            with span(f"call {task['stage']}", category="stage", tool=type(agent).__name__):
+                result = agent.call(params)
+            job_queue.complete(task["id"], worker, result=result)
+        except Exception:
+            job_queue.complete(task["id"], worker, error=traceback.format_exc())
+        finally:
+            stopped.set()
+            heartbeat.join()
+
+
+class QueueRunner:
+    """
+    Runs the jobs of a `JobQueue`: advances the stage graph of every job into tasks, and keeps
+    a pool of worker processes for each modality (`llm`, `image`, `audio`, `tts`, `compose`) with
+    its own concurrency limit. A worker runs any registered tool of its pool, given by the `pool`
+    attribute of the tool class (`default` without one). Workers that die are restarted and their
+    task is queued again; a stage `timeout` kills the worker. Only jobs with new or finished tasks
+    since the last poll are advanced.
+    """
+
+    def __init__(self,
+                 db_path: Union[str, Path],
+                 pools: Dict = None,
+                 lease: float = 30.0,
+                 max_attempts: int = 3,
+                 poll_interval: float = 0.5) -> None:
+        self.db_path = str(db_path)
+        self.pools = {**DEFAULT_POOLS, **(pools or {})}
+        self.lease = lease
+        self.max_attempts = max_attempts
+        self.poll_interval = poll_interval
+        self.job_queue = JobQueue(self.db_path)
+        self.mm_story_agent = MMStoryAgent()
+        self.workers = {}
+        # task counts of each job when it was last advanced
+        self.advanced = {}
+
+    def start_worker(self, worker: str, pool: str):
+        process = mp.Process(target=queue_worker,
+                             args=(self.db_path, pool, worker, self.lease, self.poll_interval))
+        process.start()
+        self.workers[worker] = (pool, process)
+
+    def check_workers(self):
+        for worker, (pool, process) in list(self.workers.items()):
+            if not process.is_alive():
+                print(f"Worker {worker} exited with code {process.exitcode}, restarting it")
+                self.job_queue.requeue(self.max_attempts, worker=worker)
+                self.start_worker(worker, pool)
+        for task_id, worker in self.job_queue.timed_out():
+            if worker in self.workers:
+                pool, process = self.workers[worker]
+                process.terminate()
+                process.join()
+                self.job_queue.complete(task_id, worker, error="exceeded its timeout", state="timeout")
+                self.start_worker(worker, pool)
+        self.job_queue.requeue(self.max_attempts)
+
+    def advance(self, job_id: int, state: str, config: Dict, status: Dict):
+        # dispatches the ready stages of a job and collects its finished ones, returns True when done
+        story_dir = Path(config["story_dir"])
+        if state == "queued":
+            if config.get("trace", True):
+                clear_trace(story_dir / "trace")
+            story_dir.mkdir(exist_ok=True, parents=True)
+            (story_dir / "progress.jsonl").unlink(missing_ok=True)
+            emit("job_start", story_dir / "progress.jsonl", story_dir=str(story_dir))
+        stages = {name: Stage(name, cfg) for name, cfg in self.mm_story_agent.build_stages(config).items()}
+        progress_file = story_dir / "progress.jsonl"
+        graph = StageGraph(stages, story_dir, StageCheckpoint(story_dir / "checkpoints", config.get("resume", False)),
+                           self.job_queue.stage_results(job_id), status, progress_file)
+        saved = set(graph.results)
+
+        # the stages dispatched by earlier passes, with the outcome of their finished tasks
+        tasks = self.job_queue.job_tasks(job_id)
+        dispatched = [name for name in tasks if name in graph.pending]
+        for name in dispatched:
+            graph.restore_tasks(name, len(tasks[name]))
+        for name in dispatched:
+            for task in tasks[name]:
+                page = task["page"] if task["page"] >= 0 else None
+                if task["state"] == "done":
+                    required_failed = graph.finish_task(name, page, pickle.loads(task["result"]))
+                elif task["state"] in ("failed", "timeout", "cancelled"):
+                    required_failed = graph.finish_task(name, page, error=task["error"] or task["state"],
+                                                        status=task["state"])
+                else:
+                    continue
+                if required_failed:
+                    self.job_queue.cancel_tasks(job_id, f"required stage {name} failed")
+                    graph.skip_pending(f"required stage {name} failed")
+
+        for name, params in graph.ready():
+            stage = stages[name]
+            # the stage can override the pool of its tool
+            pool = config[name].get("pool") or getattr(TOOL_REGISTRY[stage.tool_cfg["tool"]], "pool", "default")
+            for page, task_params in graph.tasks(name, params):
+                self.job_queue.add_task(job_id, stage, -1 if page is None else page, pool, task_params)
+            emit("stage_start", progress_file, stage=name, pool=pool)
+        for name in graph.results.keys() - saved:
+            self.job_queue.save_stage_result(job_id, name, graph.results[name])
+
+        done = graph.done
+        if done:
+            if "story_writer" in graph.results:
+                self.mm_story_agent.collect_modality_results(config, graph.results["story_writer"], graph.results)
+            if config.get("trace", True) and (story_dir / "trace").exists():
+                export_chrome_trace(story_dir / "trace", story_dir / "trace.json")
+            save_status(story_dir, graph.status)
+            emit("job_finish", progress_file, failed=sorted(graph.failed))
+            release_story_assets(story_dir)
+        state = "running"
+        if done:
+            # optional stages may fail
+            state = "failed" if any(stages[name].required for name in graph.failed) else "finished"
+        self.job_queue.set_job_state(job_id, state, graph.status)
+        return done
+
+    def run(self, forever: bool = False):
+        # until every job is finished, or forever (new jobs can be submitted meanwhile)
+        for pool, size in self.pools.items():
+            for idx in range(size):
+                self.start_worker(f"{socket.gethostname()}-{os.getpid()}-{pool}{idx}", pool)
+        try:
+            while True:
+                self.check_workers()
+                jobs = self.job_queue.active_jobs()
+                task_counts = self.job_queue.task_counts()
+                for job_id, state, config, status in jobs:
+                    counts = task_counts.get(job_id, (0, 0))
+                    if job_id in self.advanced and self.advanced[job_id] == counts:
+                        continue
+                    self.advanced[job_id] = counts
+                    if self.advance(job_id, state, config, status):
+                        self.advanced.pop(job_id)
+                if not jobs and not forever:
+                    break
+                time.sleep(self.poll_interval)
+        finally:
+            for pool, process in self.workers.values():
+                process.terminate()
+                process.join()
@@ -6,6 +6,14 @@ import torch.multiprocessing as mp
 mp.set_start_method("spawn", force=True)
 
 from .base import init_tool_instance
+from .scheduler import StageScheduler
+from .utils.memory_budget import MemoryBudget
+from .utils.tracing import set_trace_dir, set_process_name, clear_trace, export_chrome_trace
+from .utils.progress import set_progress_file, emit, ProgressMonitor
+from .utils.asset_bus import release_story_assets
+from .utils.llm_cache import set_llm_cache
+from .utils.rate_limit import set_llm_rate_limit
+from .utils.llm_backend import set_llm_backend
 
 
 class MMStoryAgent:
@@ -13,55 +21,44 @@ class MMStoryAgent:
     def __init__(self) -> None:
         self.modalities = ["image", "sound", "speech", "music"]
 
-    def call_modality_agent(self, modality, agent, params, return_dict):
-        result = agent.call(params)
-        return_dict[modality] = result
-
     def write_story(self, config):
         cfg = config["story_writer"]
         story_writer = init_tool_instance(cfg)
         pages = story_writer.call(cfg["params"])
         return pages
-    
-    def generate_modality_assets(self, config, pages):
-        script_data = {"pages": [{"story": page} for page in pages]}
-        story_dir = Path(config["story_dir"])
 
-        for sub_dir in self.modalities:
-            (story_dir / sub_dir).mkdir(exist_ok=True, parents=True)
+    def build_stages(self, config):
+        # Stages are the blocks listed in `stages`. Without it, the default
+        # graph is story_writer -> {image, sound, speech, music} -> video_compose.
+        # Data dependencies of the default blocks are filled in unless declared.
+        modality_stages = [modality + "_generation" for modality in self.modalities]
+        stage_names = config.get("stages", ["story_writer"] + modality_stages + ["video_compose"])
+        stages = {}
+        for name in stage_names:
+            stage = dict(config[name])
+            if name in modality_stages:
+                stage.setdefault("inputs", {"pages": "story_writer"})
+                stage.setdefault("save_dir", name[:-len("_generation")])
+            elif name == "video_compose":
+                stage.setdefault("inputs", {"pages": "story_writer"})
+                stage.setdefault("after", [m for m in modality_stages if m in stage_names])
+            stages[name] = stage
+        return stages
 
-        agents = {}
-        params = {}
-        for modality in self.modalities:
-            agents[modality] = init_tool_instance(config[modality + "_generation"])
-            params[modality] = config[modality + "_generation"]["params"].copy()
-            params[modality].update({
-                "pages": pages,
-                "save_path": story_dir / modality
-            })
-
-        processes = []
-        return_dict = mp.Manager().dict()
+    def collect_modality_results(self, config, pages, results):
+        # agents return handles (path, shape, checksum) of the files they saved,
+        # the assets themselves are never loaded here
+        script_data = {"pages": [{"story": page} for page in pages]}
+        story_dir = Path(config["story_dir"])
+        assets = {}
 
         for modality in self.modalities:
-            p = mp.Process(
-                target=self.call_modality_agent,
-                args=(
-                    modality,
-                    agents[modality],
-                    params[modality],
-                    return_dict)
-                )
-            processes.append(p)
-            p.start()
-        
-        for p in processes:
-            p.join()
-
-        for modality, result in return_dict.items():
+            if modality + "_generation" not in results:
+                continue
+            result = results[modality + "_generation"]
             try:
+                assets[modality] = result.get("assets", [])
                 if modality == "image":
-                    images = result["generation_results"]
                     for idx in range(len(pages)):
                         script_data["pages"][idx]["image_prompt"] = result["prompts"][idx]
                 elif modality == "sound":
@@ -71,19 +68,59 @@ class MMStoryAgent:
                     script_data["music_prompt"] = result["prompt"]
             except Exception as e:
                 print(f"Error occurred during generation: {e}")
-        
+        script_data["assets"] = assets
+
         with open(story_dir / "script_data.json", "w") as writer:
             json.dump(script_data, writer, ensure_ascii=False, indent=4)
-        
-        return images
-    
-    def compose_storytelling_video(self, config, pages):
-        video_compose_agent = init_tool_instance(config["video_compose"])
-        params = config["video_compose"]["params"].copy()
-        params["pages"] = pages
-        video_compose_agent.call(params)
 
-    def call(self, config):
-        pages = self.write_story(config)
-        images = self.generate_modality_assets(config, pages)
-        self.compose_storytelling_video(config, pages)
+        return assets
+
+    def call(self, config, progress_callback=None):
+        # progress events (stage start / finish, pages, LLM retries, encoding) are appended to
+        # `story_dir/progress.jsonl` and, if given, passed to `progress_callback(event)`
+        story_dir = Path(config["story_dir"])
+        if config.get("trace", True):
+            set_trace_dir(story_dir / "trace")
+            clear_trace(story_dir / "trace")
+            set_process_name("MMStoryAgent")
+        if "llm" in config:
+            set_llm_backend(config["llm"])
+        if "llm_cache" in config:
+            set_llm_cache(config["llm_cache"])
+        if "llm_rate_limit" in config:
+            set_llm_rate_limit(config["llm_rate_limit"])
+        progress_file = story_dir / "progress.jsonl"
+        set_progress_file(progress_file)
+        progress_file.unlink(missing_ok=True)
+        monitor = None
+        if progress_callback is not None:
+            monitor = ProgressMonitor(progress_file, progress_callback).start()
+        emit("job_start", story_dir=str(story_dir))
+        try:
+            scheduler = StageScheduler(
+                self.build_stages(config),
+                config["story_dir"],
+                stream_pages=config.get("stream_pages", False),
+                resume=config.get("resume", False),
+                memory_budget=MemoryBudget.from_config(config.get("memory_budget"))
+            )
+            results = scheduler.run()
+            if "story_writer" in results:
+                self.collect_modality_results(config, results["story_writer"], results)
+            failed = [name for name, status in scheduler.status.items()
+                      if status["status"] not in ("succeeded", "resumed")]
+            if failed:
+                print(f"Stages not completed: {failed}, see {story_dir / 'status.json'}. "
+                      f"Run again with --resume to rerun only these, reusing the completed stages.")
+            emit("job_finish", story_dir=str(story_dir), failed=failed)
+        finally:
+            release_story_assets(story_dir)
+            # a failed run must not leave the monitor thread running or the progress file set
+            if monitor is not None:
+                monitor.stop()
+            set_progress_file(None)
+            # later runs in this process (server, benchmark) must not write into this trace
+            if config.get("trace", True):
+                export_chrome_trace(story_dir / "trace", story_dir / "trace.json")
+                set_trace_dir(None)
+        return results
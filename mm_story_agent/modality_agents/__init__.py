@@ -16,14 +16,32 @@ _import_structure = {
         'CosyVoiceAgent'
     ],
     'image_agent': [
-        'StoryDiffusionAgent'
+        'StoryDiffusionAgent',
+        'StoryDiffusionPromptAgent'
     ],
     'llm': [
         'QwenAgent'
     ],
+    'openai_llm': [
+        'OpenAICompatibleAgent',
+        'OpenAIStandInServer'
+    ],
     "freesound_agent": [
         "FreesoundSfxAgent",
         "FreesoundMusicAgent"
+    ],
+    "stub_llm": [
+        "StubLLMAgent"
+    ],
+    "stub_agents": [
+        "StubStoryDiffusionAgent",
+        "StubAudioLDM2Agent",
+        "StubTTSAgent",
+        "StubMusicGenAgent"
+    ],
+    "remote_agent": [
+        "RemoteToolAgent",
+        "RemoteToolServer"
     ]
 }
 
@@ -13,7 +13,10 @@ from tqdm import tqdm
 
 from ..prompts_en import fsd_search_reviser_system, fsd_search_reviewer_system, fsd_music_reviser_system, fsd_music_reviewer_system
 from ..base import register_tool, init_tool_instance
-from ..utils.llm_output_check import parse_list
+from ..utils.llm_output_check import ListStreamParser, stream_llm
+from ..utils.llm_backend import default_llm
+from ..utils.async_llm import acall_llm
+from ..utils.batch_review import BatchedReview, batch_system_prompts, map_chunks
 
 
 def download_file(url, save_path):
@@ -71,6 +74,9 @@ def search_download_mix_query_list(query_list, save_path, sample_rate: int = 160
 @register_tool("freesound_sfx_retrieval")
 class FreesoundSfxAgent:
 
+    stream_pages = True
+    pool = "audio"
+
     def __init__(self, cfg) -> None:
         self.cfg = cfg
 
@@ -79,14 +85,14 @@ class FreesoundSfxAgent:
             pages: List,
         ):
         query_reviser = init_tool_instance({
-            "tool": self.cfg.get("llm", "qwen"),
+            "tool": self.cfg.get("llm", default_llm()),
             "cfg": {
                 "system_prompt": fsd_search_reviser_system,
                 "track_history": False
             }
         })
         query_reviewer = init_tool_instance({
-            "tool": self.cfg.get("llm", "qwen"),
+            "tool": self.cfg.get("llm", default_llm()),
             "cfg": {
                 "system_prompt": fsd_search_reviewer_system,
                 "track_history": False
@@ -94,36 +100,101 @@ class FreesoundSfxAgent:
         })
         num_turns = self.cfg.get("num_turns", 3)
 
-        query_lists = []
-        for page in pages:
-            review = ""
-            query_list = ""
-            for turn in range(num_turns):
-                query_list, success = query_reviser.call(
-                    json.dumps({
-                        "story": page,
-                        "previous_result": query_list,
-                        "improvement_suggestions": review,
-                    }, ensure_ascii=False),
-                    success_check_fn=parse_list
-                )
-                review, success = query_reviewer.call(json.dumps({
+        if self.cfg.get("batch_pages"):
+            return self.generate_search_queries_in_batches(pages, num_turns, query_reviser, query_reviewer)
+        return [self.revise_query_list(page, query_reviser, query_reviewer, num_turns) for page in pages]
+
+    def revise_query_list(self, page, query_reviser, query_reviewer, num_turns):
+        review = ""
+        query_list = ""
+        # the queries of the last turn whose output was a complete list
+        queries = []
+        for turn in range(num_turns):
+            parser = ListStreamParser()
+            list(stream_llm(
+                query_reviser,
+                json.dumps({
+                    "story": page,
+                    "previous_result": query_list,
+                    "improvement_suggestions": review,
+                }, ensure_ascii=False),
+                parser
+            ))
+            query_list = parser.text
+            if parser.done:
+                queries = parser.elements
+            review, success = query_reviewer.call(json.dumps({
+                "story": page,
+                "sound_description": query_list
+            }, ensure_ascii=False))
+            if review == "Check passed.":
+                break
+            else:
+                print(review)
+        return queries
+
+    async def arevise_query_list(self, page, query_reviser, query_reviewer, num_turns):
+        # `revise_query_list` with the requests awaited, the other pages of the batch go on meanwhile
+        review = ""
+        query_list = ""
+        queries = []
+        for turn in range(num_turns):
+            parser = ListStreamParser()
+            response, success = await acall_llm(
+                query_reviser,
+                json.dumps({
                     "story": page,
-                    "sound_description": query_list
-                }, ensure_ascii=False))
-                if review == "Check passed.":
-                    break
-                else:
-                    print(review)
-            query_lists.append(eval(query_list))
+                    "previous_result": query_list,
+                    "improvement_suggestions": review,
+                }, ensure_ascii=False),
+                success_check_fn=parser.accepts
+            )
+            query_list = response if isinstance(response, str) else ""
+            parser.feed(query_list)
+            if parser.close():
+                queries = parser.elements
+            review, success = await acall_llm(query_reviewer, json.dumps({
+                "story": page,
+                "sound_description": query_list
+            }, ensure_ascii=False))
+            if review == "Check passed.":
+                break
+            else:
+                print(review)
+        return queries
 
-        return query_lists
+    def generate_search_queries_in_batches(self, pages, num_turns, query_reviser, query_reviewer):
+        # `batch_pages` pages per reviser / reviewer request, see `BatchedReview`
+        reviser_system, reviewer_system = batch_system_prompts(fsd_search_reviser_system, fsd_search_reviewer_system)
+        review = BatchedReview(
+            init_tool_instance({
+                "tool": self.cfg.get("llm", default_llm()),
+                "cfg": {"system_prompt": reviser_system, "track_history": False}
+            }),
+            init_tool_instance({
+                "tool": self.cfg.get("llm", default_llm()),
+                "cfg": {"system_prompt": reviewer_system, "track_history": False}
+            }),
+            num_turns,
+            result_key="sound_description",
+            check_result=lambda query_list: isinstance(query_list, list) and
+            all(isinstance(query, str) for query in query_list)
+        )
+
+        async def revise_chunk(chunk, context):
+            results = await review.run({}, {idx + 1: {"story": page} for idx, page in chunk})
+            # pages whose batched output was not usable are revised on their own
+            return [results[idx + 1] if idx + 1 in results else
+                    await self.arevise_query_list(page, query_reviser, query_reviewer, num_turns)
+                    for idx, page in chunk]
+
+        return map_chunks(pages, self.cfg["batch_pages"], revise_chunk, self.cfg.get("llm_concurrency", 1))
 
     def call(self, params):
         queries = self.generate_search_query_from_story(params["pages"])
         save_path = params["save_path"]
         save_path = Path(save_path)
-        for idx, query_list in enumerate(tqdm(queries)):
+        for idx, query_list in enumerate(tqdm(queries), start=params.get("page_offset", 0)):
             search_download_mix_query_list(
                 query_list,
                 save_path / f"p{idx + 1}.mp3",
@@ -136,6 +207,8 @@ class FreesoundSfxAgent:
 @register_tool("freesound_music_retrieval")
 class FreesoundMusicAgent:
 
+    pool = "audio"
+
     def __init__(self, cfg) -> None:
         self.cfg = cfg
 
@@ -144,14 +217,14 @@ class FreesoundMusicAgent:
             pages: List,
         ):
         query_reviser = init_tool_instance({
-            "tool": self.cfg.get("llm", "qwen"),
+            "tool": self.cfg.get("llm", default_llm()),
             "cfg": {
                 "system_prompt": fsd_music_reviser_system,
                 "track_history": False
             }
         })
         query_reviewer = init_tool_instance({
-            "tool": self.cfg.get("llm", "qwen"),
+            "tool": self.cfg.get("llm", default_llm()),
             "cfg": {
                 "system_prompt": fsd_music_reviewer_system,
                 "track_history": False
@@ -2,15 +2,28 @@ from typing import List, Dict
 import json
 import os
 import random
+import functools
 
 import numpy as np
 import torch
 import torch.nn.functional as F
-from diffusers import StableDiffusionXLPipeline, DDIMScheduler
 
 from mm_story_agent.prompts_en import role_extract_system, role_review_system, \
     story_to_image_reviser_system, story_to_image_review_system
 from mm_story_agent.base import register_tool, init_tool_instance
+from mm_story_agent.utils.page_stream import pages_so_far, all_pages
+from mm_story_agent.utils.asset_cache import AssetCache
+from mm_story_agent.utils.checkpoint import checkpointed, acheckpointed
+from mm_story_agent.utils.asset import make_asset_handle
+from mm_story_agent.utils.tracing import traced
+from mm_story_agent.utils.asset_bus import AssetPublisher
+from mm_story_agent.utils.progress import PageProgress
+from mm_story_agent.utils.speculation import SpeculativeQueue
+from mm_story_agent.utils.memory_budget import reserve_memory
+from mm_story_agent.utils.async_llm import acall_llm, run_concurrently, run_streamed
+from mm_story_agent.utils.llm_output_check import JsonStreamParser, stream_llm
+from mm_story_agent.utils.llm_backend import default_llm
+from mm_story_agent.utils.batch_review import BatchedReview, batch_system_prompts, map_chunks
 
 
 def setup_seed(seed):
@@ -385,6 +398,7 @@ class SpatialAttnProcessor2_0(torch.nn.Module):
 
 class StoryDiffusionSynthesizer:
 
+    @traced("load StoryDiffusionSynthesizer", category="model_load", unit="image_model_load")
     def __init__(self,
                  num_pages: int,
                  height: int,
@@ -440,6 +454,9 @@ class StoryDiffusionSynthesizer:
             )
         }
 
+        # imported with the model, so that agents that do not load it (the stubs) need no diffusers
+        from diffusers import StableDiffusionXLPipeline, DDIMScheduler
+
         pipe = StableDiffusionXLPipeline.from_pretrained(
             model_name,
             torch_dtype=torch.float16,
@@ -484,6 +501,18 @@ class StoryDiffusionSynthesizer:
         print(f"number of the processor : {self.attn_args['total_count']}")
         # unet.set_attn_processor(copy.deepcopy(attn_procs))
         unet.set_attn_processor(attn_procs)
+        self.set_num_pages(self.total_length)
+
+        self.pipe = pipe
+        self.negative_prompt = "naked, deformed, bad anatomy, disfigured, poorly drawn face, mutation," \
+                               "extra limb, ugly, disgusting, poorly drawn hands, missing limb, floating" \
+                               "limbs, disconnected limbs, blurry, watermarks, oversaturated, distorted hands, amputation"
+
+    def set_num_pages(self,
+                      num_pages: int):
+        # only the attention masks depend on the number of pages, so a loaded
+        # pipeline can be reused for stories of different lengths
+        self.total_length = num_pages
         mask1024, mask4096 = cal_attn_mask_xl(
             self.total_length,
             self.id_length,
@@ -500,11 +529,6 @@ class StoryDiffusionSynthesizer:
             "mask4096": mask4096
         })
 
-        self.pipe = pipe
-        self.negative_prompt = "naked, deformed, bad anatomy, disfigured, poorly drawn face, mutation," \
-                               "extra limb, ugly, disgusting, poorly drawn hands, missing limb, floating" \
-                               "limbs, disconnected limbs, blurry, watermarks, oversaturated, distorted hands, amputation"
-
     def set_attn_write(self,
                        value: bool):
         unet = self.pipe.unet
@@ -523,13 +547,17 @@ class StoryDiffusionSynthesizer:
         p, n = self.styles.get(style_name, self.styles["(No style)"])
         return p.replace("{prompt}", positive) 
     
+    @traced("StoryDiffusionSynthesizer.call", category="inference", unit="image_step",
+            attrs=lambda call: {"units": len(call["prompts"]) * call["self"].num_steps})
     def call(self,
              prompts: List[str],        
              input_id_images = None,
              start_merge_step = None,
              style_name: str = "Pixar/Disney Character",
              guidance_scale: float = 5.0,
-             seed: int = 2047):
+             seed: int = 2047,
+             stop=None):
+        # `stop()` is checked between pages, the generation is abandoned (None is returned) once it is true
         assert len(prompts) == self.total_length, "The number of prompts should be equal to the number of pages."
         setup_seed(seed)
         generator = torch.Generator(device=self.device).manual_seed(seed)
@@ -542,6 +570,7 @@ class StoryDiffusionSynthesizer:
             "cur_step": 0,
             "attn_count": 0
         })
+        progress = PageProgress("images", total=len(prompts))
         id_prompts, negative_prompt = self.apply_style(style_name, id_prompts, self.negative_prompt)
         id_images = self.pipe(
             id_prompts,
@@ -553,10 +582,14 @@ class StoryDiffusionSynthesizer:
             width=self.width,
             negative_prompt=negative_prompt,
             generator=generator).images
+        for idx in range(len(id_images)):
+            progress.page_done(idx + 1)
     
         self.set_attn_write(False)
         real_images = []
         for real_prompt in real_prompts:
+            if stop is not None and stop():
+                return None
             self.attn_args["cur_step"] = 0
             real_prompt = self.apply_style_positive(style_name, real_prompt)
             real_images.append(self.pipe(
@@ -568,6 +601,7 @@ class StoryDiffusionSynthesizer:
                 negative_prompt=negative_prompt,
                 generator=generator).images[0]
             )
+            progress.page_done(self.id_length + len(real_images))
 
         images = id_images + real_images             
         return images
@@ -576,55 +610,182 @@ class StoryDiffusionSynthesizer:
 @register_tool("story_diffusion_t2i")
 class StoryDiffusionAgent:
 
+    stream_pages = True
+    # worker pool of the job queue (see `QueueRunner`)
+    pool = "image"
+    # estimated peak memory in GB, used by the memory budget (SDXL in fp16 + consistent self-attention)
+    memory_footprint = {"ram": 8, "vram": 14}
+    # the footprint is reserved when the model is loaded, not while prompts are revised
+    reserves_memory = True
+
     def __init__(self, cfg) -> None:
         self.cfg = cfg
+        self.synthesizer = None
+        self.publisher = AssetPublisher(cfg)
+
+    def get_synthesizer(self, num_pages: int):
+        # the pipeline stays loaded so that an agent serving several stories loads it only once
+        if self.synthesizer is None:
+            reserve_memory()
+            self.synthesizer = StoryDiffusionSynthesizer(
+                num_pages=num_pages,
+                height=self.cfg.get("height", 512),
+                width=self.cfg.get("width", 512),
+                model_name=self.cfg.get("model_name", "stabilityai/stable-diffusion-xl-base-1.0"),
+                id_length=self.cfg.get("id_length", 4),
+                num_steps=self.cfg.get("num_steps", 50)
+            )
+        else:
+            self.synthesizer.set_num_pages(num_pages)
+        return self.synthesizer
         
-    def call(self, params: Dict):
-        pages: List = params["pages"]
-        save_path: str = params["save_path"]
-        role_dict = self.extract_role_from_story(pages)
-        image_prompts = self.generate_image_prompt_from_story(pages)
+    def generate_prompts_with_role_desc(self, pages, checkpoint=None, on_drafts=None):
+        # per-page prompts can be revised while the story is still being written,
+        # role extraction needs the complete story.
+        # With `on_drafts`, the first drafts of all pages are written first and passed (with role
+        # descriptions) to `on_drafts(prompts, on_revised)` before they are reviewed;
+        # `on_revised()` is called as soon as a page's prompt is revised.
+        num_turns = self.cfg.get("num_turns", 3)
+        if on_drafts is None:
+            image_prompts = self.generate_image_prompt_from_story(pages, num_turns, checkpoint=checkpoint)
+            pages = all_pages(pages)
+            role_dict = checkpointed(checkpoint, "roles", {"pages": pages},
+                                     lambda: self.extract_role_from_story(pages))
+            return self.add_role_desc(image_prompts, role_dict)
+        drafts = self.draft_image_prompts(pages, num_turns, checkpoint)
+        pages = all_pages(pages)
+        role_dict = checkpointed(checkpoint, "roles", {"pages": pages},
+                                 lambda: self.extract_role_from_story(pages))
+        on_revised = on_drafts(self.add_role_desc([draft["prompt"] for draft in drafts], role_dict),
+                               all(draft["final"] for draft in drafts))
+        image_prompts = self.review_image_prompts(drafts, num_turns, checkpoint, on_revised)
+        return self.add_role_desc(image_prompts, role_dict)
+
+    def add_role_desc(self, image_prompts, role_dict):
         image_prompts_with_role_desc = []
         for image_prompt in image_prompts:
             for role, role_desc in role_dict.items():
                 if role in image_prompt:
                     image_prompt = image_prompt.replace(role, role_desc)
             image_prompts_with_role_desc.append(image_prompt)
-        generation_agent = StoryDiffusionSynthesizer(
-            num_pages=len(pages),
-            height=self.cfg.get("height", 512),
-            width=self.cfg.get("width", 512),
-            model_name=self.cfg.get("model_name", "stabilityai/stable-diffusion-xl-base-1.0"),
-            id_length=self.cfg.get("id_length", 4),
-            num_steps=self.cfg.get("num_steps", 50)
-        )
-        images = generation_agent.call(
-            image_prompts_with_role_desc,
-            style_name=params.get("style_name", "Storybook"),
-            guidance_scale=params.get("guidance_scale", 5.0),
-            seed=params.get("seed", 2047)
+        return image_prompts_with_role_desc
+
+    def make_generation_inputs(self, prompts, params: Dict):
+        return {
+            "tool": "story_diffusion_t2i",
+            "model": self.cfg.get("model_name", "stabilityai/stable-diffusion-xl-base-1.0"),
+            "prompts": prompts,
+            "height": self.cfg.get("height", 512),
+            "width": self.cfg.get("width", 512),
+            "id_length": self.cfg.get("id_length", 4),
+            "num_steps": self.cfg.get("num_steps", 50),
+            "style_name": params.get("style_name", "Storybook"),
+            "guidance_scale": params.get("guidance_scale", 5.0),
+            "seed": params.get("seed", 2047),
+        }
+
+    def synthesize_images(self, prompts, generation_inputs, stop=None):
+        generation_agent = self.get_synthesizer(len(prompts))
+        return generation_agent.call(
+            prompts,
+            style_name=generation_inputs["style_name"],
+            guidance_scale=generation_inputs["guidance_scale"],
+            seed=generation_inputs["seed"],
+            stop=stop
         )
+
+    def speculate_images(self, requests: List[Dict]):
+        for request in requests:
+            request["result"] = self.synthesize_images(
+                request["prompts"], request["generation_inputs"],
+                stop=lambda: request["speculation"].is_discarded(request["key"]))
+
+    def generate_images(self, prompts, generation_inputs, image_files, speculation=None):
+        cache = AssetCache.from_config(self.cfg.get("cache"))
+        if cache is not None:
+            # pages are generated jointly (consistent self-attention), so the key of
+            # each page depends on the prompts of all pages
+            cache_keys = [cache.make_key(page=idx, **generation_inputs) for idx in range(len(image_files))]
+            if all(cache.load(cache_key, image_file)
+                   for cache_key, image_file in zip(cache_keys, image_files)):
+                return [str(image_file) for image_file in image_files]
+        images = None
+        if speculation is not None:
+            # generated from the first drafts, if none of them was revised
+            speculative = speculation.keep("images")
+            speculation.close()
+            if speculative is not None:
+                images = speculative["result"]
+        if images is None:
+            images = self.synthesize_images(prompts, generation_inputs)
         for idx, image in enumerate(images):
-            image.save(save_path / f"p{idx + 1}.png")
+            self.publisher.publish(image_files[idx], np.asarray(image.convert("RGB")))
+            if self.publisher.save_files:
+                image.save(image_files[idx])
+                if cache is not None:
+                    cache.save(cache_keys[idx], image_files[idx])
+        return [str(image_file) for image_file in image_files]
+
+    def call(self, params: Dict):
+        pages: List = params["pages"]
+        save_path: str = params["save_path"]
+        checkpoint = params.get("checkpoint")
+        speculation = None
+        try:
+            if "prompts" in params:
+                # prompts are generated by a separate `story_diffusion_prompt` stage
+                image_prompts_with_role_desc = params["prompts"]
+                pages = all_pages(pages)
+            else:
+                on_drafts = None
+                if self.cfg.get("speculative", False):
+                    speculation = SpeculativeQueue(self.speculate_images)
+                    on_drafts = lambda prompts, final: self.speculate_on_drafts(
+                        speculation, prompts, final, params)
+                image_prompts_with_role_desc = self.generate_prompts_with_role_desc(
+                    pages, checkpoint, on_drafts)
+                pages = all_pages(pages)
+            generation_inputs = self.make_generation_inputs(image_prompts_with_role_desc, params)
+            image_files = [save_path / f"p{idx + 1}.png" for idx in range(len(pages))]
+            checkpointed(checkpoint, "images", generation_inputs,
+                         lambda: self.generate_images(
+                             image_prompts_with_role_desc, generation_inputs, image_files, speculation),
+                         files=image_files)
+        finally:
+            if speculation is not None:
+                speculation.discard("images")
+                speculation.close()
+        # only handles of the saved files are returned, the images stay on disk
         return {
             "prompts": image_prompts_with_role_desc,
-            "generation_results": images,
+            "assets": [make_asset_handle(image_file) for image_file in image_files],
         }
         
+    def speculate_on_drafts(self, speculation: SpeculativeQueue, prompts, final: bool, params: Dict):
+        # pages are generated jointly, so the speculative images are only kept if no prompt is revised
+        if not final:
+            speculation.submit({
+                "key": "images",
+                "prompts": prompts,
+                "generation_inputs": self.make_generation_inputs(prompts, params),
+                "speculation": speculation,
+            })
+        return lambda: speculation.discard("images")
+
     def extract_role_from_story(
             self,
             pages: List,
         ):
         num_turns = self.cfg.get("num_turns", 3)
         role_extractor = init_tool_instance({
-            "tool": self.cfg.get("llm", "qwen"),
+            "tool": self.cfg.get("llm", default_llm()),
             "cfg": {
                 "system_prompt": role_extract_system,
                 "track_history": False
             }
         })
         role_reviewer = init_tool_instance({
-            "tool": self.cfg.get("llm", "qwen"),
+            "tool": self.cfg.get("llm", default_llm()),
             "cfg": {
                 "system_prompt": role_review_system,
                 "track_history": False
@@ -633,13 +794,16 @@ class StoryDiffusionAgent:
         roles = {}
         review = ""
         for turn in range(num_turns):
-            roles, success = role_extractor.call(json.dumps({
+            parser = JsonStreamParser(check_fn=lambda roles: all(
+                isinstance(description, str) for description in roles.values()))
+            list(stream_llm(role_extractor, json.dumps({
                     "story_content": pages,
                     "previous_result": roles,
                     "improvement_suggestions": review,
                 }, ensure_ascii=False
-            ))
-            roles = json.loads(roles.strip("```json").strip("```"))
+            ), parser))
+            if parser.done:
+                roles = parser.elements[0]
             review, success = role_reviewer.call(json.dumps({
                 "story_content": pages,
                 "role_descriptions": roles
@@ -648,46 +812,229 @@ class StoryDiffusionAgent:
                 break
         return roles
 
-    def generate_image_prompt_from_story(
-            self,
-            pages: List,
-            num_turns: int = 3
-        ):
-        image_prompt_reviewer = init_tool_instance({
-            "tool": self.cfg.get("llm", "qwen"),
+    def init_image_prompt_llms(self):
+        image_prompt_reviser = init_tool_instance({
+            "tool": self.cfg.get("llm", default_llm()),
             "cfg": {
-                "system_prompt": story_to_image_review_system,
+                "system_prompt": story_to_image_reviser_system,
                 "track_history": False
             }
         })
-        image_prompt_reviser = init_tool_instance({
-            "tool": self.cfg.get("llm", "qwen"),
+        image_prompt_reviewer = init_tool_instance({
+            "tool": self.cfg.get("llm", default_llm()),
             "cfg": {
-                "system_prompt": story_to_image_reviser_system,
+                "system_prompt": story_to_image_review_system,
                 "track_history": False
             }
         })
-        image_prompts = []
-
-        for page in pages:
-            review = ""
-            image_prompt = ""
-            for turn in range(num_turns):
-                image_prompt, success = image_prompt_reviser.call(json.dumps({
-                    "all_pages": pages,
-                    "current_page": page,
-                    "previous_result": image_prompt,
-                    "improvement_suggestions": review,
-                }, ensure_ascii=False))
-                if image_prompt.startswith("Image description:"):
-                    image_prompt = image_prompt[len("Image description:"):]
-                review, success = image_prompt_reviewer.call(json.dumps({
-                    "all_pages": pages,
-                    "current_page": page,
-                    "image_description": image_prompt
-                }, ensure_ascii=False))
-                if review == "Check passed.":
-                    break
-            image_prompts.append(image_prompt)
-        return image_prompts
+        return image_prompt_reviser, image_prompt_reviewer
+
+    def init_batched_review(self, num_turns: int):
+        # `batch_pages` pages per reviser / reviewer request, see `BatchedReview`
+        reviser_system, reviewer_system = batch_system_prompts(
+            story_to_image_reviser_system, story_to_image_review_system)
+        return BatchedReview(
+            init_tool_instance({
+                "tool": self.cfg.get("llm", default_llm()),
+                "cfg": {"system_prompt": reviser_system, "track_history": False}
+            }),
+            init_tool_instance({
+                "tool": self.cfg.get("llm", default_llm()),
+                "cfg": {"system_prompt": reviewer_system, "track_history": False}
+            }),
+            num_turns,
+            result_key="image_description",
+            clean_result=lambda prompt: prompt[len("Image description:"):]
+            if prompt.startswith("Image description:") else prompt
+        )
+
+    def load_prompt_checkpoints(self, chunk, context, num_turns: int, checkpoint=None):
+        # {idx: (checkpoint inputs, checkpointed prompt or None)} of the pages of a chunk
+        loaded = {}
+        for idx, page in chunk:
+            inputs = {"all_pages": context, "current_page": page, "num_turns": num_turns}
+            found, image_prompt = checkpoint.load(f"image_prompt_p{idx + 1}", inputs) \
+                if checkpoint is not None else (False, None)
+            loaded[idx] = (inputs, image_prompt if found else None)
+        return loaded
+
+    def generate_image_prompt_from_story(
+            self,
+            pages: List,
+            num_turns: int = 3,
+            checkpoint=None
+        ):
+        image_prompt_reviser, image_prompt_reviewer = self.init_image_prompt_llms()
+        # the number of pages is unknown while they are streamed
+        progress = PageProgress("image prompts", total=len(pages) if isinstance(pages, list) else None)
+
+        async def revise(idx, page, context):
+            image_prompt = await acheckpointed(
+                checkpoint,
+                f"image_prompt_p{idx + 1}",
+                {"all_pages": context, "current_page": page, "num_turns": num_turns},
+                lambda: self.revise_image_prompt(
+                    page, context, image_prompt_reviser, image_prompt_reviewer, num_turns)
+            )
+            progress.page_done(idx + 1)
+            return image_prompt
+
+        if self.cfg.get("batch_pages"):
+            review = self.init_batched_review(num_turns)
+
+            async def revise_chunk(chunk, context):
+                loaded = self.load_prompt_checkpoints(chunk, context, num_turns, checkpoint)
+                todo = {idx + 1: {"current_page": page} for idx, page in chunk if loaded[idx][1] is None}
+                results = await review.run({"all_pages": context}, todo)
+                image_prompts = []
+                for idx, page in chunk:
+                    inputs, image_prompt = loaded[idx]
+                    if image_prompt is None:
+                        image_prompt = results.get(idx + 1)
+                        if image_prompt is None:
+                            # the batched output was not usable, the page is revised on its own
+                            image_prompt = await self.revise_image_prompt(
+                                page, context, image_prompt_reviser, image_prompt_reviewer, num_turns)
+                        if checkpoint is not None:
+                            checkpoint.save(f"image_prompt_p{idx + 1}", inputs, image_prompt)
+                    progress.page_done(idx + 1)
+                    image_prompts.append(image_prompt)
+                return image_prompts
+
+            return map_chunks(pages, self.cfg["batch_pages"], revise_chunk, self.cfg.get("llm_concurrency", 1))
+        return self.map_pages(pages, revise)
+
+    def map_pages(self, pages: List, coroutine_fn):
+        # `coroutine_fn(idx, page, context)` for each page: the pages of a complete story are
+        # revised independently, up to `llm_concurrency` of them at a time, streamed pages as they arrive
+        if isinstance(pages, list):
+            return run_concurrently([functools.partial(coroutine_fn, idx, page, pages)
+                                     for idx, page in enumerate(pages)],
+                                    self.cfg.get("llm_concurrency", 1))
+        return run_streamed(pages, lambda idx, page: coroutine_fn(idx, page, pages_so_far(pages)),
+                            self.cfg.get("llm_concurrency", 1))
+
+    def draft_image_prompts(self, pages: List, num_turns: int = 3, checkpoint=None):
+        # first drafts of all pages, or their final prompts if checkpointed
+        image_prompt_reviser, _ = self.init_image_prompt_llms()
+
+        async def draft(idx, page, context):
+            inputs = {"all_pages": context, "current_page": page, "num_turns": num_turns}
+            found, image_prompt = checkpoint.load(f"image_prompt_p{idx + 1}", inputs) \
+                if checkpoint is not None else (False, None)
+            if not found:
+                image_prompt = await self.call_image_prompt_reviser(image_prompt_reviser, page, context)
+            return {"page": page, "context": context, "inputs": inputs,
+                    "prompt": image_prompt, "final": found}
+
+        if self.cfg.get("batch_pages"):
+            review = self.init_batched_review(num_turns)
+
+            async def draft_chunk(chunk, context):
+                loaded = self.load_prompt_checkpoints(chunk, context, num_turns, checkpoint)
+                todo = {idx + 1: {"current_page": page} for idx, page in chunk if loaded[idx][1] is None}
+                revised = await review.revise({"all_pages": context}, todo)
+                drafts = []
+                for idx, page in chunk:
+                    inputs, image_prompt = loaded[idx]
+                    found = image_prompt is not None
+                    if not found:
+                        image_prompt = revised.get(idx + 1)
+                        if image_prompt is None:
+                            image_prompt = await self.call_image_prompt_reviser(image_prompt_reviser, page, context)
+                    drafts.append({"page": page, "context": context, "inputs": inputs,
+                                   "prompt": image_prompt, "final": found})
+                return drafts
+
+            return map_chunks(pages, self.cfg["batch_pages"], draft_chunk, self.cfg.get("llm_concurrency", 1))
+        return self.map_pages(pages, draft)
+
+    def review_image_prompts(self, drafts: List[Dict], num_turns: int = 3, checkpoint=None, on_revised=None):
+        image_prompt_reviser, image_prompt_reviewer = self.init_image_prompt_llms()
+        progress = PageProgress("image prompts", total=len(drafts))
+
+        async def review(idx, draft, _):
+            image_prompt = draft["prompt"]
+            if not draft["final"]:
+                image_prompt = await acheckpointed(
+                    checkpoint,
+                    f"image_prompt_p{idx + 1}",
+                    draft["inputs"],
+                    lambda: self.review_image_prompt(
+                        draft["page"], draft["context"], draft["prompt"],
+                        image_prompt_reviser, image_prompt_reviewer, num_turns)
+                )
+            if image_prompt != draft["prompt"] and on_revised is not None:
+                on_revised()
+            progress.page_done(idx + 1)
+            return image_prompt
+
+        if self.cfg.get("batch_pages"):
+            batched_review = self.init_batched_review(num_turns)
+
+            async def review_chunk(chunk, _):
+                todo = {idx + 1: {"current_page": draft["page"]} for idx, draft in chunk if not draft["final"]}
+                # the pages of a chunk share the story context of its last page
+                results = await batched_review.run(
+                    {"all_pages": chunk[-1][1]["context"]}, todo,
+                    drafts={idx + 1: draft["prompt"] for idx, draft in chunk if not draft["final"]})
+                image_prompts = []
+                for idx, draft in chunk:
+                    image_prompt = draft["prompt"]
+                    if not draft["final"]:
+                        image_prompt = results[idx + 1]
+                        if checkpoint is not None:
+                            checkpoint.save(f"image_prompt_p{idx + 1}", draft["inputs"], image_prompt)
+                    if image_prompt != draft["prompt"] and on_revised is not None:
+                        on_revised()
+                    progress.page_done(idx + 1)
+                    image_prompts.append(image_prompt)
+                return image_prompts
+
+            return map_chunks(drafts, self.cfg["batch_pages"], review_chunk, self.cfg.get("llm_concurrency", 1))
+        return self.map_pages(drafts, review)
+
+    async def call_image_prompt_reviser(self, image_prompt_reviser, page, context, image_prompt="", review=""):
+        image_prompt, success = await acall_llm(image_prompt_reviser, json.dumps({
+            "all_pages": context,
+            "current_page": page,
+            "previous_result": image_prompt,
+            "improvement_suggestions": review,
+        }, ensure_ascii=False))
+        if image_prompt.startswith("Image description:"):
+            image_prompt = image_prompt[len("Image description:"):]
+        return image_prompt
+
+    async def revise_image_prompt(self, page, context, image_prompt_reviser, image_prompt_reviewer, num_turns):
+        image_prompt = await self.call_image_prompt_reviser(image_prompt_reviser, page, context)
+        return await self.review_image_prompt(
+            page, context, image_prompt, image_prompt_reviser, image_prompt_reviewer, num_turns)
+
+    async def review_image_prompt(self, page, context, image_prompt, image_prompt_reviser, image_prompt_reviewer, num_turns):
+        # the first draft is `image_prompt`, each turn after a failed review revises it
+        review = ""
+        for turn in range(num_turns):
+            if turn > 0:
+                image_prompt = await self.call_image_prompt_reviser(
+                    image_prompt_reviser, page, context, image_prompt, review)
+            review, success = await acall_llm(image_prompt_reviewer, json.dumps({
+                "all_pages": context,
+                "current_page": page,
+                "image_description": image_prompt
+            }, ensure_ascii=False))
+            if review == "Check passed.":
+                break
+        return image_prompt
+
+
+@register_tool("story_diffusion_prompt")
+class StoryDiffusionPromptAgent(StoryDiffusionAgent):
 
+    # only calls the LLM
+    memory_footprint = {}
+    pool = "llm"
+
+    def call(self, params: Dict):
+        return {
+            "prompts": self.generate_prompts_with_role_desc(params["pages"], params.get("checkpoint"))
+        }
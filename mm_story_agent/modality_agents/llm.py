@@ -1,9 +1,37 @@
 from typing import Dict, Callable
+from http import HTTPStatus
 import os
 
 from dashscope import Generation
 
 from mm_story_agent.base import register_tool
+from mm_story_agent.utils.progress import emit
+from mm_story_agent.utils.async_llm import get_session
+from mm_story_agent.utils.llm_cache import LLMResponseCache
+from mm_story_agent.utils.llm_output_check import StreamParser
+from mm_story_agent.utils.llm_retry import RetriedRequest
+from mm_story_agent.utils.rate_limit import RateLimiter, is_throttled
+from mm_story_agent.utils.llm_backend import llm_backend_cfg
+from mm_story_agent.utils.context_budget import ContextBudget, usage_tokens
+from mm_story_agent.prompts_en import history_summary_system
+
+# the HTTP API `Generation.call` uses
+GENERATION_URL = os.environ.get("DASHSCOPE_HTTP_BASE_URL", "https://dashscope.aliyuncs.com/api/v1") + \
+    "/services/aigc/text-generation/generation"
+
+
+def response_throttled(response):
+    return is_throttled(getattr(response, "status_code", None), getattr(response, "code", None))
+
+
+def read_response(response):
+    # the (text, throttled) of a response of `Generation.call`
+    return response.output.text if response and response.output else None, response_throttled(response)
+
+
+def read_reply(reply: Dict):
+    # the (text, throttled) of a reply of `QwenAgent.request`
+    return (reply.get("output") or {}).get("text"), is_throttled(reply.get("status_code"), reply.get("code"))
 
 
 @register_tool("qwen")
@@ -11,7 +39,7 @@ class QwenAgent(object):
 
     def __init__(self,
                  config: Dict):
-        
+        config = dict(llm_backend_cfg("qwen"), **config)
         self.system_prompt = config.get("system_prompt")
         track_history = config.get("track_history", False)
         if self.system_prompt is None:
@@ -21,7 +49,66 @@ class QwenAgent(object):
                 {"role": "system", "content": self.system_prompt}
             ]
         self.track_history = track_history
-    
+        # identical requests of earlier runs are answered from the cache
+        self.cache = LLMResponseCache.from_config(config.get("cache"))
+        # requests of all processes share the provider's rate limit
+        self.limiter = RateLimiter.from_config(config.get("rate_limit"))
+        # older turns of a tracked conversation are trimmed (or summarized) to fit the context window
+        self.budget = ContextBudget(**(config.get("context") or {}))
+        self.summary = None
+        self.tokens_sent = 0
+
+    def report_tokens(self, messages, model_name: str, usage):
+        # tokens sent per request: the count of the provider if it reports one, else the estimate
+        estimated = self.budget.count(messages)
+        input_tokens, output_tokens = usage_tokens(usage)
+        self.budget.observe(messages, input_tokens)
+        self.tokens_sent += input_tokens or estimated
+        emit("llm_tokens", model=model_name, estimated=estimated, input_tokens=input_tokens,
+             output_tokens=output_tokens)
+
+    def summary_messages(self, dropped):
+        return [
+            {"role": "system", "content": history_summary_system},
+            {"role": "user", "content": self.budget.transcript(dropped, self.summary)}
+        ]
+
+    def fit_history(self, model_name: str, max_length: int, max_try: int = 5):
+        # keeps the history (ending with the prompt) within the context budget
+        dropped, kept = self.budget.split(self.history, reserve=max_length)
+        if not dropped:
+            return
+        if self.budget.strategy == "summarize":
+            messages = self.summary_messages(dropped)
+            summary, success = self.retried(messages, model_name, max_try, span_name="qwen summarize").call(
+                lambda: self.send(messages, model_name), read_response)
+            if success:
+                self.summary = summary
+            # else the turns are only trimmed
+        if self.summary is not None:
+            kept = self.budget.with_summary(kept, self.system_prompt, self.summary)
+        self.history = kept
+
+    async def afit_messages(self, messages, model_name: str, max_length: int, max_try: int = 5):
+        dropped, kept = self.budget.split(messages, reserve=max_length)
+        if not dropped:
+            return messages
+        if self.budget.strategy == "summarize":
+            summary_messages = self.summary_messages(dropped)
+
+            async def send():
+                response = await self.request(summary_messages, model_name)
+                self.report_tokens(summary_messages, model_name, response.get("usage"))
+                return response
+
+            summary, success = await self.retried(
+                summary_messages, model_name, max_try, span_name="qwen summarize").acall(send, read_reply)
+            if success:
+                self.summary = summary
+        if self.summary is not None:
+            kept = self.budget.with_summary(kept, self.system_prompt, self.summary)
+        return kept
+
     def basic_success_check(self, response):
         if not response or not response.output or not response.output.text:
             print(response)
@@ -29,6 +116,20 @@ class QwenAgent(object):
         else:
             return True
     
+    def send(self, messages, model_name: str, **parameters):
+        response = Generation.call(
+            model=model_name,
+            messages=messages,
+            api_key=os.environ.get('DASHSCOPE_API_KEY'),
+            **parameters
+        )
+        self.report_tokens(messages, model_name, getattr(response, "usage", None))
+        return response
+
+    def retried(self, messages, model_name: str, max_try: int, span_name: str = "qwen call", **parameters):
+        return RetriedRequest(span_name, model_name, max_try, self.limiter, self.cache,
+                              request=dict(parameters, messages=messages, model_name=model_name))
+
     def call(self,
              prompt: str,
              model_name: str = "qwen2-72b-instruct",
@@ -43,31 +144,16 @@ class QwenAgent(object):
             "role": "user",
             "content": prompt
         })
-        success = False
-        try_times = 0
-        while try_times < max_try:
-            response = Generation.call(
-                model=model_name,
-                messages=self.history,
-                top_p=top_p,
-                temperature=temperature,
-                api_key=os.environ.get('DASHSCOPE_API_KEY'),
-                seed=seed,
-                max_length=max_length
-            )
-            if success_check_fn is None:
-                success_check_fn = lambda x: True
-            if self.basic_success_check(response) and success_check_fn(response.output.text):
-                response = response.output.text
-                self.history.append({
-                    "role": "assistant",
-                    "content": response
-                })
-                success = True
-                break
-            else:
-                try_times += 1
-        
+        self.fit_history(model_name, max_length, max_try)
+        parameters = dict(top_p=top_p, temperature=temperature, seed=seed, max_length=max_length)
+        response, success = self.retried(self.history, model_name, max_try, **parameters).call(
+            lambda: self.send(self.history, model_name, **parameters), read_response, success_check_fn)
+        if success:
+            self.history.append({
+                "role": "assistant",
+                "content": response
+            })
+
         if not self.track_history:
             if self.system_prompt is not None:
                 self.history = self.history[:1]
@@ -75,4 +161,110 @@ class QwenAgent(object):
                 self.history = []
         
         return response, success
+
+    def stream_deltas(self, model_name: str, **parameters):
+        usage = None
+        try:
+            for response in Generation.call(
+                model=model_name,
+                messages=self.history,
+                api_key=os.environ.get('DASHSCOPE_API_KEY'),
+                stream=True,
+                incremental_output=True,
+                **parameters
+            ):
+                if response.status_code != HTTPStatus.OK:
+                    yield response
+                    return
+                usage = getattr(response, "usage", None)
+                yield response.output.text or ""
+        finally:
+            self.report_tokens(self.history, model_name, usage)
+
+    def stream(self,
+               prompt: str,
+               parser: StreamParser,
+               model_name: str = "qwen2-72b-instruct",
+               top_p: float = 0.95,
+               temperature: float = 1.0,
+               seed: int = 1,
+               max_length: int = 1024,
+               max_try: int = 5
+               ):
+        # `call` with the completion streamed through `parser` (see `llm_output_check`), yielding
+        # the elements it completes as they arrive. An attempt whose output goes off-schema is
+        # aborted there and retried; the request succeeded if `parser.done`.
+        self.history.append({
+            "role": "user",
+            "content": prompt
+        })
+        try:
+            self.fit_history(model_name, max_length, max_try)
+            parameters = dict(top_p=top_p, temperature=temperature, seed=seed, max_length=max_length)
+            yield from self.retried(self.history, model_name, max_try, **parameters).stream(
+                lambda: self.stream_deltas(model_name, **parameters), parser, response_throttled)
+            if parser.done:
+                self.history.append({
+                    "role": "assistant",
+                    "content": parser.text
+                })
+        finally:
+            if not self.track_history:
+                if self.system_prompt is not None:
+                    self.history = self.history[:1]
+                else:
+                    self.history = []
+
+    async def request(self, messages, model_name: str, **parameters):
+        session = get_session()
+        try:
+            async with session.post(
+                GENERATION_URL,
+                json={
+                    "model": model_name,
+                    "input": {"messages": messages},
+                    "parameters": dict(parameters, result_format="text"),
+                },
+                headers={"Authorization": f"Bearer {os.environ.get('DASHSCOPE_API_KEY')}"}
+            ) as response:
+                return dict(await response.json(content_type=None), status_code=response.status)
+        except Exception as e:
+            # counted as a failed try, like an error response
+            return {"error": repr(e)}
+
+    async def acall(self,
+                    prompt: str,
+                    model_name: str = "qwen2-72b-instruct",
+                    top_p: float = 0.95,
+                    temperature: float = 1.0,
+                    seed: int = 1,
+                    max_length: int = 1024,
+                    max_try: int = 5,
+                    success_check_fn: Callable = None
+                    ):
+        # `call` on the pooled HTTP client of the running event loop. The history is only read
+        # while the request is in flight, so calls of one agent can be awaited together
+        # (with `track_history`, the exchanges are appended in the order they finish).
+        messages = self.history + [{"role": "user", "content": prompt}]
+        fitted = await self.afit_messages(messages, model_name, max_length, max_try)
+        if fitted is not messages and self.track_history:
+            # the dropped turns are not sent again
+            self.history = fitted[:-1]
+        messages = fitted
+        parameters = dict(top_p=top_p, temperature=temperature, seed=seed, max_length=max_length)
+
+        async def send():
+            response = await self.request(messages, model_name, **parameters)
+            self.report_tokens(messages, model_name, response.get("usage"))
+            return response
+
+        response, success = await self.retried(messages, model_name, max_try, **parameters).acall(
+            send, read_reply, success_check_fn)
+
+        if self.track_history:
+            self.history.append({"role": "user", "content": prompt})
+            if success:
+                self.history.append({"role": "assistant", "content": response})
+
+        return response, success
    
\ No newline at end of file
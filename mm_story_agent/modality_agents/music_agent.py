@@ -3,60 +3,99 @@ import json
 from typing import List, Union, Dict
 
 import soundfile as sf
-import torchaudio
-from transformers import AutoProcessor, MusicgenForConditionalGeneration
 
 from mm_story_agent.prompts_en import story_to_music_reviser_system, story_to_music_reviewer_system
 from mm_story_agent.base import register_tool, init_tool_instance
+from mm_story_agent.utils.asset_cache import AssetCache
+from mm_story_agent.utils.checkpoint import checkpointed
+from mm_story_agent.utils.asset import make_asset_handle
+from mm_story_agent.utils.batching import run_in_batches
+from mm_story_agent.utils.tracing import traced
+from mm_story_agent.utils.asset_bus import AssetPublisher
+from mm_story_agent.utils.memory_budget import reserve_memory
+from mm_story_agent.utils.llm_backend import default_llm
 
 
 class MusicGenSynthesizer:
 
+    @traced("load MusicGenSynthesizer", category="model_load", unit="music_model_load")
     def __init__(self,
                  model_name: str = 'facebook/musicgen-medium',
                  device: str = 'cuda',
                  sample_rate: int = 16000,
                  ) -> None:
+        # transformers and torchaudio are only needed once the model is loaded
+        from transformers import AutoProcessor, MusicgenForConditionalGeneration
+
         self.device = device
         self.processor = AutoProcessor.from_pretrained(model_name)
         self.model = MusicgenForConditionalGeneration.from_pretrained(model_name).to(device)
         self.sample_rate = sample_rate
     
+    @traced("MusicGenSynthesizer.call", category="inference", unit="music_token",
+            attrs=lambda call: {"units": (1 if isinstance(call["prompt"], str) else len(call["prompt"]))
+                                * int(51.2 * call["duration"])})
     def call(self,
              prompt: Union[str, List[str]],
-             save_path: Union[str, Path],
+             save_path: Union[str, Path, List],
              duration: float = 30.0,
              ):
+        # a list of prompts is generated as one batch, one file per prompt
+        if isinstance(prompt, str):
+            prompt, save_path = [prompt], [save_path]
         inputs = self.processor(
-            text=[prompt],
+            text=prompt,
             padding=True,
             return_tensors="pt",
         ).to(self.device)
+        import torchaudio
+
         seq_length = int(51.2 * duration)
-        wav = self.model.generate(**inputs, max_new_tokens=seq_length)[0, 0].cpu()
-        wav = torchaudio.functional.resample(wav, self.model.config.audio_encoder.sampling_rate, self.sample_rate)
-        sf.write(save_path, wav.numpy(), self.sample_rate)
+        wavs = self.model.generate(**inputs, max_new_tokens=seq_length)[:, 0].cpu()
+        for wav, path in zip(wavs, save_path):
+            wav = torchaudio.functional.resample(wav, self.model.config.audio_encoder.sampling_rate, self.sample_rate)
+            sf.write(path, wav.numpy(), self.sample_rate)
 
 
 @register_tool("musicgen_t2m")
 class MusicGenAgent:
 
+    # shares the job queue workers with the sound effects
+    pool = "audio"
+    # estimated peak memory in GB, used by the memory budget (musicgen-medium in fp32)
+    memory_footprint = {"ram": 8, "vram": 8}
+    # the budget is taken when MusicGen is loaded (see `reserve_memory`)
+    reserves_memory = True
+
     def __init__(self, cfg) -> None:
         self.cfg = cfg
+        self.synthesizer = None
+        self.publisher = AssetPublisher(cfg)
+
+    def get_synthesizer(self):
+        # keep the model loaded across calls of a long-lived agent
+        if self.synthesizer is None:
+            reserve_memory()
+            self.synthesizer = MusicGenSynthesizer(
+                model_name=self.cfg.get("model_name", "facebook/musicgen-medium"),
+                device=self.cfg.get("device", "cuda"),
+                sample_rate=self.cfg.get("sample_rate", 16000),
+            )
+        return self.synthesizer
 
     def generate_music_prompt_from_story(
             self,
             pages: List,
         ):
         music_prompt_reviser = init_tool_instance({
-            "tool": self.cfg.get("llm", "qwen"),
+            "tool": self.cfg.get("llm", default_llm()),
             "cfg": {
                 "system_prompt": story_to_music_reviser_system,
                 "track_history": False
             }
         })
         music_prompt_reviewer = init_tool_instance({
-            "tool": self.cfg.get("llm", "qwen"),
+            "tool": self.cfg.get("llm", default_llm()),
             "cfg": {
                 "system_prompt": story_to_music_reviewer_system,
                 "track_history": False
@@ -81,20 +120,81 @@ class MusicGenAgent:
         return music_prompt
 
     def call(self, params: Dict):
+        result = self.call_batch([params])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def call_batch(self, params_list: List[Dict]):
+        # the music of several stories (e.g., from a batch worker) is generated in shared
+        # batches of at most `batch_size` prompts. Returns the result of each story,
+        # or the exception that story failed with.
+        stories = []
+        for params in params_list:
+            try:
+                stories.append(self.prepare_request(params))
+            except Exception as e:
+                stories.append(e)
+        requests = [story for story in stories if isinstance(story, dict) and not story["done"]]
+        run_in_batches(requests, self.cfg.get("batch_size"), self.generate_music)
+        results = []
+        for story in stories:
+            if isinstance(story, Exception):
+                results.append(story)
+            elif "error" in story:
+                results.append(RuntimeError(f"Music generation failed: {story['error']}"))
+            else:
+                results.append({
+                    "prompt": story["prompt"],
+                    "assets": [make_asset_handle(story["save_path"])],
+                })
+        return results
+
+    def prepare_request(self, params: Dict):
         pages: List = params["pages"]
-        save_path: str = params["save_path"]
-        save_path = Path(save_path)
-        music_prompt = self.generate_music_prompt_from_story(pages)
-        generation_agent = MusicGenSynthesizer(
-            model_name=self.cfg.get("model_name", "facebook/musicgen-medium"),
-            device=self.cfg.get("device", "cuda"),
-            sample_rate=self.cfg.get("sample_rate", 16000),
-        )
+        save_path = Path(params["save_path"])
+        checkpoint = params.get("checkpoint")
+        music_prompt = checkpointed(checkpoint, "music_prompt", {"pages": pages},
+                                    lambda: self.generate_music_prompt_from_story(pages))
+        generation_inputs = {
+            "tool": "musicgen_t2m",
+            "model": self.cfg.get("model_name", "facebook/musicgen-medium"),
+            "prompt": music_prompt,
+            "duration": params.get("duration", 30.0),
+            "sample_rate": self.cfg.get("sample_rate", 16000),
+        }
+        music_file = save_path / "music.wav"
+        request = {
+            "prompt": music_prompt,
+            "save_path": music_file,
+            "generation_params": {"duration": generation_inputs["duration"]},
+            "generation_inputs": generation_inputs,
+            "cache": AssetCache.from_config(self.cfg.get("cache")),
+            "cache_key": None,
+            "checkpoint": checkpoint,
+            "done": False,
+        }
+        if checkpoint is not None and checkpoint.load("music", generation_inputs, [music_file])[0]:
+            request["done"] = True
+        elif request["cache"] is not None:
+            request["cache_key"] = request["cache"].make_key(**generation_inputs)
+            if request["cache"].load(request["cache_key"], music_file):
+                request["done"] = True
+                if checkpoint is not None:
+                    checkpoint.save("music", generation_inputs, str(music_file))
+        return request
+
+    def generate_music(self, requests: List[Dict]):
+        generation_agent = self.get_synthesizer()
         generation_agent.call(
-            prompt=music_prompt,
-            save_path=save_path / "music.wav",
-            duration=params.get("duration", 30.0),
+            prompt=[request["prompt"] for request in requests],
+            save_path=[request["save_path"] for request in requests],
+            duration=requests[0]["generation_params"]["duration"],
         )
-        return {
-            "prompt": music_prompt,
-        }
\ No newline at end of file
+        # each file goes back to the story it belongs to
+        for request in requests:
+            self.publisher.publish_audio_file(request["save_path"])
+            if request["cache"] is not None:
+                request["cache"].save(request["cache_key"], request["save_path"])
+            if request["checkpoint"] is not None:
+                request["checkpoint"].save("music", request["generation_inputs"], str(request["save_path"]))
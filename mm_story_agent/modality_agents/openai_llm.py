@@ -0,0 +1,398 @@
+import os
+import re
+import json
+import time
+import uuid
+import urllib.error
+import urllib.request
+from typing import Callable, Dict, List
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from mm_story_agent.base import register_tool
+from mm_story_agent.utils.async_llm import get_session
+from mm_story_agent.utils.llm_cache import LLMResponseCache
+from mm_story_agent.utils.llm_backend import llm_backend_cfg
+from mm_story_agent.utils.llm_output_check import StreamParser
+from mm_story_agent.utils.llm_retry import RetriedRequest, load_cached
+from mm_story_agent.utils.rate_limit import RateLimiter, is_throttled
+
+# ChatML (the chat format of Qwen models), to send conversations to the completions endpoint
+MESSAGE_TEMPLATE = "<|im_start|>{role}\n{content}<|im_end|>\n"
+GENERATION_PROMPT = "<|im_start|>assistant\n"
+STOP = ["<|im_end|>"]
+
+
+def reply_text(reply: Dict):
+    try:
+        return reply["choices"][0]["message"]["content"]
+    except (KeyError, IndexError, TypeError):
+        return None
+
+
+def read_reply(reply: Dict):
+    return reply_text(reply), reply_throttled(reply)
+
+
+def reply_throttled(reply: Dict):
+    error = reply.get("error")
+    return is_throttled(reply.get("status_code"), error.get("code") if isinstance(error, dict) else None)
+
+
+@register_tool("openai_compatible")
+class OpenAICompatibleAgent:
+    """
+    LLM tool for servers with the OpenAI chat completions API (vLLM, SGLang, TGI, public APIs,
+    `OpenAIStandInServer`), with the interface of `QwenAgent`. Its cfg is merged over the `cfg`
+    of the `llm` block of the pipeline config: `base_url`, `model`, `api_key_env` (the variable
+    holding the key), `timeout`, and `cache` / `rate_limit` like `QwenAgent`.
+
+    `call_batch` sends many independent prompts in one request to the completions endpoint,
+    which servers with continuous batching answer together; the conversations are rendered with
+    `message_template` / `generation_prompt` (ChatML by default).
+    """
+
+    def __init__(self,
+                 config: Dict):
+        config = dict(llm_backend_cfg("openai_compatible"), **config)
+        self.system_prompt = config.get("system_prompt")
+        if self.system_prompt is None:
+            self.history = []
+        else:
+            self.history = [
+                {"role": "system", "content": self.system_prompt}
+            ]
+        self.track_history = config.get("track_history", False)
+        self.base_url = config.get("base_url", "http://localhost:8000/v1").rstrip("/")
+        self.model = config.get("model", "qwen2-72b-instruct")
+        self.api_key = os.environ.get(config.get("api_key_env", "OPENAI_API_KEY"), "EMPTY")
+        self.timeout = config.get("timeout", 300)
+        self.message_template = config.get("message_template", MESSAGE_TEMPLATE)
+        self.generation_prompt = config.get("generation_prompt", GENERATION_PROMPT)
+        self.stop = config.get("stop", STOP)
+        self.cache = LLMResponseCache.from_config(config.get("cache"))
+        self.limiter = RateLimiter.from_config(config.get("rate_limit"))
+
+    def make_request(self, path: str, body: Dict):
+        return urllib.request.Request(
+            self.base_url + path,
+            data=json.dumps(body, ensure_ascii=False).encode("utf-8"),
+            headers={"Content-Type": "application/json", "Authorization": f"Bearer {self.api_key}"}
+        )
+
+    def post(self, path: str, body: Dict):
+        # errors are returned as {"error": ...}, like `QwenAgent.request`
+        try:
+            with urllib.request.urlopen(self.make_request(path, body), timeout=self.timeout) as response:
+                return dict(json.loads(response.read()), status_code=response.status)
+        except urllib.error.HTTPError as e:
+            return {"error": e.read().decode("utf-8", "replace"), "status_code": e.code}
+        except Exception as e:
+            return {"error": repr(e)}
+
+    async def apost(self, path: str, body: Dict):
+        session = get_session()
+        try:
+            async with session.post(
+                self.base_url + path,
+                json=body,
+                headers={"Authorization": f"Bearer {self.api_key}"}
+            ) as response:
+                return dict(await response.json(content_type=None), status_code=response.status)
+        except Exception as e:
+            return {"error": repr(e)}
+
+    def post_stream(self, path: str, body: Dict):
+        # the chunks of a streamed completion (server-sent events), or one error reply
+        try:
+            response = urllib.request.urlopen(self.make_request(path, dict(body, stream=True)), timeout=self.timeout)
+        except urllib.error.HTTPError as e:
+            yield {"error": e.read().decode("utf-8", "replace"), "status_code": e.code}
+            return
+        except Exception as e:
+            yield {"error": repr(e)}
+            return
+        with response:
+            for line in response:
+                line = line.decode("utf-8").strip()
+                if not line.startswith("data:"):
+                    continue
+                data = line[len("data:"):].strip()
+                if data == "[DONE]":
+                    return
+                try:
+                    chunk = json.loads(data)
+                except json.JSONDecodeError as e:
+                    # a garbled event fails the attempt, like an error reply
+                    yield {"error": f"invalid event {data!r}: {e}"}
+                    return
+                yield chunk
+
+    def chat_body(self, messages, model_name, top_p, temperature, seed, max_length):
+        return {
+            "model": model_name or self.model,
+            "messages": messages,
+            "top_p": top_p,
+            "temperature": temperature,
+            "seed": seed,
+            "max_tokens": max_length,
+        }
+
+    def end_call(self, prompt: str, response, success: bool):
+        if self.track_history:
+            self.history.append({"role": "user", "content": prompt})
+            if success:
+                self.history.append({"role": "assistant", "content": response})
+
+    def retried(self, body: Dict, max_try: int):
+        return RetriedRequest("openai call", body["model"], max_try, self.limiter, self.cache,
+                              request=dict(body, base_url=self.base_url))
+
+    def call(self,
+             prompt: str,
+             model_name: str = None,
+             top_p: float = 0.95,
+             temperature: float = 1.0,
+             seed: int = 1,
+             max_length: int = 1024,
+             max_try: int = 5,
+             success_check_fn: Callable = None
+             ):
+        body = self.chat_body(self.history + [{"role": "user", "content": prompt}],
+                              model_name, top_p, temperature, seed, max_length)
+        retry = self.retried(body, max_try)
+        response, success = retry.call(lambda: self.post("/chat/completions", body), read_reply, success_check_fn)
+        self.end_call(prompt, response, success)
+        return response, success
+
+    async def acall(self,
+                    prompt: str,
+                    model_name: str = None,
+                    top_p: float = 0.95,
+                    temperature: float = 1.0,
+                    seed: int = 1,
+                    max_length: int = 1024,
+                    max_try: int = 5,
+                    success_check_fn: Callable = None
+                    ):
+        # `call` on the pooled HTTP client of the running event loop, see `QwenAgent.acall`
+        body = self.chat_body(self.history + [{"role": "user", "content": prompt}],
+                              model_name, top_p, temperature, seed, max_length)
+        retry = self.retried(body, max_try)
+        response, success = await retry.acall(lambda: self.apost("/chat/completions", body), read_reply,
+                                              success_check_fn)
+        self.end_call(prompt, response, success)
+        return response, success
+
+    def stream_deltas(self, body: Dict):
+        for chunk in self.post_stream("/chat/completions", body):
+            if "error" in chunk:
+                yield chunk
+                return
+            delta = (chunk.get("choices") or [{}])[0].get("delta") or {}
+            yield delta.get("content") or ""
+
+    def stream(self,
+               prompt: str,
+               parser: StreamParser,
+               model_name: str = None,
+               top_p: float = 0.95,
+               temperature: float = 1.0,
+               seed: int = 1,
+               max_length: int = 1024,
+               max_try: int = 5
+               ):
+        # see `QwenAgent.stream`
+        body = self.chat_body(self.history + [{"role": "user", "content": prompt}],
+                              model_name, top_p, temperature, seed, max_length)
+        retry = self.retried(body, max_try)
+        yield from retry.stream(lambda: self.stream_deltas(body), parser, reply_throttled)
+        self.end_call(prompt, parser.text, parser.done)
+
+    def render(self, messages: List[Dict]):
+        return "".join(self.message_template.format(**message) for message in messages) + self.generation_prompt
+
+    def call_batch(self,
+                   prompts: List[str],
+                   model_name: str = None,
+                   top_p: float = 0.95,
+                   temperature: float = 1.0,
+                   seed: int = 1,
+                   max_length: int = 1024,
+                   max_try: int = 5,
+                   success_check_fn: Callable = None
+                   ):
+        # [(response, success)] of independent prompts (the history is not extended), sent in one
+        # request; only the prompts whose responses fail are sent again
+        if success_check_fn is None:
+            success_check_fn = lambda x: True
+        model_name = model_name or self.model
+        conversations = [self.history + [{"role": "user", "content": prompt}] for prompt in prompts]
+        responses = [None] * len(prompts)
+        cache_keys = [None] * len(prompts)
+        for idx, messages in enumerate(conversations):
+            cache_keys[idx], responses[idx] = load_cached(
+                self.cache, success_check_fn, base_url=self.base_url, **self.chat_body(
+                    messages, model_name, top_p, temperature, seed, max_length))
+        pending = [idx for idx, response in enumerate(responses) if response is None]
+        # the prompts are cached one by one, the attempts are those of one request
+        retry = RetriedRequest("openai batch call", model_name, max_try, self.limiter)
+        for attempt in range(max_try):
+            if not pending:
+                break
+            with retry.slot() as outcome:
+                with retry.span(attempt, units=len(pending)):
+                    reply = self.post("/completions", {
+                        "model": model_name,
+                        "prompt": [self.render(conversations[idx]) for idx in pending],
+                        "top_p": top_p,
+                        "temperature": temperature,
+                        "seed": seed,
+                        "max_tokens": max_length,
+                        "stop": self.stop,
+                    })
+                throttled = reply_throttled(reply)
+                outcome["throttled"] = throttled
+            texts = {choice.get("index"): choice.get("text") for choice in reply.get("choices") or []}
+            failed = []
+            for position, idx in enumerate(pending):
+                text = texts.get(position)
+                if text and success_check_fn(text):
+                    responses[idx] = text
+                    if cache_keys[idx] is not None:
+                        self.cache.save(cache_keys[idx], text)
+                else:
+                    failed.append(idx)
+            pending = failed
+            if pending:
+                time.sleep(retry.failed(attempt, throttled, None if texts else reply))
+        return [(response, response is not None) for response in responses]
+
+
+class OpenAIStandInServer:
+    """
+    Local stand-in of an OpenAI-compatible LLM server, for runs without network access: answers
+    with the canned answers of `StubLLMAgent` (its `latency` / `pages_per_chapter` from `cfg`).
+    Serves `/v1/chat/completions` (also streamed), `/v1/completions` with a list of ChatML
+    prompts, and `/v1/models`. Like a server with continuous batching, a request takes one
+    latency whatever the number of its prompts.
+    """
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 8000,
+                 cfg: Dict = None) -> None:
+        self.host = host
+        self.port = port
+        self.cfg = cfg or {}
+
+    def answer(self, messages: List[Dict], wait: bool = True):
+        # the stub LLM for the system prompt of the conversation, imported here so that the
+        # client does not import the stubs
+        from mm_story_agent.modality_agents.stub_llm import StubLLMAgent
+
+        system_prompt = next((message["content"] for message in messages if message["role"] == "system"), None)
+        llm = StubLLMAgent(dict(self.cfg, system_prompt=system_prompt))
+        if wait:
+            time.sleep(llm.latency)
+        return llm.answer(messages[-1]["content"]), llm.latency
+
+    def chat_completion(self, request: Dict):
+        text, _ = self.answer(request["messages"])
+        return {
+            "id": f"chatcmpl-{uuid.uuid4().hex}",
+            "object": "chat.completion",
+            "created": int(time.time()),
+            "model": request.get("model"),
+            "choices": [{"index": 0, "message": {"role": "assistant", "content": text}, "finish_reason": "stop"}],
+        }
+
+    def stream_chat_completion(self, request: Dict):
+        text, latency = self.answer(request["messages"], wait=False)
+        chunks = [text[idx:idx + 16] for idx in range(0, len(text), 16)]
+        for chunk in chunks:
+            time.sleep(latency / len(chunks))
+            yield {
+                "object": "chat.completion.chunk",
+                "model": request.get("model"),
+                "choices": [{"index": 0, "delta": {"content": chunk}, "finish_reason": None}],
+            }
+
+    def completion(self, request: Dict):
+        prompts = request["prompt"]
+        if isinstance(prompts, str):
+            prompts = [prompts]
+        texts = []
+        latency = 0.0
+        for prompt in prompts:
+            messages = [
+                {"role": role, "content": content}
+                for role, content in re.findall(r"<\|im_start\|>(\w+)\n(.*?)<\|im_end\|>", prompt, re.S)
+            ]
+            text, latency = self.answer(messages, wait=False)
+            texts.append(text)
+        time.sleep(latency)
+        return {
+            "id": f"cmpl-{uuid.uuid4().hex}",
+            "object": "text_completion",
+            "created": int(time.time()),
+            "model": request.get("model"),
+            "choices": [{"index": idx, "text": text, "finish_reason": "stop"} for idx, text in enumerate(texts)],
+        }
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def reply(self, code, body):
+                content = json.dumps(body, ensure_ascii=False).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def reply_stream(self, chunks):
+                self.send_response(200)
+                self.send_header("Content-Type", "text/event-stream")
+                self.end_headers()
+                for chunk in chunks:
+                    self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+                    self.wfile.flush()
+                self.wfile.write(b"data: [DONE]\n\n")
+
+            def do_POST(self):
+                try:
+                    request = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                    if self.path == "/v1/chat/completions" and request.get("stream"):
+                        self.reply_stream(server.stream_chat_completion(request))
+                    elif self.path == "/v1/chat/completions":
+                        self.reply(200, server.chat_completion(request))
+                    elif self.path == "/v1/completions":
+                        self.reply(200, server.completion(request))
+                    else:
+                        self.reply(404, {"error": {"message": f"unknown path {self.path}"}})
+                except (BrokenPipeError, ConnectionResetError):
+                    # the client aborted a stream
+                    pass
+                except Exception as e:
+                    self.reply(400, {"error": {"message": repr(e)}})
+
+            def do_GET(self):
+                if self.path == "/v1/models":
+                    self.reply(200, {"object": "list", "data": [{"id": "stub", "object": "model"}]})
+                else:
+                    self.reply(404, {"error": {"message": f"unknown path {self.path}"}})
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
+
+    def serve(self):
+        httpd = ThreadingHTTPServer((self.host, self.port), self.make_handler())
+        print(f"Serving an OpenAI-compatible stand-in LLM on http://{self.host}:{self.port}/v1")
+        try:
+            httpd.serve_forever()
+        finally:
+            httpd.server_close()
@@ -0,0 +1,207 @@
+import os
+import hmac
+import json
+import time
+import socket
+import ipaddress
+import struct
+import shutil
+import tempfile
+import threading
+import traceback
+import socketserver
+from pathlib import Path
+from typing import Dict, List
+
+from mm_story_agent.base import register_tool, init_tool_instance
+from mm_story_agent.utils.page_stream import all_pages
+from mm_story_agent.utils.tracing import span
+
+# A message is an 8-byte length, a json header, and the files listed in `header["files"]`
+# ({"name": relative path, "size": bytes}) sent raw one after another.
+CHUNK_SIZE = 1 << 20
+# shared secret of the tool server and its clients, unless given in their configuration
+TOOL_TOKEN_ENV = "MM_STORY_AGENT_TOOL_TOKEN"
+
+
+def is_loopback(host: str):
+    if host == "localhost":
+        return True
+    try:
+        return ipaddress.ip_address(host).is_loopback
+    except ValueError:
+        return False
+
+
+def send_message(sock: socket.socket, header: Dict, file_dir: Path = None, files: List[Path] = ()):
+    header = dict(header, files=[
+        {"name": str(Path(path).relative_to(file_dir)), "size": Path(path).stat().st_size} for path in files
+    ])
+    data = json.dumps(header, ensure_ascii=False, default=str).encode("utf-8")
+    sock.sendall(struct.pack("!Q", len(data)) + data)
+    for path in files:
+        with open(path, "rb") as reader:
+            sock.sendfile(reader)
+
+
+def recv_exact(reader, size: int):
+    data = reader.read(size)
+    if len(data) < size:
+        raise ConnectionError("connection closed in the middle of a message")
+    return data
+
+
+def recv_message(reader, file_dir: Path = None):
+    # files are written under `file_dir`
+    size, = struct.unpack("!Q", recv_exact(reader, 8))
+    header = json.loads(recv_exact(reader, size))
+    for file in header["files"]:
+        path = (file_dir / file["name"]).resolve()
+        if file_dir.resolve() not in path.parents:
+            raise ValueError(f"file {file['name']} is outside of {file_dir}")
+        path.parent.mkdir(exist_ok=True, parents=True)
+        remaining = file["size"]
+        with open(path, "wb") as writer:
+            while remaining > 0:
+                chunk = reader.read(min(CHUNK_SIZE, remaining))
+                if not chunk:
+                    raise ConnectionError("connection closed in the middle of a file")
+                writer.write(chunk)
+                remaining -= len(chunk)
+    return header
+
+
+def replace_paths(value, old: str, new: str):
+    # asset handles returned by the agents point into the save directory of the remote worker
+    if isinstance(value, str):
+        return value.replace(old, new)
+    if isinstance(value, list):
+        return [replace_paths(item, old, new) for item in value]
+    if isinstance(value, dict):
+        return {key: replace_paths(item, old, new) for key, item in value.items()}
+    return value
+
+
+@register_tool("remote")
+class RemoteToolAgent:
+    """
+    Runs another tool on a `RemoteToolServer`, e.g. image or audio generation on a GPU host:
+
+        image_generation:
+            tool: remote
+            cfg:
+                address: gpu-host:9100
+                tool: story_diffusion_t2i
+                cfg: {...}
+                token: ...      # optional, by default from MM_STORY_AGENT_TOOL_TOKEN
+
+    The params are sent as json (the per-page checkpoints of the agent stay on the remote side,
+    the stage is still checkpointed here), the files the tool saves are streamed back into
+    `save_path`, and the paths in its result are rewritten to the local files.
+    """
+
+    # nothing is loaded in this process
+    memory_footprint = {}
+
+    def __init__(self, cfg: Dict) -> None:
+        self.cfg = cfg
+        host, port = cfg["address"].rsplit(":", 1)
+        self.address = (host, int(port))
+        self.timeout = cfg.get("timeout")
+        self.tool_cfg = {"tool": cfg["tool"], "cfg": cfg.get("cfg") or {}}
+        self.token = cfg.get("token") or os.environ.get(TOOL_TOKEN_ENV)
+
+    def call(self, params: Dict):
+        params = {key: value for key, value in params.items() if key != "checkpoint"}
+        if "pages" in params:
+            params["pages"] = all_pages(params["pages"])
+        save_path = Path(params["save_path"]) if "save_path" in params else None
+        with span(f"remote call {self.tool_cfg['tool']}", category="rpc", address=self.cfg["address"]):
+            with socket.create_connection(self.address, timeout=self.timeout) as sock:
+                send_message(sock, {"tool_cfg": self.tool_cfg, "params": params, "token": self.token})
+                with sock.makefile("rb") as reader:
+                    header = recv_message(reader, save_path)
+        if "error" in header:
+            raise RuntimeError(f"Remote tool {self.tool_cfg['tool']} at {self.cfg['address']} failed: {header['error']}")
+        result = header["result"]
+        if save_path is not None:
+            result = replace_paths(result, header["save_path"], str(save_path))
+        return result
+
+
+class RemoteToolServer:
+    """
+    Serves `RemoteToolAgent` requests over TCP. Each tool config gets one warm instance, so its
+    models are loaded once; requests for the same tool run one at a time, different tools in
+    parallel. `tools` restricts which registered tools may be run; with a `token`, only requests
+    carrying the same token are served. The server binds the loopback interface by default, and
+    binding another address requires `tools` or a token.
+    """
+
+    def __init__(self,
+                 host: str = "127.0.0.1",
+                 port: int = 9100,
+                 tools: List[str] = None,
+                 token: str = None) -> None:
+        self.address = (host, port)
+        self.tools = tools
+        self.token = token or os.environ.get(TOOL_TOKEN_ENV)
+        if not is_loopback(host) and self.tools is None and self.token is None:
+            raise ValueError(f"Serving every registered tool on {host} would let any host run them, "
+                             f"pass the served tools or set {TOOL_TOKEN_ENV}")
+        self.agents = {}
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    def get_lock(self, tool_cfg: Dict):
+        key = json.dumps(tool_cfg, sort_keys=True)
+        with self.lock:
+            if key not in self.locks:
+                self.locks[key] = threading.Lock()
+        return key, self.locks[key]
+
+    def handle(self, sock: socket.socket):
+        with sock.makefile("rb") as reader:
+            request = recv_message(reader)
+        tool_cfg = request["tool_cfg"]
+        save_path = Path(tempfile.mkdtemp(prefix="remote_tool_"))
+        try:
+            if self.token is not None and not hmac.compare_digest(str(request.get("token")), self.token):
+                raise PermissionError("invalid token")
+            if self.tools is not None and tool_cfg["tool"] not in self.tools:
+                raise ValueError(f"tool {tool_cfg['tool']} is not served here")
+            params = request["params"]
+            if "save_path" in params:
+                params["save_path"] = save_path
+            key, lock = self.get_lock(tool_cfg)
+            with lock:
+                if key not in self.agents:
+                    self.agents[key] = init_tool_instance(tool_cfg)
+                start = time.time()
+                result = self.agents[key].call(params)
+            print(f"{tool_cfg['tool']} done in {time.time() - start:.1f} s")
+            files = sorted(path for path in save_path.rglob("*") if path.is_file())
+            send_message(sock, {"result": result, "save_path": str(save_path)}, save_path, files)
+        except Exception:
+            send_message(sock, {"error": traceback.format_exc()})
+        finally:
+            shutil.rmtree(save_path, ignore_errors=True)
+
+    def serve(self):
+        server = self
+
+        class Handler(socketserver.BaseRequestHandler):
+
+            def handle(self):
+                server.handle(self.request)
+
+        class TCPServer(socketserver.ThreadingTCPServer):
+            allow_reuse_address = True
+            daemon_threads = True
+
+        with TCPServer(self.address, Handler) as tcp_server:
+            print(f"Serving tools on {self.address[0]}:{self.address[1]}")
+            try:
+                tcp_server.serve_forever()
+            except KeyboardInterrupt:
+                pass
@@ -1,26 +1,45 @@
 from pathlib import Path
 from typing import List, Dict
 import json
+import zlib
+import functools
 
 import torch
 import soundfile as sf
-from diffusers import AudioLDM2Pipeline
 
 from mm_story_agent.prompts_en import story_to_sound_reviser_system, story_to_sound_review_system
 from mm_story_agent.base import register_tool, init_tool_instance
+from mm_story_agent.utils.page_stream import all_pages
+from mm_story_agent.utils.asset_cache import AssetCache
+from mm_story_agent.utils.checkpoint import acheckpointed
+from mm_story_agent.utils.asset import make_asset_handle
+from mm_story_agent.utils.batching import run_in_batches
+from mm_story_agent.utils.tracing import traced
+from mm_story_agent.utils.progress import PageProgress
+from mm_story_agent.utils.asset_bus import AssetPublisher
+from mm_story_agent.utils.speculation import SpeculativeQueue
+from mm_story_agent.utils.memory_budget import reserve_memory
+from mm_story_agent.utils.async_llm import acall_llm, run_concurrently, run_streamed
+from mm_story_agent.utils.llm_backend import default_llm
+from mm_story_agent.utils.batch_review import BatchedReview, batch_system_prompts, map_chunks
 
 
 class AudioLDM2Synthesizer:
 
+    @traced("load AudioLDM2Synthesizer", category="model_load", unit="sound_model_load")
     def __init__(self,
                  device: str = 'cuda',
                  ) -> None:
+        from diffusers import AudioLDM2Pipeline
+
         self.device = device
         self.pipe = AudioLDM2Pipeline.from_pretrained(
             "cvssp/audioldm2",
             torch_dtype=torch.float16
         ).to(self.device)
     
+    @traced("AudioLDM2Synthesizer.call", category="inference", unit="sound_step",
+            attrs=lambda call: {"units": len(call["prompts"]) * call["n_candidate_per_text"] * call["ddim_steps"]})
     def call(
         self,
         prompts: List[str],
@@ -29,13 +48,19 @@ class AudioLDM2Synthesizer:
         guidance_scale: float = 3.5,
         ddim_steps: int = 100,
     ):
-        generator = torch.Generator(device=self.device).manual_seed(seed)
+        # one generator per waveform, seeded from the prompt, so that the sound of a page
+        # does not depend on the other prompts of its batch
+        generators = [
+            torch.Generator(device=self.device).manual_seed(
+                zlib.crc32(f"{seed}:{candidate}:{prompt}".encode("utf-8")))
+            for prompt in prompts for candidate in range(n_candidate_per_text)
+        ]
         audios = self.pipe(
             prompts, 
             num_inference_steps=ddim_steps, 
             audio_length_in_s=10.0,
             guidance_scale=guidance_scale,
-            generator=generator,
+            generator=generators,
             num_waveforms_per_prompt=n_candidate_per_text).audios
         
         audios = audios[::n_candidate_per_text]
@@ -46,49 +71,208 @@ class AudioLDM2Synthesizer:
 @register_tool("audioldm2_t2a")
 class AudioLDM2Agent:
 
+    stream_pages = True
+    pool = "audio"
+    # estimated peak memory in GB, used by the memory budget
+    memory_footprint = {"ram": 4, "vram": 6}
+    # reserved by `get_synthesizer`, so the footprint is not held while sound prompts are revised
+    reserves_memory = True
+
     def __init__(self, cfg) -> None:
         self.cfg = cfg
+        self.synthesizer = None
+        self.publisher = AssetPublisher(cfg)
+
+    def get_synthesizer(self):
+        # keep the pipeline loaded across calls of a long-lived agent
+        if self.synthesizer is None:
+            reserve_memory()
+            self.synthesizer = AudioLDM2Synthesizer(device=self.cfg.get("device", "cuda"))
+        return self.synthesizer
 
     def call(self, params: Dict):
+        result = self.call_batch([params])[0]
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    def call_batch(self, params_list: List[Dict]):
+        # pages of several stories (e.g., from a batch worker) are generated in shared
+        # batches of at most `batch_size` prompts. Returns the result of each story,
+        # or the exception that story failed with.
+        stories = []
+        requests = []
+        speculation = None
+        if self.cfg.get("speculative", False):
+            # sounds are generated from the drafts while their prompts are being reviewed
+            speculation = SpeculativeQueue(self.synthesize_sounds, self.cfg.get("batch_size"))
+        try:
+            for params in params_list:
+                try:
+                    story = self.prepare_requests(params, speculation)
+                except Exception as e:
+                    stories.append(e)
+                    continue
+                stories.append(story)
+                requests.extend(story["requests"])
+            self.progress = PageProgress("sounds", total=len(requests))
+            if speculation is not None:
+                requests = self.keep_speculative_sounds(requests, speculation)
+        finally:
+            if speculation is not None:
+                speculation.close()
+        run_in_batches(requests, self.cfg.get("batch_size"), self.generate_sounds)
+        results = []
+        for story in stories:
+            if isinstance(story, Exception):
+                results.append(story)
+                continue
+            errors = [request["error"] for request in story["requests"] if "error" in request]
+            if errors:
+                results.append(RuntimeError(f"Sound generation failed: {errors[0]}"))
+                continue
+            sound_prompts = story["prompts"]
+            results.append({
+                "prompts": sound_prompts,
+                # pages without sounds have no asset
+                "assets": [
+                    make_asset_handle(sound_file) if sound_prompts[idx] != "No sounds." else None
+                    for idx, sound_file in enumerate(story["sound_files"])
+                ],
+            })
+        return results
+
+    def prepare_requests(self, params: Dict, speculation: SpeculativeQueue = None):
+        # prompts of a story, and the pages still to be generated (neither checkpointed nor cached)
         pages: List = params["pages"]
-        save_path: str = params["save_path"]
-        sound_prompts = self.generate_sound_prompt_from_story(pages,)
-        save_paths = []
-        forward_prompts = []
-        save_path = Path(save_path)
+        save_path = Path(params["save_path"])
+        checkpoint = params.get("checkpoint")
+        page_offset = params.get("page_offset", 0)
+        generation_params = {
+            "n_candidate_per_text": params.get("n_candidate_per_text", 3),
+            "seed": params.get("seed", 0),
+            "guidance_scale": params.get("guidance_scale", 3.5),
+            "ddim_steps": params.get("ddim_steps", 100),
+        }
+        drafts = {}
+
+        def on_draft(page_idx, sound_prompt):
+            # the previous draft of the page was revised
+            if page_idx in drafts:
+                speculation.discard(drafts.pop(page_idx))
+            if sound_prompt != "No sounds.":
+                drafts[page_idx] = f"{save_path / f'p{page_idx + 1}.wav'}:{sound_prompt}"
+                speculation.submit({
+                    "key": drafts[page_idx],
+                    "prompt": sound_prompt,
+                    "generation_params": generation_params,
+                })
+
+        sound_prompts = self.generate_sound_prompt_from_story(
+            pages, checkpoint, page_offset, on_draft if speculation is not None else None)
+        pages = all_pages(pages)
+        cache = AssetCache.from_config(self.cfg.get("cache"))
+        requests = []
         for idx in range(len(pages)):
             if sound_prompts[idx] != "No sounds.":
-                save_paths.append(save_path / f"p{idx + 1}.wav")
-                forward_prompts.append(sound_prompts[idx])
-        
-        generation_agent = AudioLDM2Synthesizer(device=self.cfg.get("device", "cuda"))
-        if len(forward_prompts) > 0:
-            sounds = generation_agent.call(
-                forward_prompts,
-                n_candidate_per_text=params.get("n_candidate_per_text", 3),
-                seed=params.get("seed", 0),
-                guidance_scale=params.get("guidance_scale", 3.5),
-                ddim_steps=params.get("ddim_steps", 100),
-            )
-            for sound, path in zip(sounds, save_paths):
-                sf.write(path.__str__(), sound, self.cfg["sample_rate"])
+                page_save_path = save_path / f"p{idx + 1 + page_offset}.wav"
+                page_inputs = {
+                    "tool": "audioldm2_t2a",
+                    "model": "cvssp/audioldm2",
+                    "prompt": sound_prompts[idx],
+                    "sample_rate": self.cfg["sample_rate"],
+                    **generation_params
+                }
+                # the last draft of a page is its final prompt
+                speculation_key = drafts.pop(idx + page_offset, None)
+                if checkpoint is not None and \
+                        checkpoint.load(page_save_path.stem, page_inputs, [page_save_path])[0]:
+                    if speculation_key is not None:
+                        speculation.discard(speculation_key)
+                    continue
+                cache_key = None
+                if cache is not None:
+                    cache_key = cache.make_key(**page_inputs)
+                    if cache.load(cache_key, page_save_path):
+                        if checkpoint is not None:
+                            checkpoint.save(page_save_path.stem, page_inputs, str(page_save_path))
+                        if speculation_key is not None:
+                            speculation.discard(speculation_key)
+                        continue
+                requests.append({
+                    "page": idx + 1 + page_offset,
+                    "prompt": sound_prompts[idx],
+                    "save_path": page_save_path,
+                    "generation_params": generation_params,
+                    "page_inputs": page_inputs,
+                    "cache": cache,
+                    "cache_key": cache_key,
+                    "checkpoint": checkpoint,
+                    "speculation_key": speculation_key,
+                })
         return {
             "prompts": sound_prompts,
+            "sound_files": [save_path / f"p{idx + 1 + page_offset}.wav" for idx in range(len(pages))],
+            "requests": requests,
         }
 
+    def synthesize_sounds(self, requests: List[Dict]):
+        generation_agent = self.get_synthesizer()
+        sounds = generation_agent.call(
+            [request["prompt"] for request in requests],
+            **requests[0]["generation_params"]
+        )
+        for sound, request in zip(sounds, requests):
+            request["result"] = sound
+
+    def keep_speculative_sounds(self, requests: List[Dict], speculation: SpeculativeQueue):
+        # saves the sounds generated from drafts that passed review, returns the requests
+        # still to be generated
+        remaining = []
+        for request in requests:
+            speculative = None
+            if request["speculation_key"] is not None:
+                speculative = speculation.keep(request["speculation_key"])
+            if speculative is None:
+                remaining.append(request)
+            else:
+                self.save_sound(request, speculative["result"])
+        return remaining
+
+    def save_sound(self, request: Dict, sound):
+        path = request["save_path"]
+        self.publisher.publish(path, sound, sample_rate=self.cfg["sample_rate"])
+        if self.publisher.save_files:
+            sf.write(path.__str__(), sound, self.cfg["sample_rate"])
+            if request["cache"] is not None:
+                request["cache"].save(request["cache_key"], path)
+            if request["checkpoint"] is not None:
+                request["checkpoint"].save(path.stem, request["page_inputs"], str(path))
+        self.progress.page_done(request["page"], story_dir=str(path.parent.parent))
+
+    def generate_sounds(self, requests: List[Dict]):
+        self.synthesize_sounds(requests)
+        # results are routed back to the page (and story) each prompt belongs to
+        for request in requests:
+            self.save_sound(request, request["result"])
+
     def generate_sound_prompt_from_story(
             self,
             pages: List,
+            checkpoint=None,
+            page_offset: int = 0,
+            on_draft=None,
         ):
+        # `on_draft(page_idx, sound_prompt)` is called with each draft before it is reviewed
         sound_prompt_reviser = init_tool_instance({
-            "tool": self.cfg.get("llm", "qwen"),
+            "tool": self.cfg.get("llm", default_llm()),
             "cfg": {
                 "system_prompt": story_to_sound_reviser_system,
                 "track_history": False
             }
         })
         sound_prompt_reviewer = init_tool_instance({
-            "tool": self.cfg.get("llm", "qwen"),
+            "tool": self.cfg.get("llm", default_llm()),
             "cfg": {
                 "system_prompt": story_to_sound_review_system,
                 "track_history": False
@@ -96,27 +280,106 @@ class AudioLDM2Agent:
         })
         num_turns = self.cfg.get("num_turns", 3)
 
-        sound_prompts = []
-        for page in pages:
-            review = ""
-            sound_prompt = ""
-            for turn in range(num_turns):
-                sound_prompt, success = sound_prompt_reviser.call(json.dumps({
-                    "story": page,
-                    "previous_result": sound_prompt,
-                    "improvement_suggestions": review,
-                }, ensure_ascii=False))
-                if sound_prompt.startswith("Sound description:"):
-                    sound_prompt = sound_prompt[len("Sound description:"):]
-                review, success = sound_prompt_reviewer.call(json.dumps({
-                    "story": page,
-                    "sound_description": sound_prompt
-                }, ensure_ascii=False))
-                if review == "Check passed.":
-                    break
-                # else:
-                    # print(review)
-            sound_prompts.append(sound_prompt)
-
-        return sound_prompts
+        progress = PageProgress("sound prompts", total=len(pages) if isinstance(pages, list) else None)
+
+        if self.cfg.get("batch_pages"):
+            return self.generate_sound_prompts_in_batches(
+                pages, checkpoint, page_offset, on_draft, num_turns, progress,
+                sound_prompt_reviser, sound_prompt_reviewer)
+
+        async def revise(idx, page):
+            sound_prompt = await acheckpointed(
+                checkpoint,
+                f"sound_prompt_p{idx + 1}",
+                {"story": page, "num_turns": num_turns},
+                lambda: self.revise_sound_prompt(
+                    page, sound_prompt_reviser, sound_prompt_reviewer, num_turns,
+                    (lambda prompt: on_draft(idx, prompt)) if on_draft is not None else None)
+            )
+            progress.page_done(idx + 1)
+            return sound_prompt
+
+        if isinstance(pages, list):
+            # pages are revised independently, up to `llm_concurrency` of them at a time
+            return run_concurrently([functools.partial(revise, idx, page)
+                                     for idx, page in enumerate(pages, start=page_offset)],
+                                    self.cfg.get("llm_concurrency", 1))
+        # streamed pages are revised as they arrive
+        return run_streamed(pages, lambda idx, page: revise(idx + page_offset, page),
+                            self.cfg.get("llm_concurrency", 1))
+
+    def generate_sound_prompts_in_batches(self, pages, checkpoint, page_offset, on_draft, num_turns, progress,
+                                          sound_prompt_reviser, sound_prompt_reviewer):
+        # `batch_pages` pages per reviser / reviewer request, see `BatchedReview`
+        reviser_system, reviewer_system = batch_system_prompts(
+            story_to_sound_reviser_system, story_to_sound_review_system)
+        review = BatchedReview(
+            init_tool_instance({
+                "tool": self.cfg.get("llm", default_llm()),
+                "cfg": {"system_prompt": reviser_system, "track_history": False}
+            }),
+            init_tool_instance({
+                "tool": self.cfg.get("llm", default_llm()),
+                "cfg": {"system_prompt": reviewer_system, "track_history": False}
+            }),
+            num_turns,
+            result_key="sound_description",
+            clean_result=lambda prompt: prompt[len("Sound description:"):]
+            if prompt.startswith("Sound description:") else prompt
+        )
+
+        async def revise_chunk(chunk, context):
+            sound_prompts = {}
+            todo = {}
+            for idx, page in chunk:
+                idx += page_offset
+                found, sound_prompt = checkpoint.load(f"sound_prompt_p{idx + 1}", {"story": page, "num_turns": num_turns}) \
+                    if checkpoint is not None else (False, None)
+                if found:
+                    sound_prompts[idx] = sound_prompt
+                else:
+                    todo[idx + 1] = {"story": page}
+            results = await review.run(
+                {}, todo,
+                on_draft=(lambda page_number, prompt: on_draft(page_number - 1, prompt)) if on_draft is not None else None)
+            for page_number, fields in todo.items():
+                idx = page_number - 1
+                if page_number in results:
+                    sound_prompt = results[page_number]
+                else:
+                    # the batched output was not usable, the page is revised on its own
+                    sound_prompt = await self.revise_sound_prompt(
+                        fields["story"], sound_prompt_reviser, sound_prompt_reviewer, num_turns,
+                        (lambda prompt: on_draft(idx, prompt)) if on_draft is not None else None)
+                if checkpoint is not None:
+                    checkpoint.save(f"sound_prompt_p{idx + 1}", {"story": fields["story"], "num_turns": num_turns},
+                                    sound_prompt)
+                sound_prompts[idx] = sound_prompt
+            for idx, _ in chunk:
+                progress.page_done(idx + page_offset + 1)
+            return [sound_prompts[idx + page_offset] for idx, _ in chunk]
+
+        return map_chunks(pages, self.cfg["batch_pages"], revise_chunk, self.cfg.get("llm_concurrency", 1))
 
+    async def revise_sound_prompt(self, page, sound_prompt_reviser, sound_prompt_reviewer, num_turns, on_draft=None):
+        review = ""
+        sound_prompt = ""
+        for turn in range(num_turns):
+            sound_prompt, success = await acall_llm(sound_prompt_reviser, json.dumps({
+                "story": page,
+                "previous_result": sound_prompt,
+                "improvement_suggestions": review,
+            }, ensure_ascii=False))
+            if sound_prompt.startswith("Sound description:"):
+                sound_prompt = sound_prompt[len("Sound description:"):]
+            if on_draft is not None:
+                on_draft(sound_prompt)
+            review, success = await acall_llm(sound_prompt_reviewer, json.dumps({
+                "story": page,
+                "sound_description": sound_prompt
+            }, ensure_ascii=False))
+            if review == "Check passed.":
+                break
+            # else:
+                # print(review)
+        return sound_prompt
@@ -3,16 +3,19 @@ import json
 from pathlib import Path
 from typing import List, Dict
 
-from aliyunsdkcore.client import AcsClient
-from aliyunsdkcore.request import CommonRequest
-import nls
-
 from mm_story_agent.base import register_tool
+from mm_story_agent.utils.asset_cache import AssetCache
+from mm_story_agent.utils.checkpoint import checkpointed
+from mm_story_agent.utils.asset import make_asset_handle
+from mm_story_agent.utils.tracing import traced
+from mm_story_agent.utils.progress import PageProgress
+from mm_story_agent.utils.asset_bus import AssetPublisher
 
 
 # Due to the trouble regarding environment, we use dashscope to deploy and call the API for CosyVoice.
 class CosyVoiceSynthesizer:
 
+    @traced("load CosyVoiceSynthesizer", category="model_load", unit="speech_model_load")
     def __init__(self) -> None:
         self.access_key_id = os.environ.get('ALIYUN_ACCESS_KEY_ID')
         self.access_key_secret = os.environ.get('ALIYUN_ACCESS_KEY_SECRET')
@@ -20,6 +23,10 @@ class CosyVoiceSynthesizer:
         self.setup_token()
 
     def setup_token(self):
+        # the SDKs of the speech service are imported by the synthesizer that calls it
+        from aliyunsdkcore.client import AcsClient
+        from aliyunsdkcore.request import CommonRequest
+
         client = AcsClient(self.access_key_id, self.access_key_secret,
                            'cn-shanghai')
         request = CommonRequest()
@@ -40,7 +47,10 @@ class CosyVoiceSynthesizer:
                 f'Request token failed with error: {e}, with detail {traceback.format_exc()}'
             )
 
+    @traced("CosyVoiceSynthesizer.call", category="inference", unit="tts_request")
     def call(self, save_file, transcript, voice="longyuan", sample_rate=16000):
+        import nls
+
         writer = open(save_file, "wb")
         return_data = b''
 
@@ -75,22 +85,61 @@ class CosyVoiceSynthesizer:
 @register_tool("cosyvoice_tts")
 class CosyVoiceAgent:
 
+    stream_pages = True
+    pool = "tts"
+
     def __init__(self, cfg) -> None:
         self.cfg = cfg
+        self.synthesizer = None
+        self.publisher = AssetPublisher(cfg)
+
+    def get_synthesizer(self):
+        if self.synthesizer is None:
+            self.synthesizer = CosyVoiceSynthesizer()
+        return self.synthesizer
 
     def call(self, params: Dict):
         pages: List = params["pages"]
         save_path: str = params["save_path"]
-        generation_agent = CosyVoiceSynthesizer()
-
-        for idx, page in enumerate(pages):
-            generation_agent.call(
-                save_file=save_path / f"p{idx + 1}.wav",
-                transcript=page,
-                voice=params.get("voice", "longyuan"),
-                sample_rate=self.cfg.get("sample_rate", 16000)
-            )
+        page_offset: int = params.get("page_offset", 0)
+        checkpoint = params.get("checkpoint")
+        # a fresh token is requested for every call
+        self.synthesizer = None
+        cache = AssetCache.from_config(self.cfg.get("cache"))
+        assets = []
+        progress = PageProgress("speech", total=len(pages) if isinstance(pages, list) else None)
+
+        for idx, page in enumerate(pages, start=page_offset):
+            save_file = save_path / f"p{idx + 1}.wav"
+            page_inputs = {
+                "tool": "cosyvoice_tts",
+                "transcript": page,
+                "voice": params.get("voice", "longyuan"),
+                "sample_rate": self.cfg.get("sample_rate", 16000)
+            }
+            checkpointed(checkpoint, save_file.stem, page_inputs,
+                         lambda: self.synthesize_page(save_file, page_inputs, cache),
+                         files=[save_file])
+            self.publisher.publish_audio_file(save_file)
+            assets.append(make_asset_handle(save_file))
+            progress.page_done(idx + 1)
 
         return {
-            "modality": "speech"
-        }
\ No newline at end of file
+            "modality": "speech",
+            "assets": assets,
+        }
+
+    def synthesize_page(self, save_file, page_inputs, cache):
+        if cache is not None:
+            cache_key = cache.make_key(**page_inputs)
+            if cache.load(cache_key, save_file):
+                return str(save_file)
+        self.get_synthesizer().call(
+            save_file=save_file,
+            transcript=page_inputs["transcript"],
+            voice=page_inputs["voice"],
+            sample_rate=page_inputs["sample_rate"]
+        )
+        if cache is not None:
+            cache.save(cache_key, save_file)
+        return str(save_file)
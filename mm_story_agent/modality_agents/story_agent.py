@@ -1,41 +1,61 @@
 import json
 from typing import Dict
 import random
+import time
 
 from tqdm import trange, tqdm
 
-from ..utils.llm_output_check import parse_list
+from ..utils.llm_output_check import ListStreamParser, JsonStreamParser, stream_llm
 from ..base import register_tool, init_tool_instance
+from ..utils.checkpoint import checkpointed
+from ..utils.progress import PageProgress
+from ..utils.rate_limit import backoff_delay
+from ..utils.llm_backend import default_llm
 from ..prompts_en import question_asker_system, expert_system, \
     dlg_based_writer_system, dlg_based_writer_prompt, chapter_writer_system
 
 
+# allowed keys of the outline objects, checked while the outline is streamed
+OUTLINE_KEYS = {
+    (): {"story_title", "story_outline"},
+    ("story_outline", "*"): {"chapter_title", "chapter_summary"},
+}
+
+
+def check_outline(outline):
+    if not isinstance(outline, dict):
+        return False
+    if outline.keys() != {"story_title", "story_outline"}:
+        return False
+    if not isinstance(outline["story_outline"], list):
+        return False
+    for chapter in outline["story_outline"]:
+        if not isinstance(chapter, dict) or chapter.keys() != {"chapter_title", "chapter_summary"}:
+            return False
+    return True
+
+
 def json_parse_outline(outline):
     outline = outline.strip("```json").strip("```")
     try:
-        outline = json.loads(outline)
-        if not isinstance(outline, dict):
-            return False
-        if outline.keys() != {"story_title", "story_outline"}:
-            return False
-        for chapter in outline["story_outline"]:
-            if chapter.keys() != {"chapter_title", "chapter_summary"}:
-                return False
+        return check_outline(json.loads(outline))
     except json.decoder.JSONDecodeError:
         return False
-    return True
 
 
 @register_tool("qa_outline_story_writer")
 class QAOutlineStoryWriter:
 
+    # the job queue runs the tool in a worker of this pool
+    pool = "llm"
+
     def __init__(self,
                  cfg: Dict):
         self.cfg = cfg
         self.temperature = cfg.get("temperature", 1.0)
         self.max_conv_turns = cfg.get("max_conv_turns", 3)
         self.num_outline = cfg.get("num_outline", 4)
-        self.llm_type = cfg.get("llm", "qwen")
+        self.llm_type = cfg.get("llm", default_llm())
 
     def generate_outline(self, params):
         # `params`: story setting like 
@@ -92,12 +112,15 @@ class QAOutlineStoryWriter:
             num_outline=self.num_outline
         )
 
-        outline, success = writer.call(writer_prompt, success_check_fn=json_parse_outline)
-        outline = json.loads(outline)
+        # a draft that goes off the outline format is retried without waiting for its end
+        parser = JsonStreamParser(keys=OUTLINE_KEYS, check_fn=check_outline)
+        outline, = list(stream_llm(writer, writer_prompt, parser))
         # print(outline)
         return outline
 
-    def generate_story_from_outline(self, outline):
+    def iter_story_from_outline(self, outline):
+        # yield pages chapter by chapter so that downstream agents can start
+        # working on early pages while later chapters are still being written
         chapter_writer = init_tool_instance({
             "tool": self.llm_type,
             "cfg": {
@@ -106,37 +129,71 @@ class QAOutlineStoryWriter:
             }
         })
         all_pages = []
+        num_chapters = len(outline["story_outline"])
+        progress = PageProgress("write")
         for idx, chapter in enumerate(tqdm(outline["story_outline"])):
-            chapter_detail, success = chapter_writer.call(
-                json.dumps(
+            num_previous_pages = len(all_pages)
+            # pages are yielded as soon as the writer has completed them. An output that goes off
+            # the list format is retried with another seed; the pages yielded so far are part of
+            # the completed story of the retry, so that it continues the chapter after them
+            # instead of writing it again. The writer itself tries once, as its retries would
+            # repeat the prompt.
+            seed = 1
+            failed_tries = 0
+            while True:
+                # a fresh parser, as none of the pages of the continuation were delivered
+                parser = ListStreamParser()
+                prompt = json.dumps(
                     {
                         "completed_story": all_pages,
                         "current_chapter": chapter
                     },
                     ensure_ascii=False
-                ),
-                success_check_fn=parse_list,
-                temperature=self.temperature
-            )
-            while success is False:
-                chapter_detail, success = chapter_writer.call(
-                    json.dumps(
-                        {
-                            "completed_story": all_pages,
-                            "current_chapter": chapter
-                        },
-                        ensure_ascii=False
-                    ),
-                    seed=random.randint(0, 100000),
-                    temperature=self.temperature,
-                    success_check_fn=parse_list
                 )
-            pages = [page.strip() for page in eval(chapter_detail)]
-            all_pages.extend(pages)
+                for page in stream_llm(chapter_writer, prompt, parser, seed=seed, temperature=self.temperature,
+                                       max_try=1):
+                    all_pages.append(page.strip())
+                    # the number of pages is only known at the end, estimate it from the chapters written so far
+                    if idx > 0:
+                        progress.total = max(round(num_previous_pages / idx * num_chapters), len(all_pages))
+                    progress.page_done(len(all_pages))
+                    yield all_pages[-1]
+                if parser.done:
+                    break
+                if parser.error is None:
+                    # the request failed (throttled, server error), not the format of its output
+                    time.sleep(backoff_delay(failed_tries))
+                    failed_tries += 1
+                seed = random.randint(0, 100000)
+            progress.total = round(len(all_pages) / (idx + 1) * num_chapters)
+
+    def generate_story_from_outline(self, outline):
+        all_pages = list(self.iter_story_from_outline(outline))
         # print(all_pages)
         return all_pages
 
+    def stream(self, params):
+        params = params.copy()
+        checkpoint = params.pop("checkpoint", None)
+        outline = checkpointed(checkpoint, "outline", {"cfg": self.cfg, "params": params},
+                               lambda: self.generate_outline(params))
+        if checkpoint is not None:
+            found, pages = checkpoint.load("pages", outline)
+            if found:
+                yield from pages
+                return
+        pages = []
+        for page in self.iter_story_from_outline(outline):
+            pages.append(page)
+            yield page
+        if checkpoint is not None:
+            checkpoint.save("pages", outline, pages)
+
     def call(self, params):
-        outline = self.generate_outline(params)
-        pages = self.generate_story_from_outline(outline)
+        params = params.copy()
+        checkpoint = params.pop("checkpoint", None)
+        outline = checkpointed(checkpoint, "outline", {"cfg": self.cfg, "params": params},
+                               lambda: self.generate_outline(params))
+        pages = checkpointed(checkpoint, "pages", outline,
+                             lambda: self.generate_story_from_outline(outline))
         return pages
@@ -0,0 +1,150 @@
+"""
+Local stand-ins for every backend (LLM API, diffusion / audio models, TTS service), used to
+benchmark the pipeline on a CPU-only machine without network access. The stub agents subclass
+the real ones and only replace the synthesizers, so prompt revision, checkpoints, the asset
+cache and video composition run the real code. The real agents import the model libraries
+(diffusers, transformers, the TTS SDK) only when their synthesizers are created.
+"""
+import time
+import zlib
+from pathlib import Path
+from typing import List, Union
+
+import numpy as np
+import soundfile as sf
+from PIL import Image
+
+from mm_story_agent.base import register_tool
+from mm_story_agent.modality_agents.image_agent import StoryDiffusionAgent
+from mm_story_agent.modality_agents.sound_agent import AudioLDM2Agent
+from mm_story_agent.modality_agents.speech_agent import CosyVoiceAgent
+from mm_story_agent.modality_agents.music_agent import MusicGenAgent
+from mm_story_agent.utils.tracing import traced
+
+
+def prompt_seed(text: str):
+    # deterministic per prompt, so that the same prompt gives the same asset
+    return zlib.crc32(text.encode("utf-8"))
+
+
+def tone(seed: int, duration: float, sample_rate: int, amplitude: float = 0.1):
+    t = np.arange(int(duration * sample_rate)) / sample_rate
+    frequency = 200 + seed % 600
+    return (amplitude * np.sin(2 * np.pi * frequency * t)).astype(np.float32)
+
+
+class StubImageSynthesizer:
+
+    def __init__(self, height: int, width: int, latency: float = 0.0, num_steps: int = 50) -> None:
+        self.height = height
+        self.width = width
+        self.latency = latency
+        self.num_steps = num_steps
+
+    @traced("StubImageSynthesizer.call", category="inference", unit="image_step",
+            attrs=lambda call: {"units": len(call["prompts"]) * call["self"].num_steps})
+    def call(self, prompts: List[str], **kwargs):
+        time.sleep(self.latency * len(prompts))
+        images = []
+        for prompt in prompts:
+            seed = prompt_seed(prompt)
+            color = (seed % 256, (seed >> 8) % 256, (seed >> 16) % 256)
+            images.append(Image.new("RGB", (self.width, self.height), color))
+        return images
+
+
+class StubSoundSynthesizer:
+
+    def __init__(self, latency: float = 0.0, sample_rate: int = 16000) -> None:
+        self.latency = latency
+        self.sample_rate = sample_rate
+
+    @traced("StubSoundSynthesizer.call", category="inference", unit="sound_step",
+            attrs=lambda call: {"units": len(call["prompts"]) * call["n_candidate_per_text"] * call["ddim_steps"]})
+    def call(self, prompts: List[str], n_candidate_per_text: int = 3, ddim_steps: int = 100, **kwargs):
+        time.sleep(self.latency * len(prompts))
+        # AudioLDM2 generates 10 s of audio per prompt
+        return [tone(prompt_seed(prompt), 10.0, self.sample_rate, 0.05) for prompt in prompts]
+
+
+class StubSpeechSynthesizer:
+
+    def __init__(self, latency: float = 0.0, seconds_per_word: float = 0.3) -> None:
+        self.latency = latency
+        self.seconds_per_word = seconds_per_word
+
+    @traced("StubSpeechSynthesizer.call", category="inference", unit="tts_request")
+    def call(self, save_file, transcript, voice="longyuan", sample_rate=16000):
+        time.sleep(self.latency)
+        duration = max(len(transcript.split()), 1) * self.seconds_per_word
+        sf.write(str(save_file), tone(prompt_seed(transcript), duration, sample_rate, 0.3), sample_rate)
+
+
+class StubMusicSynthesizer:
+
+    def __init__(self, latency: float = 0.0, sample_rate: int = 16000) -> None:
+        self.latency = latency
+        self.sample_rate = sample_rate
+
+    @traced("StubMusicSynthesizer.call", category="inference", unit="music_token",
+            attrs=lambda call: {"units": (1 if isinstance(call["prompt"], str) else len(call["prompt"]))
+                                * int(51.2 * call["duration"])})
+    def call(self, prompt: Union[str, List[str]], save_path: Union[str, Path, List], duration: float = 30.0):
+        if isinstance(prompt, str):
+            prompt, save_path = [prompt], [save_path]
+        time.sleep(self.latency)
+        for text, path in zip(prompt, save_path):
+            sf.write(str(path), tone(prompt_seed(text), duration, self.sample_rate), self.sample_rate)
+
+
+@register_tool("stub_t2i")
+class StubStoryDiffusionAgent(StoryDiffusionAgent):
+
+    memory_footprint = {}
+
+    def get_synthesizer(self, num_pages: int):
+        if self.synthesizer is None:
+            self.synthesizer = StubImageSynthesizer(
+                height=self.cfg.get("height", 512),
+                width=self.cfg.get("width", 512),
+                latency=self.cfg.get("latency", 0.0),
+                num_steps=self.cfg.get("num_steps", 50)
+            )
+        return self.synthesizer
+
+
+@register_tool("stub_t2a")
+class StubAudioLDM2Agent(AudioLDM2Agent):
+
+    memory_footprint = {}
+
+    def get_synthesizer(self):
+        if self.synthesizer is None:
+            self.synthesizer = StubSoundSynthesizer(
+                latency=self.cfg.get("latency", 0.0),
+                sample_rate=self.cfg.get("sample_rate", 16000)
+            )
+        return self.synthesizer
+
+
+@register_tool("stub_tts")
+class StubTTSAgent(CosyVoiceAgent):
+
+    def get_synthesizer(self):
+        if self.synthesizer is None:
+            self.synthesizer = StubSpeechSynthesizer(latency=self.cfg.get("latency", 0.0))
+        return self.synthesizer
+
+
+@register_tool("stub_t2m")
+class StubMusicGenAgent(MusicGenAgent):
+
+    memory_footprint = {}
+
+    def get_synthesizer(self):
+        if self.synthesizer is None:
+            self.synthesizer = StubMusicSynthesizer(
+                latency=self.cfg.get("latency", 0.0),
+                sample_rate=self.cfg.get("sample_rate", 16000)
+            )
+        return self.synthesizer
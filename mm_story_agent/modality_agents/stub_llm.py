@@ -0,0 +1,111 @@
+"""
+The stand-in of the LLM API, kept apart from the other stubs so that it can be served (see
+`OpenAIStandInServer`) without loading the model libraries.
+"""
+import re
+import json
+import time
+import asyncio
+from typing import Dict
+
+from mm_story_agent.base import register_tool
+from mm_story_agent.prompts_en import question_asker_system, expert_system, dlg_based_writer_system, \
+    chapter_writer_system, role_extract_system, story_to_image_reviser_system, \
+    story_to_sound_reviser_system, story_to_music_reviser_system, batch_reviser_instruction, \
+    batch_reviewer_instruction
+from mm_story_agent.utils.tracing import span
+from mm_story_agent.utils.llm_backend import llm_backend_cfg
+
+
+@register_tool("stub_llm")
+class StubLLMAgent:
+    """
+    Answers like `QwenAgent`, with a canned answer chosen by the system prompt that passes the
+    format checks of the agents. Reviewers always pass. `latency` (seconds per request) and
+    `pages_per_chapter` come from the cfg, usually that of the `llm` block.
+    """
+
+    def __init__(self, config: Dict):
+        config = dict(llm_backend_cfg("stub_llm"), **config)
+        self.system_prompt = config.get("system_prompt")
+        self.latency = config.get("latency", 0.0)
+        self.pages_per_chapter = config.get("pages_per_chapter", 3)
+
+    def answer(self, prompt: str):
+        for instruction in (batch_reviser_instruction, batch_reviewer_instruction):
+            if self.system_prompt is not None and self.system_prompt.endswith(instruction):
+                # batched requests (see `BatchedReview`) get the answer of each page
+                request = json.loads(prompt)
+                page_llm = StubLLMAgent(dict(system_prompt=self.system_prompt[:-len(instruction)].strip(),
+                                             latency=self.latency, pages_per_chapter=self.pages_per_chapter))
+                return json.dumps({
+                    page: page_llm.answer(json.dumps(dict(request["shared"], **fields)))
+                    for page, fields in request["pages"].items()
+                })
+        if self.system_prompt == question_asker_system:
+            return "What does the main role want to achieve?"
+        if self.system_prompt == expert_system:
+            return "Lily wants to finish her homework before playing in the garden."
+        if self.system_prompt == dlg_based_writer_system:
+            num_outline = int(re.search(r"outline with (\d+) chapters", prompt).group(1))
+            return json.dumps({
+                "story_title": "Lily and the Clock",
+                "story_outline": [
+                    {"chapter_title": f"Chapter {idx + 1}", "chapter_summary": f"Lily learns lesson {idx + 1}."}
+                    for idx in range(num_outline)
+                ]
+            })
+        if self.system_prompt == chapter_writer_system:
+            chapter = json.loads(prompt)["current_chapter"]["chapter_title"]
+            return repr([
+                f"{chapter}, page {idx + 1}: Lily looks at the clock and plans her afternoon with her cat Tom."
+                for idx in range(self.pages_per_chapter)
+            ])
+        if self.system_prompt == role_extract_system:
+            return json.dumps({"Lily": "little girl", "Tom": "grey cat"})
+        if self.system_prompt == story_to_image_reviser_system:
+            return "Image description: Lily at a desk next to a big clock, Tom sleeping on the window sill."
+        if self.system_prompt == story_to_sound_reviser_system:
+            return "clock ticking, cat purring"
+        if self.system_prompt == story_to_music_reviser_system:
+            return "Calm and warm piano melody with soft strings."
+        return "Check passed."
+
+    def call(self,
+             prompt: str,
+             model_name: str = "stub",
+             success_check_fn=None,
+             **kwargs):
+        with span("stub llm call", category="llm", unit="llm_request", model=model_name):
+            time.sleep(self.latency)
+            response = self.answer(prompt)
+        success = success_check_fn is None or success_check_fn(response)
+        return response, success
+
+    async def acall(self,
+                    prompt: str,
+                    model_name: str = "stub",
+                    success_check_fn=None,
+                    **kwargs):
+        with span("stub llm call", category="llm", unit="llm_request", model=model_name):
+            await asyncio.sleep(self.latency)
+            response = self.answer(prompt)
+        success = success_check_fn is None or success_check_fn(response)
+        return response, success
+
+    def stream(self,
+               prompt: str,
+               parser,
+               model_name: str = "stub",
+               **kwargs):
+        # the answer arrives in chunks spread over the latency
+        with span("stub llm call", category="llm", unit="llm_request", model=model_name, stream=True):
+            response = self.answer(prompt)
+            chunks = [response[idx:idx + 16] for idx in range(0, len(response), 16)]
+            parser.reset()
+            for chunk in chunks:
+                time.sleep(self.latency / len(chunks))
+                yield from parser.feed(chunk)
+                if parser.done:
+                    break
+            parser.close()
@@ -373,4 +373,44 @@ The input consists of the story content and the corresponding music search query
 
 ## Output Format
 Directly output improvement suggestions without any additional content if requirements are not met. Otherwise, output "Check passed.".
-""".strip()
\ No newline at end of file
+""".strip()
+
+history_summary_system = """
+Summarize the earlier part of a conversation so that it can be continued without it.
+
+## Requirements
+1. Keep the facts, decisions, names and open questions the later conversation may refer to.
+2. If the input starts with a previous summary, merge it into the new summary.
+3. Do not exceed 200 words.
+
+## Output Format
+Directly output the summary without any additional content.
+""".strip()
+
+
+batch_reviser_instruction = """
+## Batched Input and Output
+The input covers several pages at once, formatted as:
+{
+    "shared": {...}, // fields of the input format above shared by all pages, may be empty
+    "pages": {
+        "(page number)": {...}, // the other fields of the input format above for this page
+        ...
+    }
+}
+Handle each page independently as described above. Output a JSON object that maps every page number of the input to its result in the output format above, e.g., {"1": ..., "2": ...}. Directly output the JSON object without any additional content.
+""".strip()
+
+
+batch_reviewer_instruction = """
+## Batched Input and Output
+The input covers several pages at once, formatted as:
+{
+    "shared": {...}, // fields of the input format above shared by all pages, may be empty
+    "pages": {
+        "(page number)": {...}, // the other fields of the input format above for this page
+        ...
+    }
+}
+Review each page independently as described above. Output a JSON object that maps every page number of the input to "Check passed." or to the improvement suggestions for that page, e.g., {"1": "Check passed.", "2": "xxx"}. Directly output the JSON object without any additional content.
+""".strip()
@@ -0,0 +1,521 @@
+import json
+import time
+import traceback
+from pathlib import Path
+from typing import Dict, List, Union
+from multiprocessing.connection import wait
+
+import torch.multiprocessing as mp
+
+from .base import init_tool_instance
+from .utils.page_stream import PageStream
+from .utils.checkpoint import StageCheckpoint
+from .utils.memory_budget import MemoryBudget, get_footprint, set_memory_connection, reserve_before_call
+from .utils.tracing import span, set_process_name
+from .utils.progress import emit, set_progress_stage
+
+
+def run_stage(name, agent, params, return_dict, error_dict, memory_connection=None):
+    set_process_name(name)
+    set_progress_stage(name)
+    set_memory_connection(memory_connection)
+    try:
+        reserve_before_call(agent)
+        with span(f"call {name}", category="stage", tool=type(agent).__name__):
+            result = agent.call(params)
+    except Exception:
+        error_dict[name] = traceback.format_exc()
+        raise
+    return_dict[name] = result
+
+
+def run_streaming_stage(name, agent, params, streams, return_dict, error_dict, memory_connection=None):
+    set_process_name(name)
+    set_progress_stage(name)
+    set_memory_connection(memory_connection)
+    pages = []
+    try:
+        reserve_before_call(agent)
+        with span(f"stream {name}", category="stage", tool=type(agent).__name__):
+            for page in agent.stream(params):
+                pages.append(page)
+                for stream in streams:
+                    stream.put(page)
+    except Exception:
+        error_dict[name] = traceback.format_exc()
+        raise
+    finally:
+        for stream in streams:
+            stream.close()
+    return_dict[name] = pages
+
+
+def save_status(story_dir: Path, status: Dict):
+    # {stage: {"status": succeeded / resumed / failed / timeout / cancelled / skipped, "error": ...}}
+    story_dir.mkdir(exist_ok=True, parents=True)
+    with open(story_dir / "status.json", "w") as writer:
+        json.dump(status, writer, ensure_ascii=False, indent=4)
+
+
+def merge_page_results(results: List):
+    # results of a `foreach` stage, one per page, are merged back into a single result
+    if all(isinstance(result, dict) for result in results):
+        merged = {}
+        for result in results:
+            for key, value in result.items():
+                if isinstance(value, list):
+                    merged.setdefault(key, []).extend(value)
+                else:
+                    merged.setdefault(key, []).append(value)
+        return merged
+    return results
+
+
+class Stage:
+    """
+    A node of the stage graph, declared in the configuration next to `tool` / `cfg` / `params`:
+
+        image_generation:
+            tool: story_diffusion_t2i
+            inputs:             # parameter name -> stage name (or `stage.key` for a field of its result)
+                pages: story_writer
+                prompts: image_prompt.prompts
+            after: []           # stages that must finish first without passing data
+            save_dir: image     # `params["save_path"]` becomes `story_dir / save_dir`
+            foreach: pages      # optional, run one task per element of this input
+            memory:             # optional, overrides the footprint (GB) declared by the tool
+                vram: 12
+            timeout: 1800       # optional, seconds before the stage is killed
+            required: true      # if a required stage fails, all other running stages are cancelled
+            cfg: ...
+            params: ...
+    """
+
+    def __init__(self, name: str, cfg: Dict) -> None:
+        self.name = name
+        self.tool_cfg = {
+            "tool": cfg["tool"],
+            "cfg": cfg.get("cfg") or {}
+        }
+        self.params = cfg.get("params") or {}
+        self.inputs = cfg.get("inputs") or {}
+        self.after = cfg.get("after") or []
+        self.save_dir = cfg.get("save_dir")
+        self.foreach = cfg.get("foreach")
+        self.memory = cfg.get("memory")
+        self.timeout = cfg.get("timeout")
+        self.required = cfg.get("required", True)
+
+    @property
+    def dependencies(self):
+        deps = {ref.split(".")[0] for ref in self.inputs.values()}
+        return deps | set(self.after)
+
+    def blocked_by(self, failed: set, stages: Dict):
+        # data dependencies are always needed, `after` dependencies only if they are required
+        deps = {ref.split(".")[0] for ref in self.inputs.values()}
+        deps |= {dep for dep in self.after if stages[dep].required}
+        return deps & failed
+
+    def checkpoint_inputs(self, params: Dict, results: Dict):
+        # a stage is resumed from its checkpoint only if the tool, its params and
+        # the results of the stages it runs after are unchanged
+        return {
+            "tool": self.tool_cfg,
+            "params": dict(params),
+            "after": {dep: results.get(dep) for dep in self.after}
+        }
+
+    def build_params(self, results: Dict, story_dir: Path):
+        params = self.params.copy()
+        for param_name, ref in self.inputs.items():
+            dep, _, key = ref.partition(".")
+            value = results[dep]
+            if key:
+                value = value[key]
+            params[param_name] = value
+        if self.save_dir is not None:
+            save_path = story_dir / self.save_dir
+            save_path.mkdir(exist_ok=True, parents=True)
+            params["save_path"] = save_path
+        return params
+
+
+def critical_path(stages: Dict[str, Stage], latencies: Dict[str, float]):
+    # the shortest possible run time given the stage latencies and dependencies
+    finish = {}
+
+    def finish_time(name):
+        if name not in finish:
+            deps = stages[name].dependencies
+            finish[name] = latencies.get(name, 0.0) + max((finish_time(dep) for dep in deps), default=0.0)
+        return finish[name]
+
+    return max((finish_time(name) for name in stages), default=0.0)
+
+
+class StageGraph:
+    """
+    The state of one run of the stage graph, shared by the drivers (`StageScheduler`,
+    `BatchStoryRunner`, `QueueRunner`), which only decide how the tasks are run. A stage is ready
+    once its dependencies are done: it is resumed from its checkpoint, or split into tasks for the
+    driver (one per element of its `foreach` input). A stage succeeds once all its tasks did, and
+    a failed stage skips the stages it blocks. `results` / `status` are those of a previous run.
+    """
+
+    def __init__(self,
+                 stages: Dict[str, Stage],
+                 story_dir: Path,
+                 checkpoint: StageCheckpoint,
+                 results: Dict = None,
+                 status: Dict = None,
+                 progress_file: Path = None) -> None:
+        self.stages = stages
+        self.story_dir = Path(story_dir)
+        self.checkpoint = checkpoint
+        self.progress_file = progress_file
+        self.results = dict(results or {})
+        # structured outcome of every stage, written to `story_dir/status.json` by the driver
+        self.status = status if status is not None else {name: {"status": "succeeded"} for name in self.results}
+        self.failed = {name for name, stage_status in self.status.items()
+                       if stage_status["status"] not in ("succeeded", "resumed")}
+        self.pending = [name for name in stages if name not in self.results and name not in self.failed]
+        # unfinished tasks of every dispatched stage
+        self.remaining = {}
+        self.num_tasks = {}
+        self.task_results = {}
+        self.checkpoint_inputs = {}
+        # stream consumer -> the stage whose pages it consumes, until it is checkpointed
+        self.streamed_from = {}
+
+    @property
+    def done(self):
+        return not self.pending and not any(self.remaining.values())
+
+    def set_status(self, name: str, status: str, error=None):
+        self.status[name] = {"status": status, "error": error} if error is not None else {"status": status}
+        emit("stage_finish", self.progress_file, stage=name, status=status, error=error)
+
+    def fail(self, name: str, status: str, error=None):
+        # only the first failure of a stage is recorded, returns whether this was it
+        if name in self.failed:
+            return False
+        self.failed.add(name)
+        self.set_status(name, status, error)
+        return True
+
+    def ready(self):
+        # yields (name, params) of every stage that can be dispatched, until none is left
+        changed = True
+        while changed:
+            finished = len(self.results) + len(self.failed)
+            for name in list(self.pending):
+                if name not in self.pending:
+                    # dispatched meanwhile, e.g., as a stream consumer
+                    continue
+                stage = self.stages[name]
+                blocked_by = stage.blocked_by(self.failed, self.stages)
+                if blocked_by:
+                    print(f"Skip stage {name} of {self.story_dir} since its dependencies failed")
+                    self.pending.remove(name)
+                    self.fail(name, "skipped", f"dependencies failed: {sorted(blocked_by)}")
+                    continue
+                if not stage.dependencies <= self.results.keys() | self.failed:
+                    continue
+                self.pending.remove(name)
+                params = stage.build_params(self.results, self.story_dir)
+                stage_inputs = stage.checkpoint_inputs(params, self.results)
+                found, output = self.checkpoint.load_output(name, stage_inputs)
+                if found:
+                    print(f"Resume stage {name} of {self.story_dir} from checkpoint")
+                    self.results[name] = output
+                    self.set_status(name, "resumed")
+                    continue
+                self.checkpoint_inputs[name] = stage_inputs
+                params["checkpoint"] = self.checkpoint.child(name)
+                yield name, params
+            # stages depending on finished ones may be ready now
+            changed = len(self.results) + len(self.failed) > finished
+
+    def tasks(self, name: str, params: Dict):
+        # [(page, params)] of a ready stage, the page is None unless the stage runs `foreach`
+        stage = self.stages[name]
+        if stage.foreach is None:
+            self.remaining[name] = 1
+            return [(None, params)]
+        items = params[stage.foreach]
+        self.remaining[name] = self.num_tasks[name] = len(items)
+        tasks = []
+        for idx, item in enumerate(items):
+            task_params = params.copy()
+            task_params[stage.foreach] = [item]
+            task_params["page_offset"] = idx
+            tasks.append((idx, task_params))
+        if not items:
+            self.complete(name)
+        return tasks
+
+    def restore_tasks(self, name: str, num_tasks: int):
+        # a stage whose tasks were dispatched before this state was built (see `QueueRunner`)
+        stage = self.stages[name]
+        self.pending.remove(name)
+        self.remaining[name] = num_tasks
+        if stage.foreach is not None:
+            self.num_tasks[name] = num_tasks
+        params = stage.build_params(self.results, self.story_dir)
+        self.checkpoint_inputs[name] = stage.checkpoint_inputs(params, self.results)
+
+    def stream(self, consumer: str, producer: str):
+        # `consumer` runs as one task on the pages of `producer` while they are being written
+        self.pending.remove(consumer)
+        self.remaining[consumer] = 1
+        self.streamed_from[consumer] = producer
+
+    def finish_task(self, name: str, page: int = None, result=None, error=None, status: str = "failed"):
+        """
+        Records the result of a task of `name`, or the `error` it failed with (`status`: failed,
+        timeout, cancelled). Returns True if this failed a required stage: the driver then
+        cancels the rest of the run.
+        """
+        required_failed = False
+        if error is not None:
+            required_failed = self.fail(name, status, error) and self.stages[name].required
+        else:
+            self.task_results[(name, page)] = result
+        self.remaining[name] -= 1
+        if self.remaining[name] == 0 and name not in self.failed:
+            self.complete(name)
+        return required_failed
+
+    def complete(self, name: str):
+        if name in self.num_tasks:
+            outputs = [self.task_results.pop((name, idx)) for idx in range(self.num_tasks[name])]
+            self.results[name] = merge_page_results(outputs) if outputs else []
+        else:
+            self.results[name] = self.task_results.pop((name, None))
+        self.set_status(name, "succeeded")
+        if name in self.checkpoint_inputs:
+            self.checkpoint.save_output(name, self.checkpoint_inputs.pop(name), self.results[name])
+        # a stream consumer is checkpointed once the pages it consumed are known, with
+        # the inputs it would have been resumed from
+        for consumer, producer in list(self.streamed_from.items()):
+            if consumer in self.results and producer in self.results:
+                del self.streamed_from[consumer]
+                stage = self.stages[consumer]
+                params = stage.build_params(self.results, self.story_dir)
+                self.checkpoint.save_output(consumer, stage.checkpoint_inputs(params, self.results),
+                                            self.results[consumer])
+
+    def skip_pending(self, reason: str):
+        # fail fast: the stages not dispatched yet are no longer needed
+        for name in self.pending:
+            self.fail(name, "skipped", reason)
+        self.pending.clear()
+
+
+class StageScheduler:
+    """
+    Runs each stage in its own process as soon as all the stages it depends on have finished.
+    With a memory budget, a stage process waits for its footprint to fit when it loads its models
+    (see `reserve_memory`); since models live in the stage processes, they are released when the
+    stage finishes.
+    """
+
+    def __init__(self,
+                 stages: Dict[str, Dict],
+                 story_dir: Union[str, Path],
+                 stream_pages: bool = False,
+                 resume: bool = False,
+                 memory_budget: MemoryBudget = None) -> None:
+        self.stages = {name: Stage(name, cfg) for name, cfg in stages.items()}
+        self.story_dir = Path(story_dir)
+        self.stream_pages = stream_pages
+        self.memory_budget = memory_budget
+        self.checkpoint = StageCheckpoint(self.story_dir / "checkpoints", resume)
+        self.agents = {}
+        self.check_graph()
+
+    def check_graph(self):
+        for stage in self.stages.values():
+            for dep in stage.dependencies:
+                if dep not in self.stages:
+                    raise ValueError(f"Stage {stage.name} depends on unknown stage {dep}")
+        visited = set()
+        for name in self.stages:
+            path = []
+            stack = [(name, False)]
+            while stack:
+                node, leaving = stack.pop()
+                if leaving:
+                    path.remove(node)
+                    visited.add(node)
+                    continue
+                if node in path:
+                    raise ValueError(f"Cycle detected in stage graph at {node}")
+                if node in visited:
+                    continue
+                path.append(node)
+                stack.append((node, True))
+                stack.extend((dep, False) for dep in self.stages[node].dependencies)
+
+    def get_agent(self, name):
+        if name not in self.agents:
+            self.agents[name] = init_tool_instance(self.stages[name].tool_cfg)
+        return self.agents[name]
+
+    def stream_consumers(self, name, pending):
+        # stages that only need the pages of `name` and can consume them while they are being written.
+        # A stage with a checkpoint to resume from waits for the pages instead, since its inputs are
+        # only known then.
+        consumers = []
+        if not self.stream_pages or not hasattr(self.get_agent(name), "stream"):
+            return consumers
+        for other in pending:
+            stage = self.stages[other]
+            if stage.inputs == {"pages": name} and not stage.after and stage.foreach is None \
+                    and getattr(self.get_agent(other), "stream_pages", False) and not self.checkpoint.has(other):
+                consumers.append(other)
+        return consumers
+
+    def run(self, results: Dict = None):
+        manager = mp.Manager()
+        return_dict = manager.dict()
+        error_dict = manager.dict()
+        graph = StageGraph(self.stages, self.story_dir, self.checkpoint, results)
+        # structured outcome of every stage, also written to `story_dir/status.json`
+        self.status = graph.status
+        running = {}
+        # error of every task process killed at its timeout
+        timed_out = {}
+        # stage processes waiting for memory, in the order they asked for it
+        waiting = []
+        # connection of every running stage process with a footprint, until it is admitted
+        connections = {}
+        reserved = set()
+
+        def task_key(name, page):
+            return name if page is None else f"{name}[{page}]"
+
+        def launch(name, page, target, args):
+            stage = self.stages[name]
+            footprint = get_footprint(self.get_agent(name), stage.tool_cfg, stage.memory)
+            connection = child_connection = None
+            if self.memory_budget is not None and any(footprint.values()):
+                connection, child_connection = mp.Pipe()
+            p = mp.Process(target=target, args=args + (child_connection,))
+            p.start()
+            deadline = time.time() + stage.timeout if stage.timeout else None
+            running[p.sentinel] = (name, page, footprint, p, deadline)
+            if connection is not None:
+                connections[p.sentinel] = connection
+            emit("stage_start", stage=name, task=task_key(name, page))
+
+        def admit():
+            for sentinel, requested in list(waiting):
+                name, page, footprint, p, deadline = running[sentinel]
+                if not self.memory_budget.fits(footprint):
+                    continue
+                self.memory_budget.acquire(footprint)
+                waiting.remove((sentinel, requested))
+                reserved.add(sentinel)
+                connections.pop(sentinel).send("admitted")
+                if deadline is not None:
+                    # the timeout does not count the time spent waiting for memory
+                    running[sentinel] = (name, page, footprint, p, deadline + time.time() - requested)
+
+        def release(sentinel):
+            connections.pop(sentinel, None)
+            for request in [request for request in waiting if request[0] == sentinel]:
+                waiting.remove(request)
+            if sentinel in reserved:
+                reserved.remove(sentinel)
+                self.memory_budget.release(running[sentinel][2])
+
+        def cancel_all(reason):
+            # fail fast: nothing else is needed once a required stage has failed
+            for sentinel, (name, page, footprint, p, deadline) in list(running.items()):
+                p.terminate()
+                p.join()
+                release(sentinel)
+                running.pop(sentinel)
+                print(f"Cancel stage {task_key(name, page)} since {reason}")
+                graph.finish_task(name, page, error=reason, status="cancelled")
+            graph.skip_pending(reason)
+
+        while True:
+            for name, params in graph.ready():
+                agent = self.get_agent(name)
+                consumers = []
+                if self.stages[name].foreach is None:
+                    consumers = self.stream_consumers(name, graph.pending)
+                if consumers:
+                    streams = []
+                    for consumer in consumers:
+                        graph.stream(consumer, name)
+                        stream = PageStream(mp.Queue())
+                        streams.append(stream)
+                        consumer_params = self.stages[consumer].build_params({name: stream}, self.story_dir)
+                        consumer_params["checkpoint"] = self.checkpoint.child(consumer)
+                        launch(consumer, None, run_stage,
+                               (consumer, self.get_agent(consumer), consumer_params, return_dict, error_dict))
+                    graph.tasks(name, params)
+                    launch(name, None, run_streaming_stage, (name, agent, params, streams, return_dict, error_dict))
+                    continue
+                for page, task_params in graph.tasks(name, params):
+                    launch(name, page, run_stage, (task_key(name, page), agent, task_params, return_dict, error_dict))
+
+            admit()
+            if not running:
+                break
+
+            waiting_sentinels = {sentinel for sentinel, _ in waiting}
+            deadlines = [deadline for sentinel, (*_, deadline) in running.items()
+                         if deadline is not None and sentinel not in waiting_sentinels]
+            timeout = max(min(deadlines) - time.time(), 0) if deadlines else None
+            requesting = {connection: sentinel for sentinel, connection in connections.items()
+                          if sentinel not in waiting_sentinels}
+            ready = wait(list(running.keys()) + list(requesting.keys()), timeout=timeout)
+            finished = [sentinel for sentinel in ready if sentinel in running]
+            for connection in ready:
+                if connection in requesting:
+                    try:
+                        connection.recv()
+                        waiting.append((requesting[connection], time.time()))
+                    except EOFError:
+                        # the process exited, its sentinel is ready as well
+                        pass
+            waiting_sentinels = {sentinel for sentinel, _ in waiting}
+            for sentinel, (name, page, footprint, p, deadline) in list(running.items()):
+                if sentinel in waiting_sentinels:
+                    continue
+                if sentinel not in finished and deadline is not None and time.time() >= deadline:
+                    key = task_key(name, page)
+                    print(f"Stage {key} exceeded its timeout of {self.stages[name].timeout} s")
+                    p.terminate()
+                    timed_out[sentinel] = f"{key} exceeded the timeout of {self.stages[name].timeout} s"
+                    finished.append(sentinel)
+
+            for sentinel in finished:
+                if sentinel not in running:
+                    # cancelled
+                    continue
+                p = running[sentinel][3]
+                p.join()
+                release(sentinel)
+                name, page, footprint, p, deadline = running.pop(sentinel)
+                key = task_key(name, page)
+                if sentinel in timed_out:
+                    required_failed = graph.finish_task(name, page, error=timed_out.pop(sentinel), status="timeout")
+                elif key in return_dict:
+                    required_failed = graph.finish_task(name, page, return_dict[key])
+                else:
+                    if name not in graph.failed:
+                        print(f"Stage {key} failed with exit code {p.exitcode}")
+                    required_failed = graph.finish_task(
+                        name, page, error=error_dict.get(key, f"exit code {p.exitcode}"))
+                if required_failed:
+                    cancel_all(f"required stage {name} failed")
+                    break
+
+        save_status(self.story_dir, graph.status)
+        return graph.results
@@ -0,0 +1,158 @@
+import os
+import copy
+import json
+import queue
+import threading
+import uuid
+from pathlib import Path
+from typing import Dict
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from socketserver import ThreadingUnixStreamServer
+
+from .base import TOOL_REGISTRY
+from .batch import BatchStoryRunner, set_story_dir
+from .mm_story_agent import MMStoryAgent
+from .scheduler import Stage
+from .utils.memory_budget import MemoryBudget
+
+
+class StoryServer:
+    """
+    A long-running `BatchStoryRunner` that accepts story jobs over HTTP, on a Unix socket or a
+    localhost port. Its stage workers stay alive between jobs, so every model is loaded by the
+    first job that needs it and later jobs only pay for inference.
+
+    POST /jobs             {"story_topic": ..., "main_role": ..., "scene": ..., "story_dir": ...}
+                           fills the template config (or {"config": {...}} replaces it), returns
+                           {"job_id": ...}; with ?wait=1 it returns the finished job instead.
+                           A config whose stages or tools are unknown is answered with 400.
+    GET  /jobs/<job_id>    {"state": "running" | "finished" | "failed", "story_dir": ..., "failed": [...],
+                           "status": {...}, "assets": {modality: [asset handle, ...]}}; a job that
+                           could not be started is "failed" with its "error"
+    """
+
+    def __init__(self,
+                 config: Dict,
+                 socket_path: str = None,
+                 host: str = "127.0.0.1",
+                 port: int = 8765) -> None:
+        self.config = config
+        self.socket_path = socket_path
+        self.address = (host, port)
+        self.incoming = queue.Queue()
+        self.jobs = {}
+        self.lock = threading.Lock()
+
+    def make_config(self, job_id: str, request: Dict):
+        if "config" in request:
+            config = copy.deepcopy(request["config"])
+        else:
+            config = copy.deepcopy(self.config)
+            for key in ("story_topic", "main_role", "scene"):
+                if key in request:
+                    config["story_writer"]["params"][key] = request[key]
+        story_dir = request.get("story_dir", Path(self.config["story_dir"]) / job_id)
+        return set_story_dir(config, story_dir)
+
+    def check_config(self, config: Dict):
+        # raised here, the error is returned to the client instead of failing in the runner
+        try:
+            stages = {name: Stage(name, stage_cfg)
+                      for name, stage_cfg in MMStoryAgent().build_stages(config).items()}
+        except KeyError as e:
+            raise ValueError(f"missing config entry {e}")
+        for name, stage in stages.items():
+            if stage.tool_cfg["tool"] not in TOOL_REGISTRY:
+                raise ValueError(f"unknown tool {stage.tool_cfg['tool']} of stage {name}")
+            unknown = stage.dependencies - stages.keys()
+            if unknown:
+                raise ValueError(f"stage {name} depends on unknown stages {sorted(unknown)}")
+
+    def submit(self, request: Dict):
+        job_id = uuid.uuid4().hex[:12]
+        config = self.make_config(job_id, request)
+        self.check_config(config)
+        job = {"state": "running", "story_dir": config["story_dir"], "done": threading.Event()}
+        with self.lock:
+            self.jobs[job_id] = job
+
+        def on_finished(result):
+            job.update(result, state="failed" if "error" in result else "finished")
+            job["done"].set()
+
+        self.incoming.put((config, on_finished))
+        return job_id
+
+    def get_job(self, job_id: str, wait: bool = False):
+        with self.lock:
+            job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        if wait:
+            job["done"].wait()
+        return {key: value for key, value in job.items() if key != "done"}
+
+    def make_handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+
+            def reply(self, code, body):
+                data = json.dumps(body, ensure_ascii=False, default=str).encode("utf-8")
+                self.send_response(code)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(data)))
+                self.end_headers()
+                self.wfile.write(data)
+
+            def do_POST(self):
+                path, _, query = self.path.partition("?")
+                if path.rstrip("/") != "/jobs":
+                    return self.reply(404, {"error": f"unknown path {path}"})
+                try:
+                    length = int(self.headers.get("Content-Length", 0))
+                    request = json.loads(self.rfile.read(length) or b"{}")
+                    job_id = server.submit(request)
+                except Exception as e:
+                    return self.reply(400, {"error": str(e)})
+                if "wait=1" in query.split("&"):
+                    return self.reply(200, {"job_id": job_id, **server.get_job(job_id, wait=True)})
+                self.reply(202, {"job_id": job_id})
+
+            def do_GET(self):
+                path, _, query = self.path.partition("?")
+                parts = path.strip("/").split("/")
+                if len(parts) != 2 or parts[0] != "jobs":
+                    return self.reply(404, {"error": f"unknown path {path}"})
+                job = server.get_job(parts[1], wait="wait=1" in query.split("&"))
+                if job is None:
+                    return self.reply(404, {"error": f"unknown job {parts[1]}"})
+                self.reply(200, {"job_id": parts[1], **job})
+
+            def log_message(self, format, *args):
+                # the client address of a Unix socket is empty
+                print(f"[server] {format % args}")
+
+        return Handler
+
+    def serve(self):
+        if self.socket_path is not None:
+            if os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
+            http_server = ThreadingUnixStreamServer(self.socket_path, self.make_handler())
+            print(f"Serving story jobs on unix socket {self.socket_path}")
+        else:
+            http_server = ThreadingHTTPServer(self.address, self.make_handler())
+            print(f"Serving story jobs on http://{self.address[0]}:{self.address[1]}")
+        threading.Thread(target=http_server.serve_forever, daemon=True).start()
+        runner = BatchStoryRunner([], MemoryBudget.from_config(self.config.get("memory_budget")))
+        try:
+            # stage workers run in processes spawned from this (main) thread
+            runner.run(self.incoming)
+        except KeyboardInterrupt:
+            pass
+        finally:
+            http_server.shutdown()
+            http_server.server_close()
+            if self.socket_path is not None and os.path.exists(self.socket_path):
+                os.unlink(self.socket_path)
@@ -0,0 +1,49 @@
+import hashlib
+from pathlib import Path
+from typing import Union
+
+import soundfile as sf
+from PIL import Image
+
+from .asset_bus import asset_info
+
+
+def file_checksum(path: Union[str, Path]):
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as reader:
+        for chunk in iter(lambda: reader.read(1 << 20), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def make_asset_handle(path: Union[str, Path]):
+    """
+    Lightweight description of a generated asset file that is passed between processes
+    instead of the decoded image / audio. Only headers are read to get the shape:
+    (height, width) for images, (frames, channels) for audio, none for videos.
+    """
+    path = Path(path)
+    if not path.exists():
+        # only published to the asset bus (`save_files: false`)
+        info = asset_info(path)
+        if info is None:
+            raise FileNotFoundError(path)
+        return {
+            "path": str(path),
+            "shape": info["shape"],
+            "checksum": None,
+            "in_memory": True,
+        }
+    if path.suffix in (".wav", ".mp3", ".flac"):
+        info = sf.info(str(path))
+        shape = [info.frames, info.channels]
+    elif path.suffix == ".mp4":
+        shape = None
+    else:
+        with Image.open(path) as image:
+            shape = [image.height, image.width]
+    return {
+        "path": str(path),
+        "shape": shape,
+        "checksum": file_checksum(path),
+    }
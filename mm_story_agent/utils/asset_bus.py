@@ -0,0 +1,113 @@
+import json
+import struct
+import hashlib
+from pathlib import Path
+from typing import Dict, Union
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+import soundfile as sf
+
+# Decoded assets (image pixels, audio samples) are published to shared memory under the path
+# their file has (or would have), so the video composer can use them without decoding the file
+# again. A block is an 8-byte header length, a json header ({"dtype", "shape", "meta"}) and the
+# array data at HEADER_SIZE. Blocks outlive the producing stage process and are released when
+# the story is finished; their names are appended to BLOCK_LIST in the story directory.
+HEADER_SIZE = 4096
+PREFIX = "mmsa_"
+BLOCK_LIST = "asset_blocks.txt"
+
+
+def short_hash(text: str):
+    return hashlib.sha1(text.encode("utf-8")).hexdigest()[:12]
+
+
+def block_name(path: Union[str, Path]):
+    # assets are saved as story_dir/<modality>/<file>, blocks of a story share a prefix
+    path = Path(path).absolute()
+    return f"{PREFIX}{short_hash(str(path.parent.parent))}_{short_hash(str(path))}"
+
+
+def unlink_block(name: str):
+    try:
+        shared_memory.SharedMemory(name=name).unlink()
+    except FileNotFoundError:
+        pass
+
+
+def publish(path: Union[str, Path], array: np.ndarray, **meta):
+    array = np.ascontiguousarray(array)
+    header = json.dumps({"dtype": array.dtype.str, "shape": list(array.shape), "meta": meta}).encode("utf-8")
+    name = block_name(path)
+    # a block left over from an earlier run of the same story
+    unlink_block(name)
+    block = shared_memory.SharedMemory(name=name, create=True, size=HEADER_SIZE + max(array.nbytes, 1))
+    # the block must not be removed when this (stage) process exits
+    resource_tracker.unregister(block._name, "shared_memory")
+    block.buf[:8] = struct.pack("!Q", len(header))
+    block.buf[8:8 + len(header)] = header
+    np.ndarray(array.shape, array.dtype, buffer=block.buf, offset=HEADER_SIZE)[...] = array
+    block.close()
+    # a single append of a short line, like the progress events of the stage processes
+    with open(Path(path).absolute().parent.parent / BLOCK_LIST, "a") as writer:
+        writer.write(name + "\n")
+
+
+def open_asset(path: Union[str, Path]):
+    """
+    Returns (block, array, meta) of a published asset, or None. The array is a view of the
+    shared memory, `block.close()` it once the array is no longer used.
+    """
+    try:
+        block = shared_memory.SharedMemory(name=block_name(path))
+    except FileNotFoundError:
+        return None
+    resource_tracker.unregister(block._name, "shared_memory")
+    size, = struct.unpack("!Q", bytes(block.buf[:8]))
+    header = json.loads(bytes(block.buf[8:8 + size]))
+    array = np.ndarray(header["shape"], np.dtype(header["dtype"]), buffer=block.buf, offset=HEADER_SIZE)
+    return block, array, header["meta"]
+
+
+def asset_info(path: Union[str, Path]):
+    opened = open_asset(path)
+    if opened is None:
+        return None
+    block, array, meta = opened
+    info = {"shape": list(array.shape), "meta": meta}
+    del array
+    block.close()
+    return info
+
+
+def release_story_assets(story_dir: Union[str, Path]):
+    # removes every block published for the story
+    block_list = Path(story_dir) / BLOCK_LIST
+    if not block_list.exists():
+        return
+    for name in set(block_list.read_text().split()):
+        unlink_block(name)
+    block_list.unlink(missing_ok=True)
+
+
+class AssetPublisher:
+    """
+    Publishing settings of an agent, from its cfg: `asset_bus: true` publishes the decoded
+    assets, `save_files: false` additionally skips writing them to disk (for tools that
+    produce the arrays in-process; such assets are then neither cached nor checkpointed).
+    """
+
+    def __init__(self, cfg: Dict) -> None:
+        self.enabled = bool(cfg.get("asset_bus", False))
+        self.save_files = cfg.get("save_files", True) or not self.enabled
+
+    def publish(self, path: Union[str, Path], array: np.ndarray, **meta):
+        if self.enabled:
+            publish(path, array, **meta)
+
+    def publish_audio_file(self, path: Union[str, Path]):
+        # for tools whose output is a file (TTS service, MusicGen), decoded once here
+        # instead of in the composer
+        if self.enabled:
+            audio, sample_rate = sf.read(str(path), dtype="float32")
+            publish(path, audio, sample_rate=sample_rate)
@@ -0,0 +1,105 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+from pathlib import Path
+from typing import Dict, Union
+
+# one instance per cache of a process, so that its size is counted once per worker
+_instances = {}
+
+
+class AssetCache:
+    """
+    Content-addressed store of generated assets (png / wav), keyed by a hash of everything
+    that determines the output (tool, model, prompt, generation params, seed). Files are
+    written atomically so that several modality processes can share one cache directory.
+    The least recently used files are evicted when the cache grows over `max_size_gb`; the
+    size is counted once and then kept up to date by `save`, so the directory is only scanned
+    again when it is over the limit (files saved by other processes are found by that scan).
+    """
+
+    def __init__(self,
+                 cache_dir: Union[str, Path] = ".cache/assets",
+                 max_size_gb: float = 10.0) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(exist_ok=True, parents=True)
+        self.max_size = int(max_size_gb * 1024 ** 3)
+        # total size of the cached files, counted on the first `save`
+        self.size = None
+
+    @classmethod
+    def from_config(cls, cfg: Dict = None):
+        # `cache` block of an agent's `cfg`, no cache if it is not configured
+        if not cfg:
+            return None
+        key = json.dumps(cfg, sort_keys=True, default=str)
+        if key not in _instances:
+            _instances[key] = cls(**cfg)
+        return _instances[key]
+
+    def make_key(self, **fields):
+        content = json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def get_path(self, key: str, suffix: str):
+        return self.cache_dir / key[:2] / f"{key}{suffix}"
+
+    def load(self, key: str, save_path: Union[str, Path]):
+        save_path = Path(save_path)
+        cache_path = self.get_path(key, save_path.suffix)
+        try:
+            shutil.copyfile(cache_path, save_path)
+            # mark as recently used
+            os.utime(cache_path)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def save(self, key: str, file_path: Union[str, Path]):
+        file_path = Path(file_path)
+        cache_path = self.get_path(key, file_path.suffix)
+        cache_path.parent.mkdir(exist_ok=True)
+        if self.size is None:
+            self.size = self.scan()[1]
+        try:
+            # an entry of the same key is replaced
+            self.size -= cache_path.stat().st_size
+        except FileNotFoundError:
+            pass
+        fd, tmp_path = tempfile.mkstemp(dir=cache_path.parent, suffix=".tmp")
+        os.close(fd)
+        shutil.copyfile(file_path, tmp_path)
+        os.replace(tmp_path, cache_path)
+        self.size += cache_path.stat().st_size
+        if self.size > self.max_size:
+            self.evict()
+
+    def scan(self):
+        # (entries as (mtime, size, path), total size)
+        entries = []
+        total_size = 0
+        for path in self.cache_dir.glob("*/*"):
+            if path.suffix == ".tmp":
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, path))
+            total_size += stat.st_size
+        return entries, total_size
+
+    def evict(self):
+        entries, total_size = self.scan()
+        entries.sort()
+        for _, size, path in entries:
+            if total_size <= self.max_size:
+                break
+            try:
+                path.unlink()
+            except FileNotFoundError:
+                pass
+            total_size -= size
+        self.size = total_size
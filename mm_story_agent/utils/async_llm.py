@@ -0,0 +1,106 @@
+import os
+import asyncio
+from typing import Callable, Iterable, List
+
+# at most this many LLM requests of a process are in flight on the pooled client
+MAX_CONNECTIONS_ENV = "MM_STORY_AGENT_LLM_CONNECTIONS"
+_sessions = {}
+
+
+def get_session():
+    """
+    The pooled HTTP client of the running event loop, shared by all LLM agents of the process,
+    so that connections are reused across requests and their number is bounded.
+    """
+    # only the LLM agents that call an HTTP API need aiohttp (a dependency of dashscope)
+    import aiohttp
+
+    loop = asyncio.get_running_loop()
+    session = _sessions.get(loop)
+    if session is None or session.closed:
+        session = aiohttp.ClientSession(
+            connector=aiohttp.TCPConnector(limit=int(os.environ.get(MAX_CONNECTIONS_ENV, 32))),
+            timeout=aiohttp.ClientTimeout(total=300)
+        )
+        _sessions[loop] = session
+    return session
+
+
+async def close_session():
+    session = _sessions.pop(asyncio.get_running_loop(), None)
+    if session is not None:
+        await session.close()
+
+
+async def acall_llm(llm, prompt: str, **kwargs):
+    # LLM tools without `acall` (e.g., registered by users) block the event loop, so their
+    # requests still run one at a time
+    if hasattr(llm, "acall"):
+        return await llm.acall(prompt, **kwargs)
+    return llm.call(prompt, **kwargs)
+
+
+def run_concurrently(coroutine_fns: List[Callable], concurrency: int = 1):
+    """
+    Runs `coroutine_fn()` for each of `coroutine_fns` (e.g., the prompt revision of each page)
+    with at most `concurrency` of them in flight, and returns their results in order.
+    Called from synchronous code; the pooled client is closed at the end.
+    """
+    async def main():
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+        async def run(coroutine_fn):
+            async with semaphore:
+                return await coroutine_fn()
+
+        try:
+            return await asyncio.gather(*(run(coroutine_fn) for coroutine_fn in coroutine_fns))
+        finally:
+            await close_session()
+
+    return asyncio.run(main())
+
+
+def run_streamed(items: Iterable, coroutine_fn: Callable, concurrency: int = 1):
+    """
+    Runs `coroutine_fn(idx, item)` for each of `items` as soon as it arrives (e.g., the pages of
+    a `PageStream`, whose iteration blocks), with at most `concurrency` of them in flight, and
+    returns their results in order. The whole stream is served by one event loop, so the pooled
+    client is kept until the last item is done. `coroutine_fn` is called when its item arrives.
+    """
+    async def main():
+        loop = asyncio.get_running_loop()
+        semaphore = asyncio.Semaphore(max(concurrency, 1))
+        iterator = iter(items)
+        finished = object()
+        tasks = []
+
+        async def run(coroutine):
+            async with semaphore:
+                return await coroutine
+
+        try:
+            while True:
+                # the blocking iteration runs in a thread, the requests of earlier items go on meanwhile
+                item = await loop.run_in_executor(None, next, iterator, finished)
+                if item is finished:
+                    break
+                tasks.append(asyncio.ensure_future(run(coroutine_fn(len(tasks), item))))
+            return await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+            await close_session()
+
+    return asyncio.run(main())
+
+
+def call_llm_batch(llm, prompts: List[str], concurrency: int = 1, **kwargs):
+    # [(response, success)] of independent prompts: one request with `call_batch` (e.g., to a
+    # server with continuous batching), else up to `concurrency` requests at a time
+    if hasattr(llm, "call_batch"):
+        return llm.call_batch(prompts, **kwargs)
+    return run_concurrently(
+        [lambda prompt=prompt: acall_llm(llm, prompt, **kwargs) for prompt in prompts],
+        concurrency
+    )
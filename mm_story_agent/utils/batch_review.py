@@ -0,0 +1,120 @@
+import json
+import functools
+from typing import Callable, Dict, List
+
+from .async_llm import acall_llm, run_concurrently, run_streamed
+from .page_stream import pages_so_far
+from .llm_output_check import JsonStreamParser
+from ..prompts_en import batch_reviser_instruction, batch_reviewer_instruction
+
+
+def batch_system_prompts(reviser_system: str, reviewer_system: str):
+    # the per-page prompts, extended to several pages per request
+    return f"{reviser_system}\n\n{batch_reviser_instruction}", f"{reviewer_system}\n\n{batch_reviewer_instruction}"
+
+
+def map_chunks(pages: List, chunk_size: int, coroutine_fn: Callable, concurrency: int = 1):
+    """
+    `coroutine_fn(chunk, context)` for chunks of up to `chunk_size` [(idx, page)], returning a
+    result per page; the results of all pages are returned in order. The chunks of a complete
+    story run up to `concurrency` at a time, streamed pages are revised whenever a chunk is full.
+    """
+    if isinstance(pages, list):
+        indexed = list(enumerate(pages))
+        chunks = [indexed[start:start + chunk_size] for start in range(0, len(indexed), chunk_size)]
+        results = run_concurrently([functools.partial(coroutine_fn, chunk, pages) for chunk in chunks],
+                                   concurrency)
+        return [result for chunk_results in results for result in chunk_results]
+
+    def stream_chunks():
+        chunk = []
+        for idx, page in enumerate(pages):
+            chunk.append((idx, page))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+    results = run_streamed(stream_chunks(), lambda _, chunk: coroutine_fn(chunk, pages_so_far(pages)), concurrency)
+    return [result for chunk_results in results for result in chunk_results]
+
+
+class BatchedReview:
+    """
+    Revise / review turns over several pages: one reviser request returns the results of all
+    pending pages as json ({"page number": result}), one reviewer request the verdict of each,
+    and only the pages that fail review are sent again. The LLMs are set up with the prompts of
+    `batch_system_prompts`. `result_key` is the field of the reviewer input holding the result,
+    `check_result(result)` checks the type of a result and `clean_result` post-processes it.
+    Pages whose batched output is never usable are left out of the results, for the caller to
+    revise them on their own.
+    """
+
+    def __init__(self,
+                 reviser,
+                 reviewer,
+                 num_turns: int = 3,
+                 result_key: str = "result",
+                 check_result: Callable = None,
+                 clean_result: Callable = None) -> None:
+        self.reviser = reviser
+        self.reviewer = reviewer
+        self.num_turns = num_turns
+        self.result_key = result_key
+        self.check_result = check_result or (lambda result: isinstance(result, str))
+        self.clean_result = clean_result or (lambda result: result)
+
+    async def request(self, llm, shared: Dict, page_inputs: Dict, check_value: Callable):
+        # one request for all `page_inputs` ({page number: fields}), returns {page number: value},
+        # empty if the output never matched
+        if not page_inputs:
+            return {}
+        keys = {str(page) for page in page_inputs}
+        parser = JsonStreamParser(check_fn=lambda output: keys <= output.keys() and
+                                  all(check_value(output[key]) for key in keys))
+        response, success = await acall_llm(llm, json.dumps({
+            "shared": shared,
+            "pages": {str(page): fields for page, fields in page_inputs.items()},
+        }, ensure_ascii=False), success_check_fn=parser.accepts)
+        if not success or not isinstance(response, str):
+            return {}
+        parser.feed(response)
+        if not parser.close():
+            return {}
+        output = parser.elements[0]
+        return {page: output[str(page)] for page in page_inputs}
+
+    async def revise(self, shared: Dict, pages: Dict, results: Dict = None, reviews: Dict = None):
+        # one reviser request for `pages` ({page number: fields}), with their previous results and reviews
+        results = results or {}
+        reviews = reviews or {}
+        revised = await self.request(self.reviser, shared, {
+            page: dict(fields, previous_result=results.get(page, ""), improvement_suggestions=reviews.get(page, ""))
+            for page, fields in pages.items()
+        }, self.check_result)
+        return {page: self.clean_result(result) for page, result in revised.items()}
+
+    async def run(self, shared: Dict, pages: Dict, drafts: Dict = None, on_draft: Callable = None):
+        # returns {page number: result}; with `drafts`, the first turn reviews them instead of
+        # revising. `on_draft(page, result)` is called with each result before it is reviewed.
+        results = dict(drafts or {})
+        reviews = {}
+        pending = list(pages)
+        for turn in range(self.num_turns):
+            if turn > 0 or drafts is None:
+                revised = await self.revise(shared, {page: pages[page] for page in pending}, results, reviews)
+                for page, result in revised.items():
+                    results[page] = result
+                    if on_draft is not None:
+                        on_draft(page, result)
+            verdicts = await self.request(self.reviewer, shared, {
+                page: dict(pages[page], **{self.result_key: results[page]})
+                for page in pending if page in results
+            }, lambda verdict: isinstance(verdict, str))
+            pending = [page for page in pending if verdicts.get(page) != "Check passed."]
+            if not pending:
+                break
+            for page in pending:
+                reviews[page] = verdicts.get(page, "")
+        return results
@@ -0,0 +1,29 @@
+import json
+import traceback
+from typing import Callable, Dict, List
+
+
+def run_in_batches(requests: List[Dict],
+                   batch_size: int,
+                   generate_fn: Callable,
+                   group_key: str = "generation_params"):
+    """
+    Runs pending generation requests, possibly of several stories, as batches of at most
+    `batch_size` (all at once if None). Only requests with the same `request[group_key]`
+    share a batch. `generate_fn(batch)` generates and saves the assets of one batch; if it
+    raises, the traceback is stored in `request["error"]` of every request of that batch.
+    """
+    groups = {}
+    for request in requests:
+        key = json.dumps(request.get(group_key), sort_keys=True, default=str)
+        groups.setdefault(key, []).append(request)
+    for group in groups.values():
+        size = batch_size or len(group)
+        for start in range(0, len(group), size):
+            batch = group[start:start + size]
+            try:
+                generate_fn(batch)
+            except Exception:
+                error = traceback.format_exc()
+                for request in batch:
+                    request["error"] = error
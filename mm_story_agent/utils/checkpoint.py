@@ -0,0 +1,125 @@
+import os
+import json
+import hashlib
+import tempfile
+from pathlib import Path
+from typing import Callable, List, Union
+
+
+def output_files(output):
+    """
+    Paths of the asset handles (dicts with a `path`) in a stage output, or None if an asset
+    only lives in shared memory (`save_files: false`): its block is gone on the next run.
+    """
+    files = []
+
+    def collect(value):
+        if isinstance(value, dict):
+            if value.get("in_memory"):
+                return False
+            if isinstance(value.get("path"), str):
+                files.append(value["path"])
+            return all(collect(item) for item in value.values())
+        if isinstance(value, (list, tuple)):
+            return all(collect(item) for item in value)
+        return True
+
+    return files if collect(output) else None
+
+
+class StageCheckpoint:
+    """
+    Persists the outputs of pipeline steps under `story_dir/checkpoints`. Each output is
+    stored in `<name>.json` together with a hash of the inputs it was computed from, the
+    file itself is the completion marker. Outputs are always written; with `resume`,
+    a step whose inputs are unchanged (and whose output files still exist) is skipped.
+    """
+
+    def __init__(self,
+                 checkpoint_dir: Union[str, Path],
+                 resume: bool = False) -> None:
+        self.checkpoint_dir = Path(checkpoint_dir)
+        self.resume = resume
+
+    def child(self, name: str):
+        return StageCheckpoint(self.checkpoint_dir / name, self.resume)
+
+    def hash_inputs(self, inputs):
+        content = json.dumps(inputs, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def load(self, name: str, inputs, files: List = None):
+        # returns (found, output)
+        if not self.resume:
+            return False, None
+        try:
+            with open(self.checkpoint_dir / f"{name}.json", "r") as reader:
+                checkpoint = json.load(reader)
+        except (FileNotFoundError, json.JSONDecodeError):
+            return False, None
+        if checkpoint["inputs_hash"] != self.hash_inputs(inputs):
+            return False, None
+        if files is not None and not all(Path(file).exists() for file in files):
+            return False, None
+        return True, checkpoint["output"]
+
+    def save(self, name: str, inputs, output):
+        try:
+            content = json.dumps({
+                "inputs_hash": self.hash_inputs(inputs),
+                "output": output
+            }, ensure_ascii=False, indent=4)
+        except TypeError as e:
+            print(f"Skip checkpoint {name} since its output is not serializable: {e}")
+            return
+        self.checkpoint_dir.mkdir(exist_ok=True, parents=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.checkpoint_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as writer:
+            writer.write(content)
+        os.replace(tmp_path, self.checkpoint_dir / f"{name}.json")
+
+    def has(self, name: str):
+        # whether a resumed run may find an output of `name`, before its inputs are known
+        return self.resume and (self.checkpoint_dir / f"{name}.json").exists()
+
+    def load_output(self, name: str, inputs):
+        # `load` of a stage output, found only if the files of its asset handles still exist
+        found, output = self.load(name, inputs)
+        if not found:
+            return False, None
+        files = output_files(output)
+        if files is None or not all(Path(file).exists() for file in files):
+            return False, None
+        return True, output
+
+    def save_output(self, name: str, inputs, output):
+        if output_files(output) is None:
+            print(f"Skip checkpoint {name} since its assets are only in shared memory")
+            return
+        self.save(name, inputs, output)
+
+    def run(self, name: str, inputs, fn: Callable, files: List = None):
+        found, output = self.load(name, inputs, files)
+        if found:
+            return output
+        output = fn()
+        self.save(name, inputs, output)
+        return output
+
+
+def checkpointed(checkpoint: StageCheckpoint, name: str, inputs, fn: Callable, files: List = None):
+    if checkpoint is None:
+        return fn()
+    return checkpoint.run(name, inputs, fn, files)
+
+
+async def acheckpointed(checkpoint: StageCheckpoint, name: str, inputs, coroutine_fn: Callable, files: List = None):
+    # `checkpointed` for a coroutine function
+    if checkpoint is None:
+        return await coroutine_fn()
+    found, output = checkpoint.load(name, inputs, files)
+    if found:
+        return output
+    output = await coroutine_fn()
+    checkpoint.save(name, inputs, output)
+    return output
@@ -0,0 +1,78 @@
+import re
+from typing import Dict, List
+
+# CJK characters are about one token each in Qwen's tokenizer, other text about 4 characters per token
+CJK = re.compile(r"[\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uff00-\uffef]")
+# role markers of a message in the chat format
+MESSAGE_OVERHEAD = 4
+SUMMARY_HEADER = "Summary of the earlier conversation:"
+
+
+def estimate_tokens(text: str):
+    cjk = len(CJK.findall(text))
+    return cjk + (len(text) - cjk + 3) // 4
+
+
+def usage_tokens(usage):
+    # (input, output) tokens of the `usage` of a response (dashscope object or json), or Nones
+    if not usage:
+        return None, None
+    if not isinstance(usage, dict):
+        usage = {key: getattr(usage, key, None) for key in ("input_tokens", "output_tokens")}
+    return usage.get("input_tokens"), usage.get("output_tokens")
+
+
+class ContextBudget:
+    """
+    Keeps the messages sent to an LLM within `max_tokens`, including the `reserve` for the
+    answer. Tokens are estimated from the text, scaled by the ratio of the counts the provider
+    reported (`observe`) to the estimates. The system message and the last message (the prompt)
+    are always kept; when they do not fit with the rest, `split` returns the oldest turns to
+    drop, which `strategy: summarize` replaces by a summary in the system message.
+    """
+
+    def __init__(self,
+                 max_tokens: int = 30000,
+                 strategy: str = "trim") -> None:
+        assert strategy in ("trim", "summarize"), f"unknown history strategy {strategy}"
+        self.max_tokens = max_tokens
+        self.strategy = strategy
+        self.ratio = 1.0
+
+    def estimate(self, messages: List[Dict]):
+        return sum(estimate_tokens(message["content"]) + MESSAGE_OVERHEAD for message in messages)
+
+    def count(self, messages: List[Dict]):
+        return round(self.estimate(messages) * self.ratio)
+
+    def observe(self, messages: List[Dict], input_tokens: int):
+        if input_tokens:
+            self.ratio = 0.5 * self.ratio + 0.5 * input_tokens / max(self.estimate(messages), 1)
+
+    def split(self, messages: List[Dict], reserve: int = 0):
+        # returns (dropped, kept) messages, the system message stays first in `kept`
+        head = messages[:1] if messages and messages[0]["role"] == "system" else []
+        turns = messages[len(head):]
+        budget = self.max_tokens - reserve
+        start = 0
+        # drop whole exchanges (user + assistant), so that the roles still alternate
+        while len(turns) - start > 1 and self.count(head + turns[start:]) > budget:
+            start += 2 if turns[start]["role"] == "user" and len(turns) - start > 2 else 1
+        if self.count(head + turns[start:]) > budget:
+            print(f"the prompt alone exceeds the context budget of {self.max_tokens} tokens")
+        return turns[:start], head + turns[start:]
+
+    def with_summary(self, messages: List[Dict], system_prompt: str, summary: str):
+        # `messages` with the system message of `system_prompt` and `summary`
+        content = f"{SUMMARY_HEADER}\n{summary}"
+        if system_prompt is not None:
+            content = f"{system_prompt}\n\n{content}"
+        if messages and messages[0]["role"] == "system":
+            messages = messages[1:]
+        return [{"role": "system", "content": content}] + messages
+
+    def transcript(self, dropped: List[Dict], summary: str = None):
+        # the input of the summarizer
+        lines = [f"{SUMMARY_HEADER}\n{summary}\n"] if summary else []
+        lines += [f"{message['role']}: {message['content']}" for message in dropped]
+        return "\n".join(lines)
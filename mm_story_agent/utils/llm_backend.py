@@ -0,0 +1,31 @@
+import os
+import json
+from typing import Dict
+
+# the `llm` block of the config ({"tool": ..., "cfg": {...}}) selects the LLM tool of the agents
+# whose cfg has no `llm`, and its settings (e.g., the `base_url` of `openai_compatible`); like
+# `llm_cache`, it reaches the LLM tools of every stage process as json in the environment
+LLM_BACKEND_ENV = "MM_STORY_AGENT_LLM"
+
+
+def set_llm_backend(cfg: Dict = None):
+    if cfg:
+        os.environ[LLM_BACKEND_ENV] = json.dumps(cfg)
+    else:
+        os.environ.pop(LLM_BACKEND_ENV, None)
+
+
+def llm_backend():
+    return json.loads(os.environ.get(LLM_BACKEND_ENV, "null")) or {}
+
+
+def default_llm():
+    return llm_backend().get("tool", "qwen")
+
+
+def llm_backend_cfg(tool: str):
+    # the settings of the `llm` block, if they are for `tool`
+    backend = llm_backend()
+    if backend.get("tool", "qwen") != tool:
+        return {}
+    return backend.get("cfg") or {}
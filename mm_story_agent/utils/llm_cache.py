@@ -0,0 +1,88 @@
+import os
+import json
+import time
+import hashlib
+import sqlite3
+from contextlib import closing
+from pathlib import Path
+from typing import Dict, Union
+
+# LLM tools are created by the agents with only `system_prompt` / `track_history`, so the
+# `llm_cache` block of the config reaches them (and the stage processes) as json in the environment
+LLM_CACHE_ENV = "MM_STORY_AGENT_LLM_CACHE"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    created REAL NOT NULL,
+    last_used REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_last_used ON responses (last_used);
+"""
+
+
+def set_llm_cache(cfg: Dict = None):
+    if cfg:
+        os.environ[LLM_CACHE_ENV] = json.dumps(cfg)
+    else:
+        os.environ.pop(LLM_CACHE_ENV, None)
+
+
+class LLMResponseCache:
+    """
+    Responses of LLM requests that passed their success check, keyed by a hash of the request
+    (model, messages, sampling params and seed), so that rerunning a config does not repeat
+    identical requests. Stored in SQLite, shared by the stage processes and later runs.
+    Entries older than `ttl_hours` are not used, the least recently used entries are evicted
+    above `max_entries`.
+    """
+
+    def __init__(self,
+                 cache_path: Union[str, Path] = ".cache/llm_responses.sqlite",
+                 max_entries: int = 100000,
+                 ttl_hours: float = None) -> None:
+        self.cache_path = str(cache_path)
+        Path(self.cache_path).parent.mkdir(exist_ok=True, parents=True)
+        self.max_entries = max_entries
+        self.ttl = ttl_hours * 3600 if ttl_hours is not None else None
+        with self.connect() as db:
+            db.execute("PRAGMA journal_mode=WAL")
+            db.executescript(SCHEMA)
+
+    @classmethod
+    def from_config(cls, cfg: Dict = None):
+        # the `cache` of an LLM tool's cfg, else the `llm_cache` of the pipeline config, else no cache
+        if cfg is None:
+            cfg = json.loads(os.environ.get(LLM_CACHE_ENV, "null"))
+        if not cfg:
+            return None
+        return cls(**cfg)
+
+    def connect(self):
+        # one connection per operation, agents are created in several threads and processes
+        return closing(sqlite3.connect(self.cache_path, timeout=60, isolation_level=None))
+
+    def make_key(self, **fields):
+        content = json.dumps(fields, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(content.encode("utf-8")).hexdigest()
+
+    def load(self, key: str):
+        now = time.time()
+        with self.connect() as db:
+            row = db.execute("SELECT response, created FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None or (self.ttl is not None and row[1] < now - self.ttl):
+                return None
+            db.execute("UPDATE responses SET last_used = ? WHERE key = ?", (now, key))
+        return row[0]
+
+    def save(self, key: str, response: str):
+        now = time.time()
+        with self.connect() as db:
+            db.execute("INSERT OR REPLACE INTO responses (key, response, created, last_used) VALUES (?, ?, ?, ?)",
+                       (key, response, now, now))
+            if self.ttl is not None:
+                db.execute("DELETE FROM responses WHERE created < ?", (now - self.ttl,))
+            db.execute("DELETE FROM responses WHERE key IN "
+                       "(SELECT key FROM responses ORDER BY last_used DESC LIMIT -1 OFFSET ?)",
+                       (self.max_entries,))
@@ -1,6 +1,266 @@
+import re
+import ast
+import copy
+import json
+from typing import Callable, Dict
+
+
 def parse_list(output):
     try:
         pages = eval(output)
         return isinstance(pages, list)
     except Exception:
-        return False
\ No newline at end of file
+        return False
+
+
+class StreamParser:
+    """
+    Incremental check of an LLM output while it is streamed. `feed(text)` returns the elements
+    completed by `text`; once the output can no longer be completed into the expected format,
+    `error` is set and the rest is ignored, so that the request can be aborted right away.
+    `done` is set when the format is complete (text after it is ignored), `close()` at the end
+    of the output returns `done`.
+
+    `elements` are the elements delivered over all attempts: after `reset()` (a retry), the
+    first `len(elements)` elements of the new output are skipped, since the consumers already
+    have them. A leading markdown fence (```json) is skipped.
+    """
+
+    def __init__(self) -> None:
+        self.elements = []
+        self.reset()
+
+    def reset(self):
+        self.text = ""
+        self.done = False
+        self.error = None
+        self.started = False
+        self.in_fence = False
+        self.count = 0
+        self.new = []
+
+    def feed(self, text: str):
+        self.new = []
+        for char in text:
+            if self.done or self.error is not None:
+                break
+            self.text += char
+            if not self.started:
+                if self.in_fence:
+                    self.in_fence = char != "\n"
+                    continue
+                if char.isspace():
+                    continue
+                if char == "`":
+                    self.in_fence = True
+                    continue
+                self.started = True
+            try:
+                self.step(char)
+            except (ValueError, SyntaxError) as e:
+                self.error = str(e) or repr(e)
+        return self.new
+
+    def close(self):
+        if not self.done and self.error is None:
+            self.error = "incomplete output"
+        return self.done
+
+    def accepts(self, text: str):
+        # whether the whole `text` is in the format, without delivering its elements
+        parser = copy.deepcopy(self)
+        parser.elements = []
+        parser.reset()
+        parser.feed(text)
+        return parser.close()
+
+    def emit(self, element):
+        self.count += 1
+        if self.count > len(self.elements):
+            self.elements.append(element)
+            self.new.append(element)
+
+    def off_schema(self, char: str):
+        raise ValueError(f"unexpected {char!r} after {self.text[-60:-1]!r}")
+
+    def step(self, char: str):
+        raise NotImplementedError
+
+
+class ListStreamParser(StreamParser):
+    """
+    A list of string literals, the format `parse_list` checks (pages of a chapter, sound
+    queries); every string is an element, delivered as soon as its closing quote arrives.
+    """
+
+    def reset(self):
+        super().reset()
+        self.state = "start"
+        self.quote = None
+        self.literal = ""
+        self.escape = False
+
+    def step(self, char: str):
+        if self.state == "string":
+            self.literal += char
+            if self.escape:
+                self.escape = False
+            elif char == "\\":
+                self.escape = True
+            elif char == self.quote:
+                element = ast.literal_eval(self.literal)
+                self.state = "comma_or_end"
+                self.emit(element)
+            return
+        if char.isspace():
+            return
+        if self.state == "start":
+            if char != "[":
+                self.off_schema(char)
+            self.state = "item_or_end"
+        elif self.state == "item_or_end" and char in "'\"":
+            self.state = "string"
+            self.quote = char
+            self.literal = char
+        elif char == "]":
+            self.done = True
+        elif self.state == "comma_or_end" and char == ",":
+            # python lists may end with a comma
+            self.state = "item_or_end"
+        else:
+            self.off_schema(char)
+
+
+# prefixes of json numbers
+NUMBER_PREFIX = re.compile(r"-?(0|[1-9]\d*)?(\.\d*)?([eE][+-]?\d*)?$")
+LITERAL_CHARS = set("0123456789+-.eEtruefalsn")
+
+
+class JsonStreamParser(StreamParser):
+    """
+    A json document whose root starts with `root`. `keys` maps the path of an object (keys from
+    the root, "*" for the items of an array) to the keys it may have, checked as soon as a key
+    is complete; the parsed document is the only element, delivered if `check_fn(document)`
+    passes (e.g., all required keys are there).
+    """
+
+    def __init__(self,
+                 keys: Dict = None,
+                 check_fn: Callable = None,
+                 root: str = "{") -> None:
+        self.keys = keys or {}
+        self.check_fn = check_fn
+        self.root = root
+        super().__init__()
+
+    def reset(self):
+        super().reset()
+        # [bracket, path, last key] of the open containers
+        self.stack = []
+        self.expect = "value"
+        self.token = None
+        self.escape = False
+        self.start = 0
+
+    def value_path(self):
+        if not self.stack:
+            return ()
+        bracket, path, key = self.stack[-1]
+        return path + (key if bracket == "{" else "*",)
+
+    def end_value(self):
+        self.expect = "comma_or_end"
+
+    def end_token(self):
+        kind, literal = self.token
+        self.token = None
+        value = json.loads(literal)
+        if kind == "key":
+            allowed = self.keys.get(self.stack[-1][1])
+            if allowed is not None and value not in allowed:
+                raise ValueError(f"unexpected key {value!r} in {self.text[-60:]!r}")
+            self.stack[-1][2] = value
+            self.expect = "colon"
+        else:
+            self.end_value()
+
+    def close_container(self):
+        self.stack.pop()
+        if self.stack:
+            self.end_value()
+            return
+        document = json.loads(self.text[self.start:])
+        if self.check_fn is not None and not self.check_fn(document):
+            raise ValueError(f"unexpected document {self.text[self.start:][:200]!r}")
+        self.done = True
+        self.emit(document)
+
+    def step(self, char: str):
+        if self.token is not None:
+            if self.token[0] != "literal":
+                self.token[1] += char
+                if self.escape:
+                    self.escape = False
+                elif char == "\\":
+                    self.escape = True
+                elif char == '"':
+                    self.end_token()
+                return
+            if char in LITERAL_CHARS:
+                literal = self.token[1] + char
+                if not (NUMBER_PREFIX.match(literal) or
+                        any(word.startswith(literal) for word in ("true", "false", "null"))):
+                    self.off_schema(char)
+                self.token[1] = literal
+                return
+            self.end_token()
+        if char.isspace():
+            return
+        expect = self.expect
+        if expect in ("value", "value_or_end"):
+            if char == "]" and expect == "value_or_end":
+                self.close_container()
+            elif not self.stack and char != self.root:
+                self.off_schema(char)
+            elif char in "{[":
+                if not self.stack:
+                    self.start = len(self.text) - 1
+                self.stack.append([char, self.value_path(), None])
+                self.expect = "key_or_end" if char == "{" else "value_or_end"
+            elif char == '"':
+                self.token = ["string", char]
+            elif char in "-0123456789tfn":
+                self.token = ["literal", char]
+            else:
+                self.off_schema(char)
+        elif expect in ("key", "key_or_end"):
+            if char == "}" and expect == "key_or_end":
+                self.close_container()
+            elif char == '"':
+                self.token = ["key", char]
+            else:
+                self.off_schema(char)
+        elif expect == "colon" and char == ":":
+            self.expect = "value"
+        elif expect == "comma_or_end" and char == ",":
+            self.expect = "key" if self.stack[-1][0] == "{" else "value"
+        elif expect == "comma_or_end" and char == {"{": "}", "[": "]"}[self.stack[-1][0]]:
+            self.close_container()
+        else:
+            self.off_schema(char)
+
+
+def stream_llm(llm, prompt: str, parser: StreamParser, **kwargs):
+    """
+    Yields the elements `parser` completes in the output of `llm` for `prompt`; the request
+    succeeded if `parser.done`. LLM tools without `stream` (e.g., registered by users) answer
+    at once, their output is parsed when it has arrived.
+    """
+    if hasattr(llm, "stream"):
+        yield from llm.stream(prompt, parser, **kwargs)
+        return
+    response, success = llm.call(prompt, success_check_fn=parser.accepts, **kwargs)
+    parser.reset()
+    if isinstance(response, str):
+        yield from parser.feed(response)
+    parser.close()
@@ -0,0 +1,144 @@
+import time
+import asyncio
+from contextlib import closing, nullcontext
+from typing import Callable, Dict
+
+from mm_story_agent.utils.tracing import span
+from mm_story_agent.utils.progress import emit
+from mm_story_agent.utils.llm_cache import LLMResponseCache
+from mm_story_agent.utils.llm_output_check import StreamParser
+from mm_story_agent.utils.rate_limit import RateLimiter, backoff_delay
+
+
+def load_cached(cache: LLMResponseCache, success_check_fn: Callable = None, **request):
+    # returns (cache key, cached response or None)
+    if cache is None:
+        return None, None
+    cache_key = cache.make_key(**request)
+    response = cache.load(cache_key)
+    if response is not None and (success_check_fn is None or success_check_fn(response)):
+        return cache_key, response
+    return cache_key, None
+
+
+class RetriedRequest:
+    """
+    The attempts of one LLM request, shared by the LLM tools, which only provide the transport.
+    A response of `cache` for `request` (the fields of the cache key) is used without attempts.
+    Each attempt takes a slot of `limiter` and is traced as `span_name`. A failed request
+    (throttled, server error) is retried after a backoff, an output that fails the check at
+    once. The accepted output is saved to the cache.
+    """
+
+    def __init__(self,
+                 span_name: str,
+                 model: str,
+                 max_try: int = 5,
+                 limiter: RateLimiter = None,
+                 cache: LLMResponseCache = None,
+                 request: Dict = None):
+        self.span_name = span_name
+        self.model = model
+        self.max_try = max_try
+        self.limiter = limiter
+        self.cache = cache
+        self.request = request or {}
+        self.cache_key = None
+
+    def slot(self):
+        return self.limiter.slot() if self.limiter is not None else nullcontext({})
+
+    def aslot(self):
+        return self.limiter.aslot() if self.limiter is not None else nullcontext({})
+
+    def span(self, attempt: int, **span_args):
+        return span(self.span_name, category="llm", unit="llm_request", model=self.model, attempt=attempt,
+                    **span_args)
+
+    def load(self, success_check_fn: Callable = None):
+        self.cache_key, response = load_cached(self.cache, success_check_fn, **self.request)
+        return response
+
+    def accept(self, text: str):
+        if self.cache_key is not None:
+            self.cache.save(self.cache_key, text)
+
+    def failed(self, attempt: int, throttled: bool, error=None):
+        # the delay before the next attempt, only a failed request (with `error`) backs off
+        emit("llm_retry", model=self.model, attempt=attempt + 1, max_try=self.max_try, throttled=throttled)
+        if error is None:
+            return 0.0
+        print(error)
+        return backoff_delay(attempt) if attempt + 1 < self.max_try else 0.0
+
+    def call(self, send: Callable, read: Callable, success_check_fn: Callable = None):
+        """
+        `send()` makes an attempt and returns its reply, `read(reply)` the (text, throttled) of it.
+        Returns (text, True) for the first text that passes `success_check_fn`, else
+        (the last reply, False).
+        """
+        response = self.load(success_check_fn)
+        if response is not None:
+            return response, True
+        for attempt in range(self.max_try):
+            with self.slot() as outcome:
+                with self.span(attempt):
+                    response = send()
+                text, throttled = read(response)
+                outcome["throttled"] = throttled
+            if text and (success_check_fn is None or success_check_fn(text)):
+                self.accept(text)
+                return text, True
+            time.sleep(self.failed(attempt, throttled, None if text else response))
+        return response, False
+
+    async def acall(self, send: Callable, read: Callable, success_check_fn: Callable = None):
+        # `call` with `send()` awaited, the requests of other coroutines go on meanwhile
+        response = self.load(success_check_fn)
+        if response is not None:
+            return response, True
+        for attempt in range(self.max_try):
+            async with self.aslot() as outcome:
+                with self.span(attempt):
+                    response = await send()
+                text, throttled = read(response)
+                outcome["throttled"] = throttled
+            if text and (success_check_fn is None or success_check_fn(text)):
+                self.accept(text)
+                return text, True
+            await asyncio.sleep(self.failed(attempt, throttled, None if text else response))
+        return response, False
+
+    def stream(self, deltas: Callable, parser: StreamParser, throttled_fn: Callable):
+        """
+        `deltas()` makes an attempt and yields the text of the streamed completion as it arrives,
+        or an error reply (not a string) and stops; `throttled_fn(error)` tells whether it was
+        throttled. Yields the elements `parser` completes, an attempt whose output goes
+        off-schema is aborted there. The request succeeded if `parser.done`.
+        """
+        response = self.load(parser.accepts)
+        if response is not None:
+            parser.reset()
+            yield from parser.feed(response)
+            if parser.close():
+                return
+        for attempt in range(self.max_try):
+            parser.reset()
+            error = None
+            with self.slot() as outcome:
+                with self.span(attempt, stream=True), closing(deltas()) as chunks:
+                    for delta in chunks:
+                        if not isinstance(delta, str):
+                            error = delta
+                            break
+                        yield from parser.feed(delta)
+                        if parser.done or parser.error is not None:
+                            # leaving the stream closes the connection, generation stops
+                            break
+                outcome["throttled"] = error is not None and throttled_fn(error)
+            if error is None and parser.close():
+                self.accept(parser.text)
+                return
+            if error is None:
+                print(f"off-schema output: {parser.error}")
+            time.sleep(self.failed(attempt, outcome["throttled"], error))
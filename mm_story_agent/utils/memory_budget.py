@@ -0,0 +1,107 @@
+import os
+import threading
+from typing import Dict
+
+import torch
+
+MEMORY_KINDS = ("ram", "vram")
+
+# connection of a stage process to its scheduler, set when the scheduler enforces a memory budget
+_memory_connection = None
+_reserved = False
+_reserve_lock = threading.Lock()
+
+
+def detect_capacity():
+    # total host RAM and memory of the first GPU (where the models are loaded), in GB
+    capacity = {"ram": os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES") / 1024 ** 3, "vram": 0.0}
+    if torch.cuda.is_available():
+        capacity["vram"] = torch.cuda.get_device_properties(0).total_memory / 1024 ** 3
+    return capacity
+
+
+def get_footprint(agent, tool_cfg: Dict, memory: Dict = None):
+    """
+    Estimated peak memory (GB) of running a tool, from the `memory_footprint` the agent class
+    declares, overridden by the `memory` block of the stage. Models put on the cpu count as RAM.
+    """
+    footprint = dict(getattr(agent, "memory_footprint", {}))
+    footprint.update(memory or {})
+    footprint = {kind: float(footprint.get(kind, 0.0)) for kind in MEMORY_KINDS}
+    if (tool_cfg.get("cfg") or {}).get("device") == "cpu":
+        footprint["ram"] += footprint["vram"]
+        footprint["vram"] = 0.0
+    return footprint
+
+
+def set_memory_connection(connection):
+    global _memory_connection, _reserved
+    _memory_connection = connection
+    _reserved = False
+
+
+def reserve_memory():
+    """
+    Waits until the scheduler admits the memory footprint of this stage process. Agents that
+    load their models on demand (`reserves_memory = True`) call it right before loading them,
+    so their LLM prompt revision still runs alongside other stages; for the other agents it is
+    called before `call`. The footprint stays reserved until the process exits.
+    """
+    global _reserved
+    with _reserve_lock:
+        if _memory_connection is None or _reserved:
+            return
+        _memory_connection.send("reserve")
+        _memory_connection.recv()
+        _reserved = True
+
+
+def reserve_before_call(agent):
+    if not getattr(agent, "reserves_memory", False):
+        reserve_memory()
+
+
+class MemoryBudget:
+    """
+    Admission control of model-loading stages. A stage is admitted only if its footprint fits
+    into what is left of the budget; a stage larger than the whole budget is admitted once nothing
+    else holds memory, so it runs alone. `auto` limits are a `fraction` of the detected capacity,
+    a missing (or null) limit is not enforced.
+    """
+
+    def __init__(self,
+                 ram=None,
+                 vram=None,
+                 fraction: float = 0.9) -> None:
+        capacity = None
+        self.limits = {}
+        for kind, limit in zip(MEMORY_KINDS, (ram, vram)):
+            if limit == "auto":
+                if capacity is None:
+                    capacity = detect_capacity()
+                limit = capacity[kind] * fraction
+            self.limits[kind] = limit
+        self.in_use = {kind: 0.0 for kind in MEMORY_KINDS}
+
+    @classmethod
+    def from_config(cls, cfg: Dict = None):
+        # `memory_budget` block of the configuration, everything is admitted if it is not set
+        if not cfg:
+            return None
+        return cls(**cfg)
+
+    def fits(self, footprint: Dict):
+        for kind, limit in self.limits.items():
+            if limit is None or footprint[kind] == 0 or self.in_use[kind] == 0:
+                continue
+            if self.in_use[kind] + footprint[kind] > limit:
+                return False
+        return True
+
+    def acquire(self, footprint: Dict):
+        for kind in MEMORY_KINDS:
+            self.in_use[kind] += footprint[kind]
+
+    def release(self, footprint: Dict):
+        for kind in MEMORY_KINDS:
+            self.in_use[kind] = max(round(self.in_use[kind] - footprint[kind], 6), 0.0)
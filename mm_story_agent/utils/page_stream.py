@@ -0,0 +1,53 @@
+class PageStream:
+    """
+    Iterable over story pages that are still being written in another process.
+
+    The story writer `put`s pages as soon as each chapter is finished and `close`s
+    the stream at the end. Consumers iterate over it like a list of pages; the
+    iteration blocks until the next page arrives. Pages received so far are kept
+    in `pages`, so agents that need the story context can use what is already written.
+    """
+
+    def __init__(self, queue) -> None:
+        self.queue = queue
+        self.pages = []
+        self.finished = False
+
+    def put(self, page: str):
+        self.queue.put(page)
+
+    def close(self):
+        self.queue.put(None)
+
+    def __iter__(self):
+        idx = 0
+        while True:
+            if idx < len(self.pages):
+                yield self.pages[idx]
+                idx += 1
+            elif self.finished:
+                return
+            else:
+                page = self.queue.get()
+                if page is None:
+                    self.finished = True
+                else:
+                    self.pages.append(page)
+
+    def wait(self):
+        """Block until the whole story is written and return all pages."""
+        for _ in self:
+            pass
+        return list(self.pages)
+
+
+def pages_so_far(pages):
+    if isinstance(pages, PageStream):
+        return list(pages.pages)
+    return pages
+
+
+def all_pages(pages):
+    if isinstance(pages, PageStream):
+        return pages.wait()
+    return pages
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import threading
+from pathlib import Path
+from typing import Callable, Union
+
+# Like the trace directory, the progress file is passed to the stage processes through the
+# environment. Every process appends json lines to it; a `ProgressMonitor` tails the file and
+# feeds the events to a callback (e.g., a job dashboard).
+PROGRESS_FILE_ENV = "MM_STORY_AGENT_PROGRESS_FILE"
+
+_write_lock = threading.Lock()
+_stage = None
+
+
+def set_progress_file(progress_file: Union[str, Path, None]):
+    if progress_file is None:
+        os.environ.pop(PROGRESS_FILE_ENV, None)
+    else:
+        Path(progress_file).parent.mkdir(exist_ok=True, parents=True)
+        os.environ[PROGRESS_FILE_ENV] = str(progress_file)
+
+
+def set_progress_stage(stage: str):
+    # stage the events of this process belong to
+    global _stage
+    _stage = stage
+
+
+def emit(event: str, progress_file: Union[str, Path, None] = None, **fields):
+    # to the progress file of this process, unless another one is given
+    progress_file = progress_file or os.environ.get(PROGRESS_FILE_ENV)
+    if progress_file is None:
+        return
+    record = {"time": time.time(), "event": event, "stage": _stage, "pid": os.getpid(), **fields}
+    line = json.dumps(record, ensure_ascii=False, default=str) + "\n"
+    with _write_lock:
+        # a single append of a short line, so lines of different processes are not interleaved
+        with open(progress_file, "a") as writer:
+            writer.write(line)
+
+
+class PageProgress:
+    """
+    Emits `page_done` events of one task, with an ETA from the observed time per page.
+    `total` can be None while the story is still being written.
+    """
+
+    def __init__(self, task: str, total: int = None) -> None:
+        self.task = task
+        self.total = total
+        self.done = 0
+        self.start = time.time()
+
+    def page_done(self, page: int, **fields):
+        self.done += 1
+        elapsed = time.time() - self.start
+        eta = None
+        if self.total is not None:
+            eta = elapsed / self.done * max(self.total - self.done, 0)
+        emit("page_done", task=self.task, page=page, done=self.done, total=self.total,
+             seconds_per_page=elapsed / self.done, eta=eta, **fields)
+
+
+class ProgressMonitor:
+    """
+    Tails a progress file in a background thread and calls `callback(event)` for every event.
+    """
+
+    def __init__(self, progress_file: Union[str, Path], callback: Callable, interval: float = 0.2) -> None:
+        self.progress_file = Path(progress_file)
+        self.callback = callback
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = threading.Thread(target=self.tail, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        self.thread.join()
+
+    def tail(self):
+        position = 0
+        buffer = ""
+        while True:
+            stopping = self.stopped.is_set()
+            if self.progress_file.exists():
+                with open(self.progress_file, "r") as reader:
+                    reader.seek(position)
+                    buffer += reader.read()
+                    position = reader.tell()
+                *lines, buffer = buffer.split("\n")
+                for line in lines:
+                    if line.strip():
+                        try:
+                            self.callback(json.loads(line))
+                        except Exception as e:
+                            print(f"Progress callback failed: {e}")
+            if stopping:
+                break
+            self.stopped.wait(self.interval)
@@ -0,0 +1,176 @@
+import os
+import json
+import time
+import uuid
+import fcntl
+import random
+import asyncio
+from pathlib import Path
+from typing import Dict, Union
+from contextlib import contextmanager, asynccontextmanager
+
+# like `llm_cache`, the `llm_rate_limit` block of the config reaches the LLM tools of every
+# stage process as json in the environment
+LLM_RATE_LIMIT_ENV = "MM_STORY_AGENT_LLM_RATE_LIMIT"
+# a request still in flight after this long belongs to a process that died without releasing it
+STALE_SECONDS = 600
+
+
+def set_llm_rate_limit(cfg: Dict = None):
+    if cfg:
+        os.environ[LLM_RATE_LIMIT_ENV] = json.dumps(cfg)
+    else:
+        os.environ.pop(LLM_RATE_LIMIT_ENV, None)
+
+
+def backoff_delay(attempt: int, base: float = 1.0, cap: float = 60.0):
+    # exponential backoff with full jitter, so that retries of many processes spread out
+    return random.uniform(0, min(cap, base * 2 ** attempt))
+
+
+def is_throttled(status_code, code):
+    return status_code == 429 or str(code or "").startswith("Throttling")
+
+
+def pid_alive(pid: int):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+class RateLimiter:
+    """
+    Token bucket (`requests_per_second`, up to `burst` at once) and concurrency limit shared by
+    all processes that use the same `state_path`; the state is a small json file updated under
+    an exclusive `flock`.
+
+    The concurrency limit adapts (AIMD): it grows by one per limit's worth of requests that
+    finish within `target_latency` seconds, is halved when the provider throttles (which also
+    empties the bucket), and shrinks by 10% when requests get slower than `target_latency`.
+    """
+
+    def __init__(self,
+                 state_path: Union[str, Path] = ".cache/llm_rate_limit.json",
+                 requests_per_second: float = 5.0,
+                 burst: float = 5.0,
+                 max_concurrency: int = 16,
+                 min_concurrency: int = 1,
+                 initial_concurrency: int = 4,
+                 target_latency: float = None) -> None:
+        self.state_path = Path(state_path)
+        self.state_path.parent.mkdir(exist_ok=True, parents=True)
+        self.rate = requests_per_second
+        self.burst = burst
+        self.max_concurrency = max_concurrency
+        self.min_concurrency = min_concurrency
+        self.initial_concurrency = min(max(initial_concurrency, min_concurrency), max_concurrency)
+        self.target_latency = target_latency
+
+    @classmethod
+    def from_config(cls, cfg: Dict = None):
+        # the `rate_limit` of an LLM tool's cfg, else the `llm_rate_limit` of the pipeline config
+        if cfg is None:
+            cfg = json.loads(os.environ.get(LLM_RATE_LIMIT_ENV, "null"))
+        if not cfg:
+            return None
+        return cls(**cfg)
+
+    def update(self, fn):
+        # runs `fn(state)` under the lock and saves the state it modified
+        fd = os.open(self.state_path, os.O_RDWR | os.O_CREAT)
+        with os.fdopen(fd, "r+") as file:
+            fcntl.flock(file, fcntl.LOCK_EX)
+            try:
+                content = file.read()
+                state = json.loads(content) if content else {}
+                now = time.time()
+                state.setdefault("tokens", self.burst)
+                state.setdefault("updated", now)
+                state.setdefault("limit", float(self.initial_concurrency))
+                state.setdefault("in_flight", {})
+                state["tokens"] = min(self.burst, state["tokens"] + (now - state["updated"]) * self.rate)
+                state["updated"] = now
+                result = fn(state, now)
+                file.seek(0)
+                file.truncate()
+                file.write(json.dumps(state))
+                file.flush()
+            finally:
+                fcntl.flock(file, fcntl.LOCK_UN)
+        return result
+
+    def try_acquire(self, slot: str):
+        # returns 0 once the request may be sent, else the seconds to wait before trying again
+
+        def acquire(state, now):
+            state["in_flight"] = {
+                key: start for key, start in state["in_flight"].items()
+                if now - start < STALE_SECONDS and pid_alive(int(key.split(":")[0]))
+            }
+            if len(state["in_flight"]) >= int(state["limit"]):
+                return 0.05
+            if state["tokens"] < 1:
+                return (1 - state["tokens"]) / self.rate
+            state["tokens"] -= 1
+            state["in_flight"][slot] = now
+            return 0
+
+        return self.update(acquire)
+
+    def new_slot(self):
+        return f"{os.getpid()}:{uuid.uuid4().hex[:8]}"
+
+    def acquire(self):
+        slot = self.new_slot()
+        while True:
+            wait = self.try_acquire(slot)
+            if wait == 0:
+                return slot
+            time.sleep(wait * random.uniform(1.0, 1.5))
+
+    async def aacquire(self):
+        slot = self.new_slot()
+        while True:
+            wait = self.try_acquire(slot)
+            if wait == 0:
+                return slot
+            await asyncio.sleep(wait * random.uniform(1.0, 1.5))
+
+    @contextmanager
+    def slot(self):
+        # one request: set `outcome["throttled"]` if the provider throttled it
+        slot = self.acquire()
+        start = time.time()
+        outcome = {"throttled": False}
+        try:
+            yield outcome
+        finally:
+            self.release(slot, outcome["throttled"], time.time() - start)
+
+    @asynccontextmanager
+    async def aslot(self):
+        slot = await self.aacquire()
+        start = time.time()
+        outcome = {"throttled": False}
+        try:
+            yield outcome
+        finally:
+            self.release(slot, outcome["throttled"], time.time() - start)
+
+    def release(self, slot: str, throttled: bool = False, latency: float = None):
+
+        def release(state, now):
+            state["in_flight"].pop(slot, None)
+            if throttled:
+                state["limit"] = max(self.min_concurrency, state["limit"] / 2)
+                state["tokens"] = 0.0
+            elif self.target_latency is not None and latency is not None and latency > self.target_latency:
+                state["limit"] = max(self.min_concurrency, state["limit"] * 0.9)
+            else:
+                state["limit"] = min(self.max_concurrency, state["limit"] + 1 / state["limit"])
+
+        self.update(release)
@@ -0,0 +1,84 @@
+import threading
+from typing import Callable, Dict
+
+from .batching import run_in_batches
+
+
+class SpeculativeQueue:
+    """
+    Generates assets from draft prompts in a background thread while the reviewer is still
+    checking them, so that the review latency is hidden behind generation on the common path
+    (the first draft passes).
+
+    `submit(request)` queues a request identified by `request["key"]`. Pending requests are run
+    through `run_in_batches(requests, batch_size, generate_fn)`, `generate_fn` stores the
+    generated assets in `request["result"]`. A draft that is revised is `discard`ed: it is
+    skipped if it has not started (a running `generate_fn` can poll `is_discarded`), and its
+    result is dropped. `keep(key)` waits for a draft that passed and returns its request, or
+    None if the generation failed; `close()` waits for the worker, before the agent uses its
+    models itself.
+    """
+
+    def __init__(self,
+                 generate_fn: Callable,
+                 batch_size: int = None) -> None:
+        self.generate_fn = generate_fn
+        self.batch_size = batch_size
+        self.pending = {}
+        self.running = set()
+        self.done = {}
+        self.discarded = set()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.work, daemon=True)
+        self.thread.start()
+
+    def submit(self, request: Dict):
+        with self.condition:
+            self.discarded.discard(request["key"])
+            self.pending[request["key"]] = request
+            self.condition.notify_all()
+
+    def discard(self, key):
+        with self.condition:
+            self.pending.pop(key, None)
+            self.done.pop(key, None)
+            self.discarded.add(key)
+
+    def is_discarded(self, key):
+        with self.condition:
+            return key in self.discarded
+
+    def keep(self, key):
+        with self.condition:
+            while key in self.pending or key in self.running:
+                self.condition.wait()
+            request = self.done.pop(key, None)
+        if request is None or "error" in request:
+            return None
+        return request
+
+    def work(self):
+        while True:
+            with self.condition:
+                while not self.pending and not self.closed:
+                    self.condition.wait()
+                if not self.pending:
+                    return
+                requests = list(self.pending.values())
+                self.pending.clear()
+                self.running = {request["key"] for request in requests}
+            run_in_batches(requests, self.batch_size, self.generate_fn)
+            with self.condition:
+                for request in requests:
+                    if request["key"] not in self.discarded:
+                        self.done[request["key"]] = request
+                self.running = set()
+                self.condition.notify_all()
+
+    def close(self):
+        with self.condition:
+            self.pending.clear()
+            self.closed = True
+            self.condition.notify_all()
+        self.thread.join()
@@ -0,0 +1,105 @@
+import os
+import json
+import time
+import inspect
+import threading
+import functools
+from pathlib import Path
+from contextlib import contextmanager
+from typing import Callable, Union
+
+# The trace directory is passed to the spawned stage processes through the environment.
+# Each process appends its events to `<trace_dir>/<pid>.jsonl`, and the files are merged
+# into a single Chrome trace (chrome://tracing, Perfetto) after the run.
+TRACE_DIR_ENV = "MM_STORY_AGENT_TRACE_DIR"
+
+_write_lock = threading.Lock()
+
+
+def set_trace_dir(trace_dir: Union[str, Path, None]):
+    if trace_dir is None:
+        os.environ.pop(TRACE_DIR_ENV, None)
+    else:
+        Path(trace_dir).mkdir(exist_ok=True, parents=True)
+        os.environ[TRACE_DIR_ENV] = str(trace_dir)
+
+
+def get_trace_dir():
+    return os.environ.get(TRACE_DIR_ENV)
+
+
+def write_event(event):
+    trace_dir = get_trace_dir()
+    if trace_dir is None:
+        return
+    with _write_lock:
+        with open(Path(trace_dir) / f"{os.getpid()}.jsonl", "a") as writer:
+            writer.write(json.dumps(event, ensure_ascii=False, default=str) + "\n")
+
+
+@contextmanager
+def span(name: str, category: str = "pipeline", **args):
+    if get_trace_dir() is None:
+        yield
+        return
+    start = time.time()
+    try:
+        yield
+    finally:
+        write_event({
+            "name": name,
+            "cat": category,
+            "ph": "X",
+            "ts": start * 1e6,
+            "dur": (time.time() - start) * 1e6,
+            "pid": os.getpid(),
+            "tid": threading.get_native_id(),
+            "args": args,
+        })
+
+
+def traced(name: str, category: str = "pipeline", attrs: Callable = None, **span_args):
+    # decorator version of `span`; `attrs(arguments)` adds span args computed from the arguments
+    # of the call (a dict by parameter name, with defaults), e.g. the units of work
+    def decorator(fn):
+        signature = inspect.signature(fn)
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            call_args = span_args
+            if attrs is not None:
+                arguments = signature.bind(*args, **kwargs)
+                arguments.apply_defaults()
+                call_args = dict(span_args, **attrs(arguments.arguments))
+            with span(name, category, **call_args):
+                return fn(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def set_process_name(name: str):
+    # shown as the lane title of this process in the trace viewer
+    write_event({
+        "name": "process_name",
+        "ph": "M",
+        "pid": os.getpid(),
+        "tid": threading.get_native_id(),
+        "args": {"name": name},
+    })
+
+
+def clear_trace(trace_dir: Union[str, Path]):
+    for event_file in Path(trace_dir).glob("*.jsonl"):
+        event_file.unlink()
+
+
+def export_chrome_trace(trace_dir: Union[str, Path], save_path: Union[str, Path]):
+    events = []
+    for event_file in sorted(Path(trace_dir).glob("*.jsonl")):
+        with open(event_file, "r") as reader:
+            for line in reader:
+                line = line.strip()
+                if line:
+                    events.append(json.loads(line))
+    with open(save_path, "w") as writer:
+        json.dump({"traceEvents": events, "displayTimeUnit": "ms"}, writer, ensure_ascii=False)
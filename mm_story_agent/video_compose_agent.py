@@ -1,5 +1,7 @@
 from pathlib import Path
 from typing import List, Union
+import gc
+import time
 import random
 import re
 from datetime import timedelta
@@ -15,8 +17,76 @@ import moviepy.video.compositing.transitions as transfx
 from moviepy.audio.AudioClip import AudioArrayClip
 from moviepy.audio.fx.all import audio_loop
 from moviepy.video.tools.subtitles import SubtitlesClip
+from proglog import ProgressBarLogger
 
 from mm_story_agent.base import register_tool
+from mm_story_agent.utils.tracing import span
+from mm_story_agent.utils.progress import PageProgress, emit
+from mm_story_agent.utils.asset_bus import open_asset, asset_info
+from mm_story_agent.utils.asset import make_asset_handle
+
+
+class EncodeProgressLogger(ProgressBarLogger):
+    # reports the progress bars of moviepy (audio chunks, video frames) as progress events
+
+    def __init__(self, step: float = 0.05):
+        super().__init__()
+        self.step = step
+        self.reported = {}
+        self.started = {}
+
+    def bars_callback(self, bar, attr, value, old_value=None):
+        if attr != "index":
+            return
+        total = self.bars[bar]["total"]
+        if not total:
+            return
+        if value == 0 or bar not in self.started:
+            self.started[bar] = time.time()
+            self.reported[bar] = 0.0
+        fraction = (value + 1) / total
+        if fraction - self.reported[bar] < self.step and value + 1 < total:
+            return
+        self.reported[bar] = fraction
+        elapsed = time.time() - self.started[bar]
+        emit("encode_progress", bar=bar, done=value + 1, total=total, fraction=fraction,
+             eta=elapsed / fraction * (1 - fraction))
+
+
+def asset_exists(path: Path):
+    # assets of agents with `save_files: false` are only on the asset bus
+    return path.exists() or asset_info(path) is not None
+
+
+def load_audio(path: Union[str, Path], sample_rate: int):
+    """
+    Returns the audio clip of an asset and its mono samples at the original sample rate (for the
+    loudness), from the asset bus if the agent published it there, else decoded from the file.
+    """
+    opened = open_asset(path)
+    if opened is None:
+        samples, _ = librosa.core.load(str(path), sr=None)
+        return AudioFileClip(str(path), fps=sample_rate), samples
+    block, array, meta = opened
+    samples = np.array(array, dtype=np.float32)
+    del array
+    block.close()
+    mono = samples if samples.ndim == 1 else samples.mean(axis=1)
+    if meta["sample_rate"] != sample_rate:
+        samples = librosa.resample(samples.T, orig_sr=meta["sample_rate"], target_sr=sample_rate).T
+    if samples.ndim == 1:
+        samples = np.stack([samples, samples], axis=1)
+    return AudioArrayClip(samples, fps=sample_rate), mono
+
+
+def load_image(path: Union[str, Path], blocks: List):
+    # the pixels stay in shared memory until the video is encoded, their blocks are collected in `blocks`
+    opened = open_asset(path)
+    if opened is None:
+        return ImageClip(str(path))
+    block, array, meta = opened
+    blocks.append(block)
+    return ImageClip(array)
 
 
 def generate_srt(timestamps: List,
@@ -226,6 +296,13 @@ def add_slide_effect(clips, slide_duration):
     return video
 
 
+def traced_pages(num_pages: int):
+    # the pages to compose, each one recorded as a span while the loop body runs
+    for page in trange(1, num_pages + 1):
+        with span("compose page", category="compose", unit="compose_page", page=page):
+            yield page
+
+
 def compose_video(story_dir: Union[str, Path],
                   save_path: Union[str, Path],
                   captions: List,
@@ -253,18 +330,19 @@ def compose_video(story_dir: Union[str, Path],
     # audio_durations = []
     cur_duration = 0
     timestamps = []
+    blocks = []
 
-    for page in trange(1, num_pages + 1):
+    progress = PageProgress("compose", total=num_pages)
+    for page in traced_pages(num_pages):
         ##### speech track
         slide_silence = AudioArrayClip(np.zeros((int(audio_sample_rate * slide_duration), 2)), fps=audio_sample_rate)
         fade_silence = AudioArrayClip(np.zeros((int(audio_sample_rate * fade_duration), 2)), fps=audio_sample_rate)
 
-        if (speech_dir / f"p{page}.wav").exists(): # single speech file
+        if asset_exists(speech_dir / f"p{page}.wav"): # single speech file
             single_utterance = True
-            speech_file = (speech_dir / f"./p{page}.wav").__str__()
-            speech_clip = AudioFileClip(speech_file, fps=audio_sample_rate)
+            speech_clip, speech_array = load_audio(speech_dir / f"p{page}.wav", audio_sample_rate)
             # speech_clip = speech_clip.audio_fadein(fade_duration)
-            
+        
             speech_clip = concatenate_audioclips([fade_silence, speech_clip, fade_silence])
         else: # multiple speech files
             single_utterance = False
@@ -272,9 +350,10 @@ def compose_video(story_dir: Union[str, Path],
             speech_files = sorted(speech_files, key=lambda x: int(x.stem.split("_")[-1]))
             speech_clips = []
             for utt_idx, speech_file in enumerate(speech_files):
-                speech_clip = AudioFileClip(speech_file.__str__(), fps=audio_sample_rate)
+                speech_clip, samples = load_audio(speech_file, audio_sample_rate)
                 # add multiple timestamps of the same speech clip
                 if utt_idx == 0:
+                    speech_array = samples # for energy calculation
                     timestamps.append([cur_duration + fade_duration,
                                        cur_duration + fade_duration + speech_clip.duration])
                     cur_duration += speech_clip.duration + fade_duration
@@ -292,14 +371,13 @@ def compose_video(story_dir: Union[str, Path],
                     cur_duration += speech_clip.duration
                 speech_clips.append(speech_clip)
             speech_clip = concatenate_audioclips([fade_silence] + speech_clips + [fade_silence])
-            speech_file = speech_files[0] # for energy calculation
-        
+    
         # add slide silence
         if page == 1:
             speech_clip = concatenate_audioclips([speech_clip, slide_silence])
         else:
             speech_clip = concatenate_audioclips([slide_silence, speech_clip, slide_silence])
-        
+    
         # add the timestamp of the whole clip as a single element 
         if single_utterance:
             if page == 1:
@@ -311,12 +389,10 @@ def compose_video(story_dir: Union[str, Path],
                                    cur_duration + speech_clip.duration - fade_duration - slide_duration])
                 cur_duration += speech_clip.duration - slide_duration
 
-        speech_array, _ = librosa.core.load(speech_file, sr=None)
         speech_rms = librosa.feature.rms(y=speech_array)[0].mean()
 
         # set image as the main content, align the duration
-        image_file = (image_dir / f"./p{page}.png").__str__()        
-        image_clip = ImageClip(image_file)
+        image_clip = load_image(image_dir / f"p{page}.png", blocks)
         image_clip = image_clip.set_duration(speech_clip.duration).set_fps(fps)
         image_clip = image_clip.crossfadein(fade_duration).crossfadeout(fade_duration)
 
@@ -335,14 +411,13 @@ def compose_video(story_dir: Union[str, Path],
 
         # sound track
         sound_file = sound_dir / f"p{page}.wav"
-        if sound_file.exists():
-            sound_clip = AudioFileClip(sound_file.__str__(), fps=audio_sample_rate)
+        if asset_exists(sound_file):
+            sound_clip, sound_array = load_audio(sound_file, audio_sample_rate)
             sound_clip = sound_clip.audio_fadein(fade_duration)
             if sound_clip.duration < speech_clip.duration:
                 sound_clip = audio_loop(sound_clip, duration=speech_clip.duration)
             else:
                 sound_clip = sound_clip.subclip(0, speech_clip.duration)
-            sound_array, _ = librosa.core.load(sound_file.__str__(), sr=None)
             sound_rms = librosa.feature.rms(y=sound_array)[0].mean()
             ratio = speech_rms / sound_rms * bg_speech_ratio
             audio_clip = CompositeAudioClip([speech_clip, sound_clip.volumex(sound_volume * ratio).audio_fadeout(fade_duration)])
@@ -351,44 +426,63 @@ def compose_video(story_dir: Union[str, Path],
 
         video_clip = image_clip.set_audio(audio_clip)        
         video_clips.append(video_clip)
+        progress.page_done(page)
 
         # audio_durations.append(audio_clip.duration)
 
     # final_clip = concatenate_videoclips(video_clips, method="compose")
-    composite_clip = add_slide_effect(video_clips, slide_duration=slide_duration)
-    composite_clip = add_bottom_black_area(composite_clip, black_area_height=caption_config["area_height"])
-    del caption_config["area_height"]
-    max_caption_length = caption_config["max_length"]
-    del caption_config["max_length"]
-    composite_clip = add_caption(
-        captions,
-        story_dir / "captions.srt",
-        timestamps,
-        composite_clip,
-        max_caption_length,
-        **caption_config
-    )
+    with span("slide effect", category="compose"):
+        composite_clip = add_slide_effect(video_clips, slide_duration=slide_duration)
+    with span("caption", category="compose"):
+        composite_clip = add_bottom_black_area(composite_clip, black_area_height=caption_config["area_height"])
+        del caption_config["area_height"]
+        max_caption_length = caption_config["max_length"]
+        del caption_config["max_length"]
+        composite_clip = add_caption(
+            captions,
+            story_dir / "captions.srt",
+            timestamps,
+            composite_clip,
+            max_caption_length,
+            **caption_config
+        )
 
     # add music track, align the duration
-    music_clip = AudioFileClip(music_path.__str__(), fps=audio_sample_rate)
-    music_array, _ = librosa.core.load(music_path.__str__(), sr=None)
-    music_rms = librosa.feature.rms(y=music_array)[0].mean()
-    ratio = speech_rms / music_rms * bg_speech_ratio
-    if music_clip.duration < composite_clip.duration:
-        music_clip = audio_loop(music_clip, duration=composite_clip.duration)
-    else:
-        music_clip = music_clip.subclip(0, composite_clip.duration)
-    all_audio_clip = CompositeAudioClip([composite_clip.audio, music_clip.volumex(music_volume * ratio)])
-    composite_clip = composite_clip.set_audio(all_audio_clip)
+    with span("music track", category="compose"):
+        music_clip, music_array = load_audio(music_path, audio_sample_rate)
+        music_rms = librosa.feature.rms(y=music_array)[0].mean()
+        ratio = speech_rms / music_rms * bg_speech_ratio
+        if music_clip.duration < composite_clip.duration:
+            music_clip = audio_loop(music_clip, duration=composite_clip.duration)
+        else:
+            music_clip = music_clip.subclip(0, composite_clip.duration)
+        all_audio_clip = CompositeAudioClip([composite_clip.audio, music_clip.volumex(music_volume * ratio)])
+        composite_clip = composite_clip.set_audio(all_audio_clip)
     
-    composite_clip.write_videofile(save_path.__str__(),
-                                   audio_fps=audio_sample_rate,
-                                   audio_codec=audio_codec,)
+    with span("encode video", category="compose", unit="video_frame",
+              units=int(composite_clip.duration * fps), pages=num_pages, fps=fps):
+        composite_clip.write_videofile(save_path.__str__(),
+                                       audio_fps=audio_sample_rate,
+                                       audio_codec=audio_codec,
+                                       logger=EncodeProgressLogger())
+    del video_clips, video_clip, image_clip, composite_clip
+    gc.collect()
+    for block in blocks:
+        try:
+            block.close()
+        except BufferError:
+            # a clip still references the pixels, the mapping goes away with the process
+            pass
 
 
 @register_tool("slideshow_video_compose")
 class SlideshowVideoComposeAgent:
 
+    pool = "compose"
+
+    # estimated peak memory in GB, used by the memory budget (all clips are kept in memory until encoding)
+    memory_footprint = {"ram": 4}
+
     def __init__(self, cfg) -> None:
         self.cfg = cfg
 
@@ -405,9 +499,10 @@ class SlideshowVideoComposeAgent:
         width = params["width"]
         pages = params["pages"]
         params["caption"].update(self.adjust_caption_config(width, height))
+        save_path = Path(params["story_dir"]) / "output.mp4"
         compose_video(
             story_dir=Path(params["story_dir"]),
-            save_path=Path(params["story_dir"]) / "output.mp4",
+            save_path=save_path,
             captions=pages,
             music_path=Path(params["story_dir"]) / "music/music.wav",
             num_pages=len(pages),
@@ -416,4 +511,5 @@ class SlideshowVideoComposeAgent:
             audio_codec=params["audio_codec"],
             caption_config=params["caption"],
             **params["slideshow_effect"]
-        )
\ No newline at end of file
+        )
+        return {"video": make_asset_handle(save_path)}
\ No newline at end of file
@@ -1,17 +1,138 @@
 import argparse
 import yaml
 from mm_story_agent import MMStoryAgent
+from mm_story_agent.utils.llm_cache import set_llm_cache
+from mm_story_agent.utils.rate_limit import set_llm_rate_limit
+from mm_story_agent.utils.llm_backend import set_llm_backend
 
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser()
-    parser.add_argument("--config", "-c", type=str, required=True)
+    parser.add_argument("--config", "-c", type=str)
+    parser.add_argument("--topics", type=str, default=None,
+                        help="batch mode: generate one story per topic in this json file, "
+                             "using `--config` as the template")
+    parser.add_argument("--config_dir", type=str, default=None,
+                        help="batch mode: generate one story per yaml config in this directory")
+    parser.add_argument("--resume", action="store_true",
+                        help="skip pipeline steps whose checkpoints in `story_dir` have unchanged inputs")
+    parser.add_argument("--estimate", action="store_true",
+                        help="dry run: print the LLM requests, diffusion steps, MusicGen tokens, video frames "
+                             "and seconds the story (or batch) would take, without running anything")
+    parser.add_argument("--calibrate", type=str, nargs="*", default=None,
+                        help="trace.json files (or story dirs) of previous runs to time the units of `--estimate`, "
+                             "by default the trace.json in `story_dir` if any")
+    parser.add_argument("--serve", action="store_true",
+                        help="keep the models loaded and accept story jobs over HTTP, with `--config` as the template")
+    parser.add_argument("--socket", type=str, default=None,
+                        help="serve on this unix socket instead of a localhost port")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--tool_server", action="store_true",
+                        help="serve tools to `remote` stages of other hosts over TCP on `--port`")
+    parser.add_argument("--host", type=str, default="127.0.0.1",
+                        help="address the servers bind; with --tool_server, another address than the loopback "
+                             "requires --tools or a token in MM_STORY_AGENT_TOOL_TOKEN")
+    parser.add_argument("--tools", type=str, nargs="*", default=None,
+                        help="with --tool_server: only serve these tools")
+    parser.add_argument("--llm_server", action="store_true",
+                        help="serve a local stand-in of an OpenAI-compatible LLM API (canned answers of the stub "
+                             "LLM, with the `cfg` of the `llm` block of --config) on `--port`, for offline runs")
+    parser.add_argument("--queue", type=str, default=None,
+                        help="sqlite job queue: run its jobs with one worker pool per modality "
+                             "(sizes from `job_queue.pools` of `--config`) until all are finished")
+    parser.add_argument("--submit", action="store_true",
+                        help="with --queue: only add the stories of --config / --topics / --config_dir as jobs")
 
     args = parser.parse_args()
 
-    with open(args.config, "r") as reader:
-        config = yaml.load(reader, Loader=yaml.FullLoader)
-    
-    mm_story_agent = MMStoryAgent()
-    mm_story_agent.call(config)
+    if args.config is not None:
+        # the LLM backend, response cache and rate limit apply in every mode, the stage processes inherit them
+        with open(args.config, "r") as reader:
+            llm_config = yaml.load(reader, Loader=yaml.FullLoader) or {}
+        set_llm_backend(llm_config.get("llm"))
+        set_llm_cache(llm_config.get("llm_cache"))
+        set_llm_rate_limit(llm_config.get("llm_rate_limit"))
+
+    if args.llm_server:
+        from mm_story_agent.modality_agents.openai_llm import OpenAIStandInServer
+        OpenAIStandInServer(args.host, args.port, (llm_config.get("llm") or {}).get("cfg") if args.config else None).serve()
+    elif args.tool_server:
+        from mm_story_agent.modality_agents.remote_agent import RemoteToolServer
+        RemoteToolServer(args.host, args.port, args.tools).serve()
+    elif args.queue is not None:
+        from mm_story_agent.job_queue import JobQueue, QueueRunner
+        config = None
+        if args.config is not None:
+            with open(args.config, "r") as reader:
+                config = yaml.load(reader, Loader=yaml.FullLoader)
+        if args.submit:
+            if args.config_dir is not None:
+                from mm_story_agent.batch import configs_from_dir
+                configs = configs_from_dir(args.config_dir)
+            elif config is None:
+                parser.error("--submit requires --config or --config_dir")
+            elif args.topics is not None:
+                from mm_story_agent.batch import configs_from_topics, load_topics
+                configs = configs_from_topics(config, load_topics(args.topics))
+            else:
+                configs = [config]
+            job_queue = JobQueue(args.queue)
+            for config in configs:
+                config["resume"] = args.resume
+                print(f"Job {job_queue.submit(config)}: {config['story_dir']}")
+        else:
+            pools = ((config or {}).get("job_queue") or {}).get("pools")
+            QueueRunner(args.queue, pools).run()
+    elif args.serve:
+        if args.config is None:
+            parser.error("--serve requires --config")
+        from mm_story_agent.server import StoryServer
+        with open(args.config, "r") as reader:
+            config = yaml.load(reader, Loader=yaml.FullLoader)
+        StoryServer(config, socket_path=args.socket, port=args.port).serve()
+    elif args.estimate:
+        from pathlib import Path
+        from mm_story_agent.estimator import CostEstimator, calibrate, print_report
+        if args.config_dir is not None:
+            from mm_story_agent.batch import configs_from_dir
+            configs = configs_from_dir(args.config_dir)
+        else:
+            if args.config is None:
+                parser.error("--config is required unless --config_dir is given")
+            with open(args.config, "r") as reader:
+                configs = [yaml.load(reader, Loader=yaml.FullLoader)]
+            if args.topics is not None:
+                from mm_story_agent.batch import configs_from_topics, load_topics
+                configs = configs_from_topics(configs[0], load_topics(args.topics))
+        trace_files = args.calibrate
+        if trace_files is None:
+            trace_files = [Path(config["story_dir"]) / "trace.json" for config in configs]
+            trace_files = [trace_file for trace_file in trace_files if trace_file.exists()]
+        unit_costs = calibrate(trace_files)
+        if args.topics is not None:
+            # the stories of a topic file only differ in their topic
+            print(f"{len(configs)} stories like:")
+            configs = configs[:1]
+        for config in configs:
+            print(f"==> {config['story_dir']}")
+            print_report(CostEstimator(config, unit_costs).estimate())
+    elif args.config_dir is not None:
+        from mm_story_agent.batch import BatchStoryRunner, configs_from_dir
+        configs = configs_from_dir(args.config_dir)
+        for config in configs:
+            config["resume"] = args.resume
+        BatchStoryRunner(configs).run()
+    else:
+        if args.config is None:
+            parser.error("--config is required unless --config_dir is given")
+        with open(args.config, "r") as reader:
+            config = yaml.load(reader, Loader=yaml.FullLoader)
+        config["resume"] = args.resume
+
+        if args.topics is not None:
+            from mm_story_agent.batch import BatchStoryRunner, configs_from_topics, load_topics
+            BatchStoryRunner(configs_from_topics(config, load_topics(args.topics))).run()
+        else:
+            mm_story_agent = MMStoryAgent()
+            mm_story_agent.call(config)
@@ -0,0 +1,41 @@
+import json
+
+from mm_story_agent.modality_agents import story_agent
+from mm_story_agent.modality_agents.story_agent import QAOutlineStoryWriter
+
+
+class FlakyWriter:
+    """
+    Writes each chapter as a list of pages; the first turn breaks off after two pages, the
+    retry continues the chapter after the pages of its `completed_story`.
+    """
+
+    def __init__(self, pages):
+        self.pages = pages
+        self.prompts = []
+
+    def stream(self, prompt, parser, **kwargs):
+        self.prompts.append(json.loads(prompt))
+        written = len(self.prompts[-1]["completed_story"])
+        parser.reset()
+        if len(self.prompts) == 1:
+            output = json.dumps(self.pages[:2])[:-1] + ", oops"
+        else:
+            output = json.dumps(self.pages[written:])
+        yield from parser.feed(output)
+        parser.close()
+
+
+def test_retried_chapter_delivers_every_continuation_page(monkeypatch):
+    pages = ["page1", "page2", "page3", "page4", "page5"]
+    writer = FlakyWriter(pages)
+    monkeypatch.setattr(story_agent, "init_tool_instance", lambda cfg: writer)
+    agent = QAOutlineStoryWriter({"llm": "flaky"})
+
+    story = list(agent.iter_story_from_outline({
+        "story_title": "title",
+        "story_outline": [{"chapter_title": "chapter", "chapter_summary": "summary"}]
+    }))
+
+    assert story == pages
+    assert writer.prompts[1]["completed_story"] == ["page1", "page2"]